@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'campus_marketplace.settings')
+# One long-lived event loop serves every request, so async views keep their own connection pools
+os.environ.setdefault('SHOP_ASYNC_HTTP', '1')
 
 application = get_asgi_application()
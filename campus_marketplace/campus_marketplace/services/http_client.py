@@ -0,0 +1,331 @@
+"""
+Shared outbound HTTP client for the payment and delivery providers.
+
+One requests.Session per provider keeps connections alive between calls,
+so a quote or invoice doesn't pay for a fresh TCP+TLS handshake. Every
+call has a connect/read timeout. Idempotent calls are retried a bounded
+number of times with jittered exponential backoff. A per-provider circuit
+breaker stops calling a provider that keeps failing, for a cool-down
+period, instead of tying up workers on it.
+
+Usage:
+    response = get_client('xendit').post(url, json=payload, idempotent=True)
+    response = await get_async_client('lalamove').post(url, json=payload, idempotent=True)
+
+The async client does the same over httpx for async views, with its own
+connection pool per event loop and the provider's circuit breaker shared
+with the sync client. That only pays off under ASGI (SHOP_ASYNC_HTTP,
+set by asgi.py), where one loop serves every request. Under WSGI each
+async view runs in a fresh loop, so there get_async_client hands out the
+pooled sync client run on a shared thread pool instead of opening (and
+leaking) a new connection pool per request. A caller that stops waiting
+on such a call (e.g. on a deadline) gets control back at once; the
+request finishes in the background within its own timeout.
+
+Per-provider settings can be overridden with settings.SHOP_HTTP_CLIENTS,
+e.g. {'lalamove': {'read_timeout': 20}}.
+"""
+import asyncio
+import functools
+import logging
+import random
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+PROVIDERS = {
+    'lalamove': {
+        'connect_timeout': 3.05,
+        'read_timeout': 10,
+        'retries': 2,
+    },
+    'xendit': {
+        'connect_timeout': 3.05,
+        'read_timeout': 15,
+        'retries': 2,
+    },
+}
+DEFAULTS = {
+    'connect_timeout': 3.05,
+    'read_timeout': 10,
+    'retries': 2,
+    'backoff': 0.3,            # seconds; doubled per attempt, with full jitter
+    'pool_size': 10,           # kept-alive connections per host
+    'failure_threshold': 5,    # consecutive failures that open the circuit
+    'reset_timeout': 30,       # seconds the circuit stays open before a trial call
+}
+IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'})
+RETRY_STATUSES = frozenset({429, 502, 503, 504})
+# Threads running sync client calls for async code under WSGI
+THREADS = getattr(settings, 'SHOP_HTTP_THREADS', 32)
+
+
+class ServiceUnavailable(requests.exceptions.ConnectionError):
+    """Raised without calling the provider while its circuit is open."""
+
+
+class CircuitBreaker:
+    """Opens after failure_threshold consecutive failures; lets one trial call through after reset_timeout."""
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial_running or time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self._trial_running = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+    def release(self):
+        """For a call that ended without telling us anything (e.g. cancelled): free the trial slot."""
+        with self._lock:
+            self._trial_running = False
+
+
+class ServiceClient:
+    def __init__(self, name, connect_timeout, read_timeout, retries, backoff, pool_size,
+                 failure_threshold, reset_timeout):
+        self.name = name
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.session = requests.Session()
+        # Retries are done here, where the breaker can see every attempt
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, url, *, idempotent=None, **kwargs):
+        """
+        Like requests.request. Pass idempotent=True for a POST the provider
+        deduplicates (e.g. with an idempotency key header) so it may be retried.
+        """
+        method = method.upper()
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        kwargs.setdefault('timeout', self.timeout)
+        attempts = 1 + (self.retries if idempotent else 0)
+        response = None
+
+        for attempt in range(1, attempts + 1):
+            if not self.breaker.allow():
+                if response is not None:
+                    # The circuit opened between retries; hand back the failure we got
+                    return response
+                logger.warning("%s circuit open, not calling %s %s", self.name, method, url)
+                raise ServiceUnavailable(f"{self.name} is temporarily unavailable")
+
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self.breaker.record_failure()
+                logger.warning("%s %s %s failed after %.0f ms (attempt %d/%d): %s", self.name, method, url,
+                               (time.perf_counter() - started) * 1000, attempt, attempts, e)
+                if attempt == attempts:
+                    raise
+                self._sleep(attempt)
+                continue
+            except Exception:
+                # e.g. a broken body or too many redirects: not retried, but it still counts,
+                # and a trial call must always settle the breaker or it stays open for good
+                self.breaker.record_failure()
+                raise
+            except BaseException:
+                self.breaker.release()
+                raise
+
+            elapsed = (time.perf_counter() - started) * 1000
+            if response.status_code >= 500 or response.status_code == 429:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            logger.info("%s %s %s -> %s in %.0f ms (attempt %d/%d)", self.name, method, url,
+                        response.status_code, elapsed, attempt, attempts)
+            if response.status_code in RETRY_STATUSES and attempt < attempts:
+                response.close()  # give the connection back to the pool
+                self._sleep(attempt)
+                continue
+            return response
+
+    def _backoff_delay(self, attempt):
+        # Full jitter: anywhere up to the exponential cap, so retries from many workers spread out
+        return random.uniform(0, self.backoff * 2 ** (attempt - 1))
+
+    def _sleep(self, attempt):
+        time.sleep(self._backoff_delay(attempt))
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+class AsyncServiceClient:
+    """
+    ServiceClient for async code, on httpx.AsyncClient. Same timeouts,
+    retries and logging; failures count against the sync client's breaker,
+    so both see the provider as down at the same time. Errors are httpx
+    exceptions, except ServiceUnavailable while the circuit is open.
+    """
+
+    def __init__(self, client):
+        self.name = client.name
+        self.retries = client.retries
+        self._backoff_delay = client._backoff_delay
+        self.breaker = client.breaker
+        self.session = httpx.AsyncClient(
+            timeout=httpx.Timeout(client.read_timeout, connect=client.connect_timeout),
+            # Like the requests pool: extra connections are opened when busy, pool_size are kept alive
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=client.pool_size),
+        )
+
+    async def request(self, method, url, *, idempotent=None, **kwargs):
+        method = method.upper()
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        attempts = 1 + (self.retries if idempotent else 0)
+        response = None
+
+        for attempt in range(1, attempts + 1):
+            if not self.breaker.allow():
+                if response is not None:
+                    return response
+                logger.warning("%s circuit open, not calling %s %s", self.name, method, url)
+                raise ServiceUnavailable(f"{self.name} is temporarily unavailable")
+
+            started = time.perf_counter()
+            try:
+                response = await self.session.request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                self.breaker.record_failure()
+                logger.warning("%s %s %s failed after %.0f ms (attempt %d/%d): %r", self.name, method, url,
+                               (time.perf_counter() - started) * 1000, attempt, attempts, e)
+                if attempt == attempts:
+                    raise
+                await asyncio.sleep(self._backoff_delay(attempt))
+                continue
+            except Exception:
+                self.breaker.record_failure()
+                raise
+            except BaseException:
+                # Cancelled, say by a deadline: nothing learned about the provider
+                self.breaker.release()
+                raise
+
+            elapsed = (time.perf_counter() - started) * 1000
+            if response.status_code >= 500 or response.status_code == 429:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            logger.info("%s %s %s -> %s in %.0f ms (attempt %d/%d)", self.name, method, url,
+                        response.status_code, elapsed, attempt, attempts)
+            if response.status_code in RETRY_STATUSES and attempt < attempts:
+                await response.aclose()
+                await asyncio.sleep(self._backoff_delay(attempt))
+                continue
+            return response
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+
+class ThreadedServiceClient:
+    """
+    The async interface over a ServiceClient, each call run on the shared
+    thread pool. Errors are requests exceptions, as with the sync client.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.name = client.name
+
+    async def request(self, method, url, *, content=None, **kwargs):
+        if content is not None:
+            kwargs['data'] = content
+        # Not sync_to_async: when cancelled it still waits for the thread to finish,
+        # and so would the request's event loop before the view could return
+        call = functools.partial(self.client.request, method, url, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(_executor, call)
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=THREADS, thread_name_prefix='http-client')
+# httpx connections belong to the loop that opened them: one set of clients per
+# event loop, dropped with it
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_client(name):
+    """The process-wide client for a provider, created on first use."""
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                options = {**DEFAULTS, **PROVIDERS.get(name, {})}
+                options.update(getattr(settings, 'SHOP_HTTP_CLIENTS', {}).get(name, {}))
+                client = _clients[name] = ServiceClient(name, **options)
+    return client
+
+
+def get_async_client(name):
+    """
+    Under ASGI, the running event loop's async client for a provider, created
+    on first use. Otherwise the process-wide client, called from a thread.
+    """
+    if not getattr(settings, 'SHOP_ASYNC_HTTP', False):
+        return ThreadedServiceClient(get_client(name))
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get(name)
+    if client is None:
+        client = clients[name] = AsyncServiceClient(get_client(name))
+    return client
@@ -1,4 +1,3 @@
-import requests
 import hmac
 import hashlib
 import time
@@ -8,6 +7,7 @@ from campus_marketplace.settings import LALAMOVE_API_KEY as API_KEY
 from campus_marketplace.settings import LALAMOVE_API_SECRET as API_SECRET
 from campus_marketplace.settings import LALAMOVE_MARKET as MARKET
 from campus_marketplace.settings import LALAMOVE_BASE_URL as BASE_URL   
+from campus_marketplace.services.http_client import get_async_client, get_client
 
 def _generate_signature(api_secret, timestamp, method, path, body_json=""):
     """Internal helper to generate the HMAC-SHA256 signature."""
@@ -18,9 +18,9 @@ def _generate_signature(api_secret, timestamp, method, path, body_json=""):
         hashlib.sha256
     ).hexdigest()
 
-def _make_lalamove_request(method, path, data=None):
-    """Internal helper to handle signed HTTP requests."""
-    
+def _signed_request(method, path, data=None):
+    """Internal helper returning the URL, headers and body of a signed request."""
+
     timestamp = str(int(time.time() * 1000))
     body_json = json.dumps(data) if data else ""
     signature = _generate_signature(API_SECRET, timestamp, method, path, body_json)
@@ -32,12 +32,24 @@ def _make_lalamove_request(method, path, data=None):
         'Market': MARKET
     }
     
-    url = f"{BASE_URL}{path}"
-    
-    response = requests.request(method, url, headers=headers, data=body_json)
+    return f"{BASE_URL}{path}", headers, body_json
+
+def _make_lalamove_request(method, path, data=None, idempotent=False):
+    """Internal helper to handle signed HTTP requests over the shared, pooled client."""
+    url, headers, body_json = _signed_request(method, path, data)
+    response = get_client('lalamove').request(method, url, headers=headers, data=body_json, idempotent=idempotent)
     response.raise_for_status() # Raises an exception for 4xx/5xx responses
     return response.json()
 
+async def _amake_lalamove_request(method, path, data=None, idempotent=False, timeout=None):
+    """Async version of _make_lalamove_request; raises httpx.HTTPStatusError (requests.HTTPError under WSGI) for 4xx/5xx responses."""
+    url, headers, body_json = _signed_request(method, path, data)
+    options = {} if timeout is None else {'timeout': timeout}
+    response = await get_async_client('lalamove').request(method, url, headers=headers, content=body_json,
+                                                          idempotent=idempotent, **options)
+    response.raise_for_status()
+    return response.json()
+
 # --- Public Interface Functions ---
 
 def get_lalamove_quotation(order_details_payload):
@@ -46,7 +58,14 @@ def get_lalamove_quotation(order_details_payload):
     Returns the JSON response (including 'quotedTotalFee').
     """
     path = "/v3/quotations"
-    return _make_lalamove_request("POST", path, data=order_details_payload)
+    # A quotation has no side effects, so it is safe to retry
+    return _make_lalamove_request("POST", path, data=order_details_payload, idempotent=True)
+
+def _require_quotation(order_details_payload):
+    # An order is placed against a quotation from the previous step; a fee
+    # estimated from past quotes has none and can't be booked
+    if not (order_details_payload.get('data') or {}).get('quotationId'):
+        raise ValueError("A Lalamove order needs the quotationId of a live quote")
 
 def create_lalamove_order(order_details_payload):
     """
@@ -54,5 +73,18 @@ def create_lalamove_order(order_details_payload):
     Returns the JSON response with the order details.
     """
     path = "/v3/orders"
-    # Ensure the payload includes the quotationId from the previous step
-    return _make_lalamove_request("POST", path, data=order_details_payload)
\ No newline at end of file
+    _require_quotation(order_details_payload)
+    return _make_lalamove_request("POST", path, data=order_details_payload)
+
+async def aget_lalamove_quotation(order_details_payload, timeout=None):
+    """
+    Async version of get_lalamove_quotation. With a timeout (seconds), for
+    callers on a deadline, it makes one attempt that gives up after it.
+    """
+    return await _amake_lalamove_request("POST", "/v3/quotations", data=order_details_payload,
+                                         idempotent=timeout is None, timeout=timeout)
+
+async def acreate_lalamove_order(order_details_payload):
+    """Async version of create_lalamove_order."""
+    _require_quotation(order_details_payload)
+    return await _amake_lalamove_request("POST", "/v3/orders", data=order_details_payload)
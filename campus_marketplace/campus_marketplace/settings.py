@@ -55,7 +55,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    # WhiteNoise, async-capable so async views stay async under ASGI
+    'campus_marketplace.middleware.AsyncWhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -77,6 +78,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'shop.context_processors.badges',
             ],
         },
     },
@@ -104,6 +106,32 @@ else:
         }
     }
 
+# One cache for every process (web workers, run_worker, cron commands): the
+# version tokens, badge counters, quote locks and image flags kept in it are
+# only useful if all of them see the same values. Redis when REDIS_URL is
+# set, otherwise a database table (created by the 0027_cache_table migration).
+# Either may evict entries, so nothing is kept here that can't be rebuilt;
+# the table is sized well above what the shop stores so that is rare, and
+# culls a tenth of it at a time when it does fill up.
+if os.getenv('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_URL'),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'shop_cache',
+            'OPTIONS': {
+                'MAX_ENTRIES': int(os.getenv('CACHE_MAX_ENTRIES', 100000)),
+                'CULL_FREQUENCY': 10,
+            },
+        }
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -164,8 +192,17 @@ LOGIN_URL = '/login/'
 LOGIN_REDIRECT_URL = '/'
 LOGOUT_REDIRECT_URL = '/'
 
+# Async views use httpx pools of their own only when served by ASGI (set in asgi.py)
+SHOP_ASYNC_HTTP = os.getenv('SHOP_ASYNC_HTTP') == '1'
+
 # Email Configuration (using Gmail)
-EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+# Mail is queued in the outbox and delivered by the task worker (shop/mail.py)
+EMAIL_BACKEND = 'shop.mail.OutboxEmailBackend'
+# What the worker delivers with; set EMAIL_DELIVERY_BACKEND to
+# django.core.mail.backends.console.EmailBackend (or .filebased.) to only print or save it
+SHOP_EMAIL_DELIVERY_BACKEND = os.getenv('EMAIL_DELIVERY_BACKEND', 'django.core.mail.backends.smtp.EmailBackend')
+EMAIL_FILE_PATH = BASE_DIR / 'sent_emails'
+EMAIL_TIMEOUT = 30
 EMAIL_HOST = 'smtp.gmail.com'
 EMAIL_PORT = 587
 EMAIL_USE_TLS = True
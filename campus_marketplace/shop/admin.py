@@ -1,9 +1,9 @@
 from django.contrib import admin
-from .models import CartItem, Order, OrderItem, Category, Product, ShippingAddress
+from .models import CartItem, OutgoingEmail, Order, OrderItem, Category, Product, ProductRecommendation, ShippingAddress, ShippingEstimate, StockReservation, Task, WebhookEvent
 
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
-    list_display = ('name', 'slug')
+    list_display = ('name', 'slug', 'length')
     prepopulated_fields = {'slug': ('name',)}
 
 @admin.register(Product)
@@ -12,7 +12,27 @@ class ProductAdmin(admin.ModelAdmin):
     list_filter = ('category', 'seller')
     search_fields = ('name', 'description')
 
+@admin.register(WebhookEvent)
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = ('external_id', 'status', 'provider', 'received_at', 'processed_at', 'attempts')
+    list_filter = ('provider', 'status')
+    search_fields = ('external_id', 'event_id')
+
+@admin.register(Task)
+class TaskAdmin(admin.ModelAdmin):
+    list_display = ('name', 'status', 'priority', 'run_at', 'attempts', 'finished_at')
+    list_filter = ('status', 'name')
+
+@admin.register(OutgoingEmail)
+class OutgoingEmailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'status', 'attempts', 'created_at', 'sent_at')
+    list_filter = ('status',)
+    search_fields = ('subject',)
+
 admin.site.register(CartItem)
 admin.site.register(Order)
 admin.site.register(OrderItem)
-admin.site.register(ShippingAddress)    
+admin.site.register(ShippingAddress)
+admin.site.register(ProductRecommendation)    
+admin.site.register(StockReservation)
+admin.site.register(ShippingEstimate)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ShopConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'shop'
+
+    def ready(self):
+        # Connect the search index and cache invalidation signals, and register background tasks
+        from . import search, caching, autocomplete, images, webhooks, mail  # noqa: F401
@@ -0,0 +1,252 @@
+"""
+In-process prefix index for search-as-you-type suggestions.
+
+Every product and category name is stored under each of its word
+suffixes ("red running shoes", "running shoes", "shoes") in one sorted
+list, so a prefix lookup is a bisect plus a short scan. The index is
+built once per process and then kept current from the model signals.
+
+When a name or slug changes, the signals also record an
+AutocompleteChange row. Every SYNC_INTERVAL seconds at most, a lookup
+reads the rows recorded since its process last looked and re-reads just
+those products and categories, so other processes patch their index too
+instead of rebuilding it. Rows are kept for CHANGES_KEPT; a process that
+hasn't looked for that long rebuilds.
+"""
+import bisect
+import threading
+import time
+import unicodedata
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+SYNC_INTERVAL = 5
+# Re-read changes this far behind the last look, for rows committed late or stamped by a skewed clock
+SYNC_OVERLAP = timedelta(seconds=30)
+CHANGES_KEPT = timedelta(days=1)
+
+
+def normalize(text):
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return ' '.join(text.casefold().split())
+
+
+class PrefixIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = []       # sorted search keys
+        self._entries = []    # (kind, id) aligned with _keys
+        self._labels = {}     # (kind, id) -> (label, extra)
+        self._terms = {}      # (kind, id) -> keys, for removal
+
+    def __len__(self):
+        return len(self._labels)
+
+    @staticmethod
+    def _keys_for(label):
+        words = normalize(label).split(' ')
+        return sorted({' '.join(words[i:]) for i in range(len(words)) if words[i]})
+
+    def load(self, items):
+        """Replace the whole index with (kind, id, label, extra) items."""
+        pairs, labels, terms = [], {}, {}
+        for kind, obj_id, label, extra in items:
+            entry = (kind, obj_id)
+            keys = self._keys_for(label)
+            labels[entry] = (label, extra)
+            terms[entry] = keys
+            pairs.extend((key, entry) for key in keys)
+        pairs.sort()
+        with self._lock:
+            self._keys = [key for key, _ in pairs]
+            self._entries = [entry for _, entry in pairs]
+            self._labels = labels
+            self._terms = terms
+
+    def add(self, kind, obj_id, label, extra=None):
+        entry = (kind, obj_id)
+        with self._lock:
+            if self._labels.get(entry) == (label, extra):
+                return
+            self._remove(entry)
+            keys = self._keys_for(label)
+            for key in keys:
+                i = bisect.bisect_left(self._keys, key)
+                self._keys.insert(i, key)
+                self._entries.insert(i, entry)
+            self._labels[entry] = (label, extra)
+            self._terms[entry] = keys
+
+    def remove(self, kind, obj_id):
+        with self._lock:
+            self._remove((kind, obj_id))
+
+    def _remove(self, entry):
+        for key in self._terms.pop(entry, ()):
+            i = bisect.bisect_left(self._keys, key)
+            while i < len(self._keys) and self._keys[i] == key:
+                if self._entries[i] == entry:
+                    del self._keys[i]
+                    del self._entries[i]
+                    break
+                i += 1
+        self._labels.pop(entry, None)
+
+    def lookup(self, prefix, limit=8):
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        results, seen = [], set()
+        with self._lock:
+            i = bisect.bisect_left(self._keys, prefix)
+            while i < len(self._keys) and len(results) < limit and self._keys[i].startswith(prefix):
+                entry = self._entries[i]
+                if entry not in seen:
+                    seen.add(entry)
+                    label, extra = self._labels[entry]
+                    results.append((entry[0], entry[1], label, extra))
+                i += 1
+        return results
+
+
+_index = PrefixIndex()
+_loaded = False
+# Changes stamped since this (less SYNC_OVERLAP) may not be in the index yet
+_synced_to = None
+_checked_at = float('-inf')
+_sync_lock = threading.Lock()
+
+
+def _load_index():
+    from .models import Category, Product
+
+    global _loaded, _synced_to
+    started = timezone.now()
+    items = [('category', pk, name, slug) for pk, name, slug in Category.objects.values_list('pk', 'name', 'slug')]
+    items += [('product', pk, name, None) for pk, name in Product.objects.values_list('pk', 'name').iterator()]
+    _index.load(items)
+    _synced_to = started
+    _loaded = True
+
+
+def _sync():
+    """Re-read what other processes changed since the last look, or everything if that was too long ago."""
+    from .models import AutocompleteChange, Category, Product
+
+    global _synced_to
+    started = timezone.now()
+    if started - _synced_to > CHANGES_KEPT - SYNC_OVERLAP:
+        _load_index()
+        return
+    changed = {'category': set(), 'product': set()}
+    changes = AutocompleteChange.objects.filter(changed_at__gte=_synced_to - SYNC_OVERLAP)
+    for kind, obj_id in changes.values_list('kind', 'object_id'):
+        changed[kind].add(obj_id)
+    # Applying the current names, not the logged ones, makes reading a change twice harmless
+    current = {}
+    if changed['category']:
+        for pk, name, slug in Category.objects.filter(pk__in=changed['category']).values_list('pk', 'name', 'slug'):
+            current['category', pk] = (name, slug)
+    if changed['product']:
+        for pk, name in Product.objects.filter(pk__in=changed['product']).values_list('pk', 'name'):
+            current['product', pk] = (name, None)
+    for kind in ('category', 'product'):
+        for obj_id in changed[kind]:
+            if (kind, obj_id) in current:
+                _index.add(kind, obj_id, *current[kind, obj_id])
+            else:
+                _index.remove(kind, obj_id)
+    _synced_to = started
+
+
+def get_index():
+    """The process-wide index, built on first use and patched with other processes' changes."""
+    global _checked_at
+    if not _loaded:
+        with _sync_lock:
+            if not _loaded:
+                _load_index()
+                _checked_at = time.monotonic()
+    elif time.monotonic() - _checked_at >= SYNC_INTERVAL and _sync_lock.acquire(blocking=False):
+        # One thread catches up; the others keep answering from the index as it is
+        try:
+            _sync()
+            _checked_at = time.monotonic()
+        finally:
+            _sync_lock.release()
+    return _index
+
+
+def suggest(prefix, limit=8):
+    """Category suggestions first, then products, up to limit in total."""
+    matches = get_index().lookup(prefix, limit=limit * 2)
+    matches.sort(key=lambda match: match[0] != 'category')
+    return matches[:limit]
+
+
+def _changed(kind, obj_id, label=None, extra=None):
+    """Record a saved (label given) or deleted product or category once the transaction commits."""
+    from .models import AutocompleteChange
+
+    def apply():
+        # Tell other processes, even if this one (admin, run_worker, a command) never loaded the index
+        now = timezone.now()
+        AutocompleteChange.objects.create(kind=kind, object_id=obj_id, changed_at=now)
+        AutocompleteChange.objects.filter(changed_at__lt=now - CHANGES_KEPT).delete()
+        if _loaded:
+            # Patch our own index instead of waiting for the next sync
+            if label is None:
+                _index.remove(kind, obj_id)
+            else:
+                _index.add(kind, obj_id, label, extra)
+
+    transaction.on_commit(apply)
+
+
+def _label(instance, *fields):
+    # Read from __dict__ so a deferred field doesn't cost a query
+    return tuple(instance.__dict__.get(field) for field in fields)
+
+
+def _label_saved(instance, created, *fields):
+    label = _label(instance, *fields)
+    changed = created or label != instance._indexed_label
+    instance._indexed_label = label
+    return changed
+
+
+@receiver(post_init, sender='shop.Product')
+def remember_product_name(sender, instance, **kwargs):
+    instance._indexed_label = _label(instance, 'name')
+
+
+@receiver(post_save, sender='shop.Product')
+def index_product_name(sender, instance, created, raw=False, **kwargs):
+    if not raw and _label_saved(instance, created, 'name'):
+        _changed('product', instance.pk, instance.name)
+
+
+@receiver(post_delete, sender='shop.Product')
+def unindex_product_name(sender, instance, **kwargs):
+    _changed('product', instance.pk)
+
+
+@receiver(post_init, sender='shop.Category')
+def remember_category_name(sender, instance, **kwargs):
+    instance._indexed_label = _label(instance, 'name', 'slug')
+
+
+@receiver(post_save, sender='shop.Category')
+def index_category_name(sender, instance, created, raw=False, **kwargs):
+    if not raw and _label_saved(instance, created, 'name', 'slug'):
+        _changed('category', instance.pk, instance.name, instance.slug)
+
+
+@receiver(post_delete, sender='shop.Category')
+def unindex_category_name(sender, instance, **kwargs):
+    _changed('category', instance.pk)
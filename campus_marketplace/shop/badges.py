@@ -0,0 +1,73 @@
+"""
+Per-user cart and unread-message counters for the page header.
+
+Counts live in the cache and are adjusted in place by the views that
+change them; the database is only counted when a counter is missing.
+Adjustments are applied after commit, and a missing counter is left
+missing so the next read rebuilds it instead of incrementing a guess.
+"""
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Sum
+
+CART = 'cart'
+UNREAD = 'unread'
+# Bounds the drift from writes that bypass the views (admin, shell)
+COUNTER_TIMEOUT = 60 * 60
+
+
+def _key(kind, user_id):
+    return f'badges:{kind}:{user_id}'
+
+
+def _count_from_db(kind, user_id):
+    from .models import CartItem, Message
+
+    if kind == CART:
+        return CartItem.objects.filter(user_id=user_id).aggregate(n=Sum('quantity'))['n'] or 0
+    return Message.objects.filter(recipient_id=user_id, is_read=False).count()
+
+
+def get_counts(user):
+    """{'cart': n, 'unread': n} for the user, rebuilding only the counters the cache lost."""
+    if not user.is_authenticated:
+        return {CART: 0, UNREAD: 0}
+    keys = {kind: _key(kind, user.pk) for kind in (CART, UNREAD)}
+    cached = cache.get_many(keys.values())
+    counts, missing = {}, {}
+    for kind, key in keys.items():
+        if key in cached:
+            counts[kind] = cached[key]
+        else:
+            counts[kind] = missing[key] = _count_from_db(kind, user.pk)
+    if missing:
+        cache.set_many(missing, COUNTER_TIMEOUT)
+    return counts
+
+
+def adjust(kind, user_id, delta):
+    """Add delta to a user's counter once the current transaction commits."""
+    if not delta:
+        return
+    key = _key(kind, user_id)
+
+    def apply():
+        try:
+            if cache.incr(key, delta) < 0:
+                cache.delete(key)
+        except ValueError:
+            pass
+
+    transaction.on_commit(apply)
+
+
+def reset(kind, user_id, value=0):
+    """Set a user's counter outright, e.g. after the cart is emptied."""
+    key = _key(kind, user_id)
+    transaction.on_commit(lambda: cache.set(key, value, COUNTER_TIMEOUT))
+
+
+def forget(kind, user_id):
+    """Drop a counter whose change can't be expressed as a delta; it is recounted on next read."""
+    key = _key(kind, user_id)
+    transaction.on_commit(lambda: cache.delete(key))
@@ -0,0 +1,132 @@
+"""
+Cached shared part of the product detail page.
+
+Entries are stamped with the version of the product's category and seller
+at build time. Saving a product, its category or its seller's profile
+(or rebuilding the recommendations) bumps the matching version, so stale entries are rebuilt on the next hit
+without having to find and delete every product that references them.
+"""
+import uuid
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from django.http import Http404
+
+from .models import Category, Product, Profile
+
+PRODUCT_DETAIL_TIMEOUT = 15 * 60
+RELATED_COUNT = 4
+
+
+def _detail_key(product_id):
+    return f'product_detail:{product_id}'
+
+
+def _version_key(kind, object_id):
+    return f'product_detail:{kind}:{object_id}'
+
+
+def bump_version(kind, *object_ids):
+    versions = {_version_key(kind, i): uuid.uuid4().hex for i in object_ids if i is not None}
+    # After commit, so a reader can't rebuild from the old rows and stamp them with the new version
+    transaction.on_commit(lambda: cache.set_many(versions, None))
+
+
+def _current_versions(category_id, seller_id):
+    keys = [
+        _version_key('category', category_id),
+        _version_key('seller', seller_id),
+        _version_key('recommendations', 'all'),
+    ]
+    versions = cache.get_many(keys)
+    missing = {key: uuid.uuid4().hex for key in keys if key not in versions}
+    if missing:
+        # A version the cache evicted comes back as a new one, not as None, which an entry
+        # stamped before it was ever bumped would still match
+        for key, version in missing.items():
+            if not cache.add(key, version, None):
+                version = cache.get(key, version)
+            versions[key] = version
+    return tuple(versions[key] for key in keys)
+
+
+def _build_product_detail(product_id):
+    seller_products = (
+        Product.objects.filter(seller=OuterRef('seller'))
+        .order_by().values('seller').annotate(n=Count('pk')).values('n')
+    )
+    try:
+        product = (
+            Product.objects.select_related('category', 'seller', 'seller__profile')
+            .annotate(seller_products_count=Subquery(seller_products, output_field=IntegerField()))
+            .get(pk=product_id)
+        )
+    except Product.DoesNotExist:
+        raise Http404("No Product matches the given query.")
+
+    # "Customers also bought" neighbours, topped up from the category when history is thin
+    related_products = list(
+        Product.objects.filter(recommended_in__product=product).order_by('recommended_in__rank')[:RELATED_COUNT]
+    )
+    if len(related_products) < RELATED_COUNT:
+        related_products += Product.objects.filter(category_id=product.category_id).exclude(
+            pk__in=[product.pk] + [p.pk for p in related_products]
+        )[:RELATED_COUNT - len(related_products)]
+    return {
+        'product': product,
+        'related_products': related_products,
+        'seller': product.seller,
+        'seller_products_count': product.seller_products_count,
+    }
+
+
+def get_product_detail(product_id):
+    """Return the product page context shared by all users, from cache when fresh."""
+    cached = cache.get(_detail_key(product_id))
+    if cached is not None:
+        product = cached['product']
+        if cached['versions'] == _current_versions(product.category_id, product.seller_id):
+            return cached
+
+    detail = _build_product_detail(product_id)
+    product = detail['product']
+    # A bump racing with the build can leave this entry stale until the next bump or the timeout
+    detail['versions'] = _current_versions(product.category_id, product.seller_id)
+    cache.set(_detail_key(product_id), detail, PRODUCT_DETAIL_TIMEOUT)
+    return detail
+
+
+def invalidate_product(product):
+    key = _detail_key(product.pk)
+    transaction.on_commit(lambda: cache.delete(key))
+    # Related lists of the category and the seller's product count change too;
+    # read from __dict__ so a deferred (possibly deleted) product isn't refetched
+    bump_version('category', product.__dict__.get('category_id'))
+    bump_version('seller', product.__dict__.get('seller_id'))
+
+
+@receiver(pre_save, sender=Product)
+def invalidate_previous_category(sender, instance, **kwargs):
+    previous = getattr(instance, '_original_category_id', None)
+    if previous is not None and previous != instance.category_id:
+        bump_version('category', previous)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product_detail(sender, instance, **kwargs):
+    invalidate_product(instance)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category_details(sender, instance, **kwargs):
+    bump_version('category', instance.pk)
+
+
+@receiver(post_save, sender=Profile)
+def invalidate_seller_details(sender, instance, **kwargs):
+    bump_version('seller', instance.user_id)
@@ -0,0 +1,173 @@
+"""
+A user's cart as one object per request.
+
+The lines are fetched once, together with their products and sellers, and
+the subtotal comes back from the same query as a windowed SUM, so a page
+costs one query however many lines the cart has. Money is kept as Decimal
+throughout.
+
+Visitors who aren't logged in get a GuestCart instead: product ids and
+quantities in a signed cookie, so adding to it never touches the database.
+It is folded into the user's CartItem rows when they log in.
+"""
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.db import transaction
+from django.db.models import Case, DecimalField, ExpressionWrapper, F, Sum, Value, When, Window
+from django.utils.functional import cached_property
+
+from .models import CartItem, Product, available_stock
+
+TAX_RATE = Decimal('0.05')
+CENTS = Decimal('0.01')
+
+GUEST_CART_COOKIE = 'guest_cart'
+GUEST_CART_SALT = 'shop.cart.guest'
+GUEST_CART_MAX_AGE = 30 * 24 * 60 * 60
+GUEST_CART_MAX_LINES = 50
+
+
+def _money(amount):
+    return Decimal(amount).quantize(CENTS, rounding=ROUND_HALF_UP)
+
+
+class Cart:
+    def __init__(self, user):
+        self.user = user
+
+    @classmethod
+    def for_request(cls, request):
+        """The request user's cart, built once and shared by everything handling the request."""
+        cart = getattr(request, '_cart', None)
+        if cart is None or cart.user != request.user:
+            cart = request._cart = cls(request.user)
+        return cart
+
+    @cached_property
+    def _rows(self):
+        line_total = ExpressionWrapper(
+            F('quantity') * F('product__price'),
+            output_field=DecimalField(max_digits=12, decimal_places=2),
+        )
+        return list(
+            CartItem.objects.filter(user=self.user)
+            .select_related('product__seller')
+            .annotate(line_amount=line_total, cart_subtotal=Window(Sum(line_total)),
+                      available_stock=available_stock('product'))
+            .order_by('pk')
+        )
+
+    def refresh(self):
+        """Forget the loaded lines after the cart was changed."""
+        self.__dict__.pop('_rows', None)
+
+    @property
+    def lines(self):
+        return self._rows
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __bool__(self):
+        return bool(self._rows)
+
+    @property
+    def quantity(self):
+        return sum(line.quantity for line in self._rows)
+
+    @property
+    def subtotal(self):
+        return _money(self._rows[0].cart_subtotal if self._rows else 0)
+
+    @property
+    def tax(self):
+        return _money(self.subtotal * TAX_RATE)
+
+    @property
+    def total(self):
+        return self.subtotal + self.tax
+
+    def total_with(self, shipping):
+        return self.total + _money(shipping)
+
+
+class GuestCart:
+    """
+    {product_id: quantity} kept in a signed cookie as "12:1|15:3".
+    Changes are written back with save(response).
+    """
+
+    def __init__(self, items=None):
+        self.items = dict(items or {})
+
+    @classmethod
+    def from_request(cls, request):
+        raw = request.get_signed_cookie(GUEST_CART_COOKIE, default='', salt=GUEST_CART_SALT)
+        items = {}
+        for pair in raw.split('|') if raw else ():
+            try:
+                product_id, quantity = (int(part) for part in pair.split(':'))
+            except ValueError:
+                continue
+            if product_id > 0 and quantity > 0:
+                items[product_id] = quantity
+        return cls(items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __bool__(self):
+        return bool(self.items)
+
+    @property
+    def quantity(self):
+        return sum(self.items.values())
+
+    def add(self, product_id, quantity=1):
+        if product_id not in self.items and len(self.items) >= GUEST_CART_MAX_LINES:
+            return False
+        self.items[product_id] = self.items.get(product_id, 0) + quantity
+        return True
+
+    def lines(self):
+        """Unsaved CartItems for the products still on sale, for showing the cart; one query."""
+        products = Product.objects.filter(pk__in=self.items).select_related('seller').order_by('pk')
+        return [CartItem(product=product, quantity=self.items[product.pk]) for product in products]
+
+    def save(self, response):
+        if not self.items:
+            response.delete_cookie(GUEST_CART_COOKIE)
+            return
+        value = '|'.join(f'{product_id}:{quantity}' for product_id, quantity in self.items.items())
+        response.set_signed_cookie(
+            GUEST_CART_COOKIE, value, salt=GUEST_CART_SALT,
+            max_age=GUEST_CART_MAX_AGE, httponly=True, samesite='Lax',
+        )
+
+    def merge_into(self, user):
+        """
+        Add the guest lines to the user's cart; returns how many units were merged.
+        Missing lines are inserted empty, then every line is topped up in one
+        UPDATE relative to its current quantity, so a concurrent change to the
+        same line (another tab, the cart API) isn't overwritten.
+        """
+        if not self.items:
+            return 0
+        with transaction.atomic():
+            product_ids = sorted(Product.objects.filter(pk__in=self.items).values_list('pk', flat=True))
+            if not product_ids:
+                return 0
+            CartItem.objects.bulk_create(
+                [CartItem(user=user, product_id=product_id, shipping_method='P', quantity=0) for product_id in product_ids],
+                ignore_conflicts=True,
+            )
+            CartItem.objects.filter(user=user, product_id__in=product_ids).update(
+                quantity=F('quantity') + Case(
+                    *(When(product_id=product_id, then=Value(self.items[product_id])) for product_id in product_ids),
+                    default=Value(0),
+                )
+            )
+        return sum(self.items[product_id] for product_id in product_ids)
@@ -0,0 +1,118 @@
+"""
+Validators for conditional GET on the catalog pages.
+
+Each page's ETag is a hash of a cheap summary of what it renders (latest
+updated_at plus row count of the products and categories involved), the
+full URL and the viewing user's own state, so an unchanged page is
+answered with 304 before any template is rendered. Pages with pending
+flash messages are never short-circuited.
+"""
+import hashlib
+
+from django.contrib.messages import get_messages
+from django.db.models import Count, Max
+from django.db.models.functions import Now
+
+from .badges import get_counts
+from .caching import get_product_detail
+from .cart import GuestCart
+from .models import CartItem, Category, Product, StockReservation
+from .search import search_products
+
+
+def _memoize(request, key, compute):
+    # condition() asks for the ETag and Last-Modified separately; compute once per request
+    cache = request.__dict__.setdefault('_conditional_state', {})
+    if key not in cache:
+        cache[key] = compute()
+    return cache[key]
+
+
+def _holds_state():
+    # Holds change available stock without touching the products; they also lapse by
+    # themselves, which changes the count of active ones
+    return tuple(
+        StockReservation.objects.filter(expires_at__gt=Now())
+        .aggregate(count=Count('pk'), latest=Max('pk')).values()
+    )
+
+
+def _catalog_state(products, holds=False):
+    product_state = products.order_by().aggregate(updated=Max('updated_at'), count=Count('pk'))
+    category_state = Category.objects.aggregate(updated=Max('updated_at'), count=Count('pk'))
+    stamps = [s for s in (product_state['updated'], category_state['updated']) if s is not None]
+    parts = (product_state['count'], category_state['count'])
+    if holds:
+        parts += _holds_state()
+    return max(stamps, default=None), parts
+
+
+def _user_state(request):
+    if not request.user.is_authenticated:
+        # The guest cart badge is read from the cookie
+        return ('anon', GuestCart.from_request(request).quantity)
+    # The header badges come from cached counters, so this costs no query
+    counts = get_counts(request.user)
+    return (request.user.pk, counts['cart'], counts['unread'])
+
+
+def _validators(request, key, compute):
+    """(etag, last_modified) for the page, or (None, None) when it must be rendered."""
+    def build():
+        if len(get_messages(request)):
+            return None, None
+        last_modified, parts = compute()
+        user_state = _user_state(request)
+        if request.user.is_authenticated and request.user.last_login:
+            # A fresh login must not be answered from a copy cached for whoever was here before
+            last_modified = max(filter(None, (last_modified, request.user.last_login)))
+        raw = repr((key, request.get_full_path(), user_state, last_modified, parts))
+        return hashlib.sha1(raw.encode(), usedforsecurity=False).hexdigest(), last_modified
+    return _memoize(request, key, build)
+
+
+def homepage_etag(request):
+    return _validators(request, 'homepage', lambda: _catalog_state(Product.objects.all(), holds=True))[0]
+
+
+def homepage_last_modified(request):
+    return _validators(request, 'homepage', lambda: _catalog_state(Product.objects.all(), holds=True))[1]
+
+
+def _product_list_state(request):
+    products = Product.objects.all()
+    query = request.GET.get('q')
+    if query:
+        products = search_products(products, query)
+    # Facet counts cover the whole (searched) set, so validate against all of it;
+    # the page shows available stock, so holds count too
+    return _catalog_state(products, holds=True)
+
+
+def product_list_etag(request):
+    return _validators(request, 'product_list', lambda: _product_list_state(request))[0]
+
+
+def product_list_last_modified(request):
+    return _validators(request, 'product_list', lambda: _product_list_state(request))[1]
+
+
+def _product_detail_state(request, product_id):
+    detail = get_product_detail(product_id)
+    product, seller = detail['product'], detail['seller']
+    stamps = [product.updated_at, product.category.updated_at]
+    if hasattr(seller, 'profile'):
+        stamps.append(seller.profile.updated_at)
+    stamps += [p.updated_at for p in detail['related_products']]
+    in_cart = request.user.is_authenticated and CartItem.objects.filter(user=request.user, product=product).exists()
+    related = tuple(p.pk for p in detail['related_products'])
+    available = Product.objects.with_available_stock().values_list('available_stock', flat=True).get(pk=product.pk)
+    return max(stamps), (detail['seller_products_count'], related, in_cart, available)
+
+
+def product_detail_etag(request, product_id):
+    return _validators(request, 'product_detail', lambda: _product_detail_state(request, product_id))[0]
+
+
+def product_detail_last_modified(request, product_id):
+    return _validators(request, 'product_detail', lambda: _product_detail_state(request, product_id))[1]
@@ -0,0 +1,16 @@
+from django.utils.functional import SimpleLazyObject
+
+from .badges import get_counts
+from .cart import GuestCart
+
+
+def _badge_counts(request):
+    counts = get_counts(request.user)
+    if not request.user.is_authenticated:
+        counts['cart'] = GuestCart.from_request(request).quantity
+    return counts
+
+
+def badges(request):
+    """Header badges as {{ badges.cart }} / {{ badges.unread }}, looked up only if a template uses them."""
+    return {'badges': SimpleLazyObject(lambda: _badge_counts(request))}
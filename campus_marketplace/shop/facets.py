@@ -0,0 +1,89 @@
+"""
+Sidebar filters and facet counts for product_list.
+
+All facet counts come from a single conditional aggregation over the
+current result set: each facet ignores its own filter (so the other
+options stay clickable) but honours every other one.
+"""
+from decimal import Decimal, InvalidOperation
+
+from django.db.models import Count, Q
+
+
+# (min, max) inclusive; prices have two decimal places so buckets don't overlap
+PRICE_BUCKETS = [
+    (None, Decimal('99.99')),
+    (Decimal('100'), Decimal('499.99')),
+    (Decimal('500'), Decimal('999.99')),
+    (Decimal('1000'), Decimal('4999.99')),
+    (Decimal('5000'), None),
+]
+
+
+def _parse_price(value):
+    try:
+        price = Decimal(value)
+    except (TypeError, InvalidOperation):
+        return None
+    return price if price.is_finite() and price >= 0 else None
+
+
+def parse_filters(params, categories):
+    """Read the filter query parameters; invalid values are ignored."""
+    slug = params.get('category')
+    return {
+        'category': next((c for c in categories if c.slug == slug), None),
+        'min_price': _parse_price(params.get('min_price')),
+        'max_price': _parse_price(params.get('max_price')),
+        'in_stock': params.get('in_stock') == '1',
+        'seller': params.get('seller') or None,
+    }
+
+
+def _price_q(min_price, max_price):
+    q = Q()
+    if min_price is not None:
+        q &= Q(price__gte=min_price)
+    if max_price is not None:
+        q &= Q(price__lte=max_price)
+    return q
+
+
+def filter_conditions(filters):
+    """Return (category, price, other) Q objects for the active filters."""
+    category_q = Q(category_id=filters['category'].pk) if filters['category'] else Q()
+    price_q = _price_q(filters['min_price'], filters['max_price'])
+    other_q = Q()
+    if filters['in_stock']:
+        # Units held for open invoices can't be bought; needs Product.objects.with_available_stock()
+        other_q &= Q(available_stock__gt=0)
+    if filters['seller']:
+        other_q &= Q(seller__username=filters['seller'])
+    return category_q, price_q, other_q
+
+
+def facet_counts(queryset, categories, filters):
+    """
+    Count matching products per category and per price bucket in one query.
+    Sets `facet_count` on each category and returns the price bucket list.
+    """
+    category_q, price_q, other_q = filter_conditions(filters)
+    aggregates = {
+        f'category_{c.pk}': Count('pk', filter=Q(category_id=c.pk) & price_q)
+        for c in categories
+    }
+    for i, (low, high) in enumerate(PRICE_BUCKETS):
+        aggregates[f'price_{i}'] = Count('pk', filter=_price_q(low, high) & category_q)
+    counts = queryset.filter(other_q).aggregate(**aggregates)
+
+    for c in categories:
+        c.facet_count = counts[f'category_{c.pk}']
+    return [
+        {
+            'min_price': low,
+            'max_price': high,
+            'count': counts[f'price_{i}'],
+            'selected': (low, high) == (filters['min_price'], filters['max_price']),
+        }
+        for i, (low, high) in enumerate(PRICE_BUCKETS)
+    ]
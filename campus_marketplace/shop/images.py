@@ -0,0 +1,187 @@
+"""
+Resized WebP/JPEG derivatives of uploaded product photos and avatars.
+
+Derivatives are written next to the original through the default storage
+("products/shoe.jpg" -> "products/shoe_thumb.webp", "products/shoe_thumb.jpg", ...)
+by a background task queued when an image is uploaded. Storages may not
+keep the name asked for (Cloudinary, or any storage that avoids
+overwriting, adds a suffix), so the names they return are recorded in
+ImageDerivative rows, with a copy in the shared cache, and that is what
+the responsive_image template tag builds its srcsets from. Until they
+exist, it renders the original image and queues the task for older
+uploads that never had one.
+"""
+import logging
+import os
+from io import BytesIO
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models.signals import post_init, post_save
+from django.dispatch import receiver
+from PIL import Image, ImageOps
+
+from .models import ImageDerivative
+from .taskqueue import task
+
+logger = logging.getLogger(__name__)
+
+# name -> longest edge in pixels
+SIZES = {
+    'thumb': 320,
+    'medium': 640,
+    'large': 1280,
+}
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+READY_TIMEOUT = None
+FAILED_TIMEOUT = 60 * 60
+# How long a render waits before queuing the same missing image again
+QUEUED_TIMEOUT = 60 * 60
+
+
+def derivative_name(name, size, ext):
+    root, _ = os.path.splitext(name)
+    return f'{root}_{size}.{ext}'
+
+
+def _ready_key(name):
+    return f'image_derivatives:{name}'
+
+
+def _complete(names):
+    return isinstance(names, dict) and all(f'{size}.{ext}' in names for size in SIZES for ext in FORMATS)
+
+
+def _recorded(name):
+    # {'thumb.webp': stored name, ...} once generated, False if that failed, None if unknown
+    state = cache.get(_ready_key(name))
+    if state is False:
+        return False
+    if _complete(state):
+        return state
+    # The cache only copies the database; fall back to it when the entry was culled
+    names = ImageDerivative.objects.filter(original=name).values_list('names', flat=True).first()
+    if _complete(names):
+        cache.set(_ready_key(name), names, READY_TIMEOUT)
+        return names
+    return None
+
+
+def generate_derivatives(name, storage=default_storage, force=False):
+    """
+    Write every size/format of the stored image `name` and record the names
+    they were stored under; returns how many were written.
+    """
+    with storage.open(name, 'rb') as original:
+        image = Image.open(original)
+        image = ImageOps.exif_transpose(image)
+        image.load()
+    if image.mode not in ('RGB', 'L'):
+        # JPEG has no alpha channel; flatten onto white
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.convert('RGBA').getchannel('A'))
+        image = background
+
+    written = 0
+    stored = {}
+    for size, edge in SIZES.items():
+        resized = image.copy()
+        resized.thumbnail((edge, edge), Image.Resampling.LANCZOS)
+        for ext, (pil_format, options) in FORMATS.items():
+            target = derivative_name(name, size, ext)
+            if not force and storage.exists(target):
+                stored[f'{size}.{ext}'] = target
+                continue
+            buffer = BytesIO()
+            resized.save(buffer, pil_format, **options)
+            if storage.exists(target):
+                storage.delete(target)
+            # The storage may have saved it under another name
+            stored[f'{size}.{ext}'] = storage.save(target, ContentFile(buffer.getvalue()))
+            written += 1
+    ImageDerivative.objects.update_or_create(original=name, defaults={'names': stored})
+    cache.set(_ready_key(name), stored, READY_TIMEOUT)
+    return written
+
+
+def ensure_derivatives(name):
+    """Generate the derivatives of `name` unless they are recorded already; True if they exist."""
+    state = _recorded(name)
+    if state is not None:
+        return bool(state)
+    try:
+        generate_derivatives(name)
+        return True
+    except Exception:
+        # Unreadable or missing original: serve it as-is and don't retry on every render
+        logger.exception("Could not generate derivatives for %s", name)
+        cache.set(_ready_key(name), False, FAILED_TIMEOUT)
+        return False
+
+
+def derivative_srcsets(name):
+    """
+    {'webp': 'url 320w, ...', 'jpg': ...} and the fallback src, or None while
+    they aren't available. Never generates anything; missing ones are queued.
+    """
+    stored = _recorded(name)
+    if stored is False:
+        return None
+    if stored is None:
+        # Never generated (an older upload): leave it to a worker
+        if cache.add(f'{_ready_key(name)}:queued', True, QUEUED_TIMEOUT):
+            build_derivatives.enqueue(name)
+        return None
+    srcsets = {
+        ext: ', '.join(f'{default_storage.url(stored[f"{size}.{ext}"])} {edge}w' for size, edge in SIZES.items())
+        for ext in FORMATS
+    }
+    return srcsets, default_storage.url(stored['medium.jpg'])
+
+
+@task(priority=-10)
+def build_derivatives(name):
+    """Generate an image's derivatives in the background; queued on upload and by the template tag."""
+    ensure_derivatives(name)
+
+
+def _stored_name(instance, field_name):
+    # Read from __dict__ so a deferred field doesn't cost a query
+    value = instance.__dict__.get(field_name)
+    return getattr(value, 'name', value) or ''
+
+
+def _regenerate_if_changed(instance, field_name):
+    name = _stored_name(instance, field_name)
+    if name and name != instance._original_image_name:
+        # Resizing is slow; a worker does it, and pages show the original until then
+        ImageDerivative.objects.filter(original=name).delete()
+        cache.delete(_ready_key(name))
+        build_derivatives.enqueue(name)
+    instance._original_image_name = name
+
+
+@receiver(post_init, sender='shop.Product')
+def remember_product_image(sender, instance, **kwargs):
+    instance._original_image_name = _stored_name(instance, 'image')
+
+
+@receiver(post_save, sender='shop.Product')
+def generate_product_image_derivatives(sender, instance, raw=False, **kwargs):
+    if not raw:
+        _regenerate_if_changed(instance, 'image')
+
+
+@receiver(post_init, sender='shop.Profile')
+def remember_avatar(sender, instance, **kwargs):
+    instance._original_image_name = _stored_name(instance, 'avatar')
+
+
+@receiver(post_save, sender='shop.Profile')
+def generate_avatar_derivatives(sender, instance, raw=False, **kwargs):
+    if not raw:
+        _regenerate_if_changed(instance, 'avatar')
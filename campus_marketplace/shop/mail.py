@@ -0,0 +1,239 @@
+"""
+Outgoing mail through an outbox.
+
+With EMAIL_BACKEND = 'shop.mail.OutboxEmailBackend', send_mail() and
+friends (password reset included) only store the message as an
+OutgoingEmail row and queue the send_outbox task, so a request never
+waits on SMTP. drain_outbox then delivers queued mail in batches over one
+connection to the real backend (SHOP_EMAIL_DELIVERY_BACKEND, Gmail SMTP
+in production), no faster than SHOP_EMAIL_RATE messages a second. Point
+that setting at Django's console or file-based backend to see the mail
+locally without sending anything.
+
+A message that fails is retried after RETRY_BACKOFF, doubled per
+attempt, up to MAX_ATTEMPTS; if the server can't be reached at all, the
+claimed batch goes back to the queue for RETRY_BACKOFF without using up
+an attempt. While mail is waiting to be retried, send_outbox schedules
+itself for when the next message is due.
+
+Notifications go through send_notification, which leaves out users who
+turned email notifications off in their profile.
+"""
+import base64
+import logging
+import smtplib
+import time
+import uuid
+from datetime import timedelta
+from email import message_from_bytes
+from email.message import Message
+from email.mime.base import MIMEBase
+
+from django.conf import settings
+from django.core.mail import EmailMessage, EmailMultiAlternatives, get_connection
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db.models import F
+from django.utils import timezone
+
+from .models import OutgoingEmail
+from .taskqueue import task
+
+logger = logging.getLogger(__name__)
+
+DELIVERY_BACKEND = getattr(settings, 'SHOP_EMAIL_DELIVERY_BACKEND', 'django.core.mail.backends.smtp.EmailBackend')
+# Messages per second; Gmail throttles bursts
+RATE = getattr(settings, 'SHOP_EMAIL_RATE', 2)
+BATCH_SIZE = 50
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF = 30          # seconds before the first retry, doubled per attempt
+# A batch claimed by a sender that hasn't finished by then is assumed lost and sent again
+CLAIM_TIMEOUT = timedelta(minutes=15)
+
+
+class OutboxEmailBackend(BaseEmailBackend):
+    """Stores messages in the outbox and returns; drain_outbox sends them."""
+
+    def send_messages(self, email_messages):
+        rows = [_to_row(message) for message in email_messages if message.recipients()]
+        if not rows:
+            return 0
+        OutgoingEmail.objects.bulk_create(rows)
+        send_outbox.enqueue()
+        return len(rows)
+
+
+def _encode(content):
+    return base64.b64encode(content).decode()
+
+
+def _attachment_row(attachment):
+    if isinstance(attachment, MIMEBase):
+        # Attached ready-made (an inline image with its Content-ID, say): keep every header
+        return {'mime': _encode(attachment.as_bytes())}
+    filename, content, mimetype = attachment
+    if isinstance(content, EmailMessage):
+        content = content.message()
+    if isinstance(content, Message):
+        # A forwarded message/rfc822
+        content = content.as_bytes()
+    elif isinstance(content, str):
+        content = content.encode()
+    return [filename, _encode(content), mimetype]
+
+
+def _mime_part(raw):
+    parsed = message_from_bytes(raw)
+    part = MIMEBase(*parsed.get_content_type().split('/', 1))
+    for header in list(part.keys()):
+        del part[header]
+    for header, value in parsed.items():
+        part[header] = value
+    part.set_payload(parsed.get_payload())
+    return part
+
+
+def _to_row(message):
+    attachments = [_attachment_row(attachment) for attachment in message.attachments]
+    return OutgoingEmail(
+        subject=message.subject, body=message.body, from_email=message.from_email or settings.DEFAULT_FROM_EMAIL,
+        to=list(message.to), cc=list(message.cc), bcc=list(message.bcc), reply_to=list(message.reply_to),
+        headers=dict(message.extra_headers), attachments=attachments,
+        alternatives=[list(alternative) for alternative in getattr(message, 'alternatives', [])],
+    )
+
+
+def _to_message(row, connection):
+    message = EmailMultiAlternatives(
+        subject=row.subject, body=row.body, from_email=row.from_email, to=row.to, cc=row.cc, bcc=row.bcc,
+        reply_to=row.reply_to, headers=row.headers, alternatives=[tuple(a) for a in row.alternatives],
+        connection=connection,
+    )
+    for attachment in row.attachments:
+        if isinstance(attachment, dict):
+            message.attach(_mime_part(base64.b64decode(attachment['mime'])))
+        else:
+            filename, content, mimetype = attachment
+            message.attach(filename, base64.b64decode(content), mimetype)
+    return message
+
+
+def _claim(sender_id, batch_size):
+    # Requeue batches whose sender died, then mark a batch as ours
+    OutgoingEmail.objects.filter(
+        status=OutgoingEmail.SENDING, claimed_at__lt=timezone.now() - CLAIM_TIMEOUT,
+    ).update(status=OutgoingEmail.QUEUED, claimed_by='')
+    pks = list(
+        OutgoingEmail.objects.filter(status=OutgoingEmail.QUEUED, next_attempt_at__lte=timezone.now())
+        .order_by('created_at', 'pk').values_list('pk', flat=True)[:batch_size]
+    )
+    # Another sender may take some of the same rows first; we get what our UPDATE still found queued
+    OutgoingEmail.objects.filter(pk__in=pks, status=OutgoingEmail.QUEUED).update(
+        status=OutgoingEmail.SENDING, claimed_by=sender_id, claimed_at=timezone.now(),
+    )
+    return list(OutgoingEmail.objects.filter(status=OutgoingEmail.SENDING, claimed_by=sender_id).order_by('created_at', 'pk'))
+
+
+def _failed(row, error):
+    attempts = row.attempts + 1
+    OutgoingEmail.objects.filter(pk=row.pk).update(
+        status=OutgoingEmail.QUEUED if attempts < MAX_ATTEMPTS else OutgoingEmail.FAILED,
+        attempts=attempts, last_error=repr(error)[:2000], claimed_by='',
+        # Back off, so a short outage doesn't use up every attempt at once
+        next_attempt_at=timezone.now() + timedelta(seconds=RETRY_BACKOFF * 2 ** row.attempts),
+    )
+
+
+def _release(sender_id, error):
+    # Hand what we claimed but didn't get to back to the queue, without counting an attempt
+    return OutgoingEmail.objects.filter(status=OutgoingEmail.SENDING, claimed_by=sender_id).update(
+        status=OutgoingEmail.QUEUED, claimed_by='', last_error=repr(error)[:2000],
+        next_attempt_at=timezone.now() + timedelta(seconds=RETRY_BACKOFF),
+    )
+
+
+def drain_outbox(batch_size=BATCH_SIZE, rate=RATE, backend=None):
+    """
+    Send due mail over one connection, batch by batch, until none is left;
+    returns (sent, failed). If the connection can't be opened, the batch
+    is released and the error raised.
+    """
+    sender_id = uuid.uuid4().hex
+    batch = _claim(sender_id, batch_size)
+    if not batch:
+        # Don't connect just to find nothing to send
+        return 0, 0
+    connection = get_connection(backend or DELIVERY_BACKEND, fail_silently=False)
+    interval = 1 / rate if rate else 0
+    sent = failed = 0
+    next_send = time.monotonic()
+    try:
+        connection.open()
+        while batch:
+            for row in batch:
+                time.sleep(max(0, next_send - time.monotonic()))
+                next_send = time.monotonic() + interval
+                try:
+                    try:
+                        _to_message(row, connection).send()
+                    except smtplib.SMTPServerDisconnected:
+                        # The server dropped an idle connection; reconnect once and retry
+                        connection.close()
+                        connection.open()
+                        _to_message(row, connection).send()
+                except Exception as e:
+                    logger.exception("Could not send email %s", row.pk)
+                    _failed(row, e)
+                    failed += 1
+                    continue
+                OutgoingEmail.objects.filter(pk=row.pk).update(
+                    status=OutgoingEmail.SENT, sent_at=timezone.now(), attempts=F('attempts') + 1, claimed_by='',
+                )
+                sent += 1
+            batch = _claim(sender_id, batch_size)
+    except Exception as e:
+        # e.g. the server is down; don't leave the batch stuck as sending until CLAIM_TIMEOUT
+        _release(sender_id, e)
+        raise
+    finally:
+        connection.close()
+    if sent or failed:
+        logger.info("Outbox: sent %d, failed %d", sent, failed)
+    return sent, failed
+
+
+@task(priority=5, max_attempts=1)
+def send_outbox():
+    """
+    Drain the outbox; queued by OutboxEmailBackend whenever mail is stored,
+    and by itself for when mail waiting to be retried is due.
+    """
+    try:
+        drain_outbox()
+    finally:
+        next_due = (
+            OutgoingEmail.objects.filter(status=OutgoingEmail.QUEUED)
+            .order_by('next_attempt_at').values_list('next_attempt_at', flat=True).first()
+        )
+        if next_due is not None:
+            send_outbox.schedule_unless_queued(max(next_due, timezone.now()))
+
+
+def notification_recipients(users):
+    """Email addresses of those users who have email notifications turned on."""
+    from django.contrib.auth.models import User
+
+    return list(
+        User.objects.filter(pk__in=[user.pk for user in users], profile__email_notifications=True)
+        .exclude(email='').values_list('email', flat=True)
+    )
+
+
+def send_notification(users, subject, body, html_body=None):
+    """Queue one notification per consenting user (so they don't see each other's address); returns how many."""
+    messages = []
+    for email in notification_recipients(users):
+        message = EmailMultiAlternatives(subject, body, settings.DEFAULT_FROM_EMAIL, [email])
+        if html_body:
+            message.attach_alternative(html_body, 'text/html')
+        messages.append(message)
+    return get_connection().send_messages(messages) if messages else 0
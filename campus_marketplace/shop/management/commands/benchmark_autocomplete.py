@@ -0,0 +1,62 @@
+import random
+import statistics
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+from shop.autocomplete import PrefixIndex, normalize
+from shop.models import Category, Product
+
+
+class Command(BaseCommand):
+    help = "Report memory use and lookup latency of the autocomplete prefix index"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--synthetic', type=int, default=0,
+                            help="Index this many generated product names instead of the database")
+        parser.add_argument('--lookups', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        items = self.load_items(options['synthetic'])
+        names = [label for _, _, label, _ in items] or ['a']
+
+        tracemalloc.start()
+        started = time.perf_counter()
+        index = PrefixIndex()
+        index.load(items)
+        build_seconds = time.perf_counter() - started
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        # Prefixes of 1-6 characters taken from real names, like a user typing
+        rng = random.Random(0)
+        prefixes = []
+        for _ in range(options['lookups']):
+            word = rng.choice(normalize(rng.choice(names)).split(' ') or ['a'])
+            prefixes.append(word[:rng.randint(1, 6)])
+
+        timings = []
+        for prefix in prefixes:
+            started = time.perf_counter()
+            index.lookup(prefix)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+
+        self.stdout.write(f"Indexed entries:  {len(index)}")
+        self.stdout.write(f"Build time:       {build_seconds * 1000:.1f} ms")
+        self.stdout.write(f"Index memory:     {memory / 1024 / 1024:.2f} MiB")
+        self.stdout.write(f"Lookups:          {len(timings)}")
+        self.stdout.write(f"Latency p50:      {statistics.median(timings):.3f} ms")
+        self.stdout.write(f"Latency p99:      {timings[int(len(timings) * 0.99) - 1]:.3f} ms")
+        self.stdout.write(f"Latency max:      {timings[-1]:.3f} ms")
+
+    def load_items(self, synthetic):
+        if synthetic:
+            rng = random.Random(0)
+            words = ['red', 'blue', 'used', 'calculator', 'uniform', 'shoes', 'notebook', 'lab', 'gown',
+                     'drafting', 'table', 'laptop', 'charger', 'book', 'physics', 'engineering', 'set', 'pen']
+            return [('product', i, ' '.join(rng.sample(words, rng.randint(2, 5))), None) for i in range(synthetic)]
+        items = [('category', pk, name, slug) for pk, name, slug in Category.objects.values_list('pk', 'name', 'slug')]
+        items += [('product', pk, name, None) for pk, name in Product.objects.values_list('pk', 'name').iterator()]
+        return items
@@ -0,0 +1,56 @@
+import statistics
+import time
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from shop.cart import Cart
+from shop.models import CartItem, Category, Product
+from shop.orders import place_order
+
+
+class Command(BaseCommand):
+    help = "Measure checkouts per second at different cart sizes (all writes are rolled back)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1, 5, 20, 50])
+        parser.add_argument('--checkouts', type=int, default=50, help="Checkouts timed per cart size")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.run(options['sizes'], options['checkouts'])
+            transaction.set_rollback(True)
+
+    def run(self, sizes, checkouts):
+        category = Category.objects.create(name='Benchmark', slug='benchmark-checkout')
+        sellers = [User.objects.create_user(username=f'benchmark-seller-{i}') for i in range(5)]
+        buyer = User.objects.create_user(username='benchmark-buyer')
+        products = Product.objects.bulk_create([
+            Product(name=f'Benchmark product {i}', price=Decimal('19.99') + i, stock=10 ** 6,
+                    category=category, seller=sellers[i % len(sellers)])
+            for i in range(max(sizes))
+        ])
+
+        self.stdout.write(f"{'lines':>6} {'checkouts/s':>12} {'p50 ms':>8} {'p99 ms':>8} {'queries':>8}")
+        for size in sizes:
+            timings, queries = [], 0
+            for _ in range(checkouts):
+                CartItem.objects.bulk_create([
+                    CartItem(user=buyer, product=product, quantity=2) for product in products[:size]
+                ])
+                cart = Cart(buyer)
+                list(cart)
+                with CaptureQueriesContext(connection) as captured:
+                    started = time.perf_counter()
+                    place_order(cart, Decimal('50.00'))
+                    timings.append(time.perf_counter() - started)
+                queries = len(captured.captured_queries)
+            timings.sort()
+            self.stdout.write(
+                f"{size:>6} {len(timings) / sum(timings):>12.1f} "
+                f"{statistics.median(timings) * 1000:>8.2f} {timings[int(len(timings) * 0.99) - 1] * 1000:>8.2f} "
+                f"{queries:>8}"
+            )
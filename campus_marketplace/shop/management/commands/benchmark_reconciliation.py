@@ -0,0 +1,133 @@
+import json
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from shop import reconcile
+from shop.models import Category, Order, OrderItem, Product, StockReservation
+from shop.webhooks import process_pending
+
+
+def invoice_status(n):
+    # Of every 10 orders: 3 paid, 3 expired, 1 unknown to Xendit, 3 still open
+    return ('PAID', 'PAID', 'SETTLED', 'EXPIRED', 'EXPIRED', 'EXPIRED', None, 'PENDING', 'PENDING', 'PENDING')[n % 10]
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class StubXendit(BaseHTTPRequestHandler):
+    """Answers invoice lookups after `latency` seconds, like the real API."""
+    protocol_version = 'HTTP/1.1'
+    latency = 0.05
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urlsplit(self.path)
+        if url.path.startswith('/v2/invoices/'):
+            invoice_id = url.path.rsplit('/', 1)[1]
+        else:
+            invoice_id = parse_qs(url.query).get('external_id', [''])[0].replace('BENCH-', 'inv-')
+        status = invoice_status(int(invoice_id.rsplit('-', 1)[1]))
+        by_id = url.path.startswith('/v2/invoices/')
+        if status is None:
+            # Looking up an unknown id is a 404; searching by external_id finds nothing
+            body, code = ({'error_code': 'INVOICE_NOT_FOUND_ERROR'}, 404) if by_id else ([], 200)
+        else:
+            body, code = {'id': invoice_id, 'external_id': invoice_id.replace('inv-', 'BENCH-'), 'status': status}, 200
+            if not by_id:
+                body = [body]
+        body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Reconcile a batch of synthetic stale pending orders against a local stub of the "
+        "Xendit API at several concurrency levels (all writes are rolled back)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8])
+        parser.add_argument('--batch-size', type=int, default=reconcile.BATCH_SIZE)
+        parser.add_argument('--latency', type=int, default=50, help="Stub response time in ms")
+
+    def handle(self, *args, **options):
+        StubXendit.latency = options['latency'] / 1000
+        server = StubServer(('127.0.0.1', 0), StubXendit)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = reconcile.BASE_URL
+        reconcile.BASE_URL = f'http://127.0.0.1:{server.server_port}'
+        try:
+            with transaction.atomic():
+                self.create_orders(options['orders'])
+                self.stdout.write(f"{'concurrency':>11} {'orders/s':>9} {'paid':>6} {'expired':>7} "
+                                  f"{'missing':>7} {'open':>6} {'errors':>6}")
+                for concurrency in options['concurrency']:
+                    # Each run starts from the same stale orders
+                    savepoint = transaction.savepoint()
+                    counts = reconcile.reconcile_pending_orders(
+                        older_than=timedelta(0), batch_size=options['batch_size'], concurrency=concurrency,
+                    )
+                    self.stdout.write(
+                        f"{concurrency:>11} {counts['checked'] / counts['seconds']:>9.1f} {counts['paid']:>6} "
+                        f"{counts['expired']:>7} {counts['missing']:>7} {counts['open']:>6} {counts['errors']:>6}"
+                    )
+                    while process_pending():
+                        pass
+                    statuses = dict(
+                        Order.objects.filter(external_id__startswith='BENCH-').order_by().values_list('status')
+                        .annotate(n=Count('pk'))
+                    )
+                    transaction.savepoint_rollback(savepoint)
+                self.stdout.write(f"Orders afterwards: {statuses}")
+                transaction.set_rollback(True)
+        finally:
+            reconcile.BASE_URL = base_url
+            server.shutdown()
+            server.server_close()
+
+    def create_orders(self, orders):
+        # Only the synthetic orders are pending for the run (rolled back with the rest)
+        Order.objects.filter(status='pending').update(status='cancelled')
+        category = Category.objects.create(name='Benchmark', slug='benchmark-reconciliation')
+        seller = User.objects.create_user(username='benchmark-reconcile-seller')
+        buyer = User.objects.create_user(username='benchmark-reconcile-buyer')
+        product = Product.objects.create(name='Benchmark product', price=Decimal('99.00'), stock=10 ** 6,
+                                         category=category, seller=seller)
+        # Every fourth order never got its invoice id stored, and is looked up by external_id
+        pending = Order.objects.bulk_create([
+            Order(user=buyer, total=Decimal('99.00'), status='pending', external_id=f'BENCH-{i}',
+                  invoice_id=f'inv-{i}' if i % 4 else None)
+            for i in range(orders)
+        ])
+        # Placed well before the invoice window closed
+        Order.objects.filter(pk__in=[order.pk for order in pending]).update(
+            placed_at=timezone.now() - timedelta(hours=2),
+        )
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, quantity=1, price_each=product.price) for order in pending
+        ])
+        expires_at = timezone.now() + timedelta(hours=1)
+        StockReservation.objects.bulk_create([
+            StockReservation(order=order, product=product, quantity=1, expires_at=expires_at) for order in pending
+        ])
@@ -0,0 +1,118 @@
+import asyncio
+import json
+import statistics
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.test import AsyncClient, Client, override_settings
+from django.urls import reverse
+
+from campus_marketplace.services import lalamove_service
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class StubLalamove(BaseHTTPRequestHandler):
+    """Answers every quotation after `latency` seconds, like a slow upstream."""
+    protocol_version = 'HTTP/1.1'
+    latency = 0.2
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.latency)
+        body = json.dumps({'data': {
+            'quotationId': uuid.uuid4().hex,
+            'priceBreakdown': {'total': '120', 'currency': 'PHP'},
+        }}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare shipping-quote throughput of the WSGI and ASGI handlers against a local "
+        "stub of the Lalamove API (requests run in-process; nothing is sent to Lalamove)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--concurrency', type=int, default=50, help="Requests in flight at once")
+        parser.add_argument('--workers', type=int, default=4, help="WSGI worker threads, like gunicorn --threads")
+        parser.add_argument('--latency', type=int, default=200, help="Stub response time in ms")
+        parser.add_argument('--same-address', action='store_true',
+                            help="Quote one address throughout, to see the cache; by default every request misses")
+
+    def handle(self, *args, **options):
+        StubLalamove.latency = options['latency'] / 1000
+        server = StubServer(('127.0.0.1', 0), StubLalamove)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = lalamove_service.BASE_URL
+        lalamove_service.BASE_URL = f'http://127.0.0.1:{server.server_port}'
+        try:
+            # The test clients send Host: testserver
+            with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+                self.url = reverse('get_shipping_quote')
+                self.same_address = options['same_address']
+                n = options['requests']
+                self.stdout.write(f"{'server':>6} {'quotes/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+                self.report('WSGI', *self.run_wsgi(n, options['workers']))
+                # As asgi.py sets it: one loop for every request, with its own httpx pool
+                with override_settings(SHOP_ASYNC_HTTP=True):
+                    self.report('ASGI', *asyncio.run(self.run_asgi(n, options['concurrency'])))
+        finally:
+            lalamove_service.BASE_URL = base_url
+            server.shutdown()
+            server.server_close()
+
+    def body(self):
+        address = '12 Rizal Street, Manila' if self.same_address else f'{uuid.uuid4().hex[:8]} Rizal Street, Manila'
+        return json.dumps({'delivery_address': address})
+
+    def run_wsgi(self, n, workers):
+        client = Client()
+
+        def one(_):
+            started = time.perf_counter()
+            response = client.post(self.url, self.body(), content_type='application/json')
+            return time.perf_counter() - started, response.status_code
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(one, range(n)))
+        return time.perf_counter() - started, results
+
+    async def run_asgi(self, n, concurrency):
+        client = AsyncClient()
+        slots = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with slots:
+                started = time.perf_counter()
+                response = await client.post(self.url, self.body(), content_type='application/json')
+                return time.perf_counter() - started, response.status_code
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(one() for _ in range(n)))
+        return time.perf_counter() - started, results
+
+    def report(self, name, elapsed, results):
+        timings = sorted(seconds for seconds, _ in results)
+        errors = sum(1 for _, status in results if status != 200)
+        self.stdout.write(
+            f"{name:>6} {len(results) / elapsed:>9.1f} {statistics.median(timings) * 1000:>8.0f} "
+            f"{timings[int(len(timings) * 0.99) - 1] * 1000:>8.0f} {errors:>7}"
+        )
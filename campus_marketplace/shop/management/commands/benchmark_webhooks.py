@@ -0,0 +1,93 @@
+import json
+import random
+import statistics
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import Client, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from shop.models import Category, Order, OrderItem, Product, StockReservation, WebhookEvent
+from shop.webhooks import process_pending
+
+
+class Command(BaseCommand):
+    help = (
+        "Post a burst of synthetic Xendit webhooks (with redeliveries) and time the "
+        "acknowledgements and the worker that applies them (all writes are rolled back)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=500)
+        parser.add_argument('--deliveries', type=int, default=3, help="Times each event is delivered")
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        with transaction.atomic(), override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+            self.run(options['orders'], options['deliveries'], options['batch_size'])
+            transaction.set_rollback(True)
+
+    def run(self, orders, deliveries, batch_size):
+        category = Category.objects.create(name='Benchmark', slug='benchmark-webhooks')
+        seller = User.objects.create_user(username='benchmark-webhook-seller')
+        buyer = User.objects.create_user(username='benchmark-webhook-buyer')
+        product = Product.objects.create(name='Benchmark product', price=Decimal('99.00'), stock=10 ** 6,
+                                         category=category, seller=seller)
+        pending = Order.objects.bulk_create([
+            Order(user=buyer, total=Decimal('99.00'), status='pending', external_id=f'BENCH-{i}')
+            for i in range(orders)
+        ])
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, quantity=1, price_each=product.price) for order in pending
+        ])
+        expires_at = timezone.now() + timedelta(hours=1)
+        StockReservation.objects.bulk_create([
+            StockReservation(order=order, product=product, quantity=1, expires_at=expires_at) for order in pending
+        ])
+
+        # Xendit redelivers when it isn't sure we got an event; shuffle so copies arrive interleaved
+        bodies = [
+            json.dumps({'id': f'inv-{order.pk}', 'external_id': order.external_id, 'status': 'PAID',
+                        'amount': 99})
+            for order in pending for _ in range(deliveries)
+        ]
+        random.Random(0).shuffle(bodies)
+
+        client = Client()
+        url = reverse('webhook_listener')
+        token = settings.XENDIT_WEBHOOK_VERIFICATION_TOKEN
+        headers = {'HTTP_X_CALLBACK_TOKEN': token} if token is not None else {}
+        timings = []
+        started = time.perf_counter()
+        for body in bodies:
+            sent = time.perf_counter()
+            response = client.post(url, body, content_type='application/json', **headers)
+            timings.append(time.perf_counter() - sent)
+            if response.status_code != 200:
+                self.stderr.write(f"Webhook answered {response.status_code}: {response.content[:200]!r}")
+                return
+        ingest_seconds = time.perf_counter() - started
+        stored = WebhookEvent.objects.filter(external_id__startswith='BENCH-').count()
+
+        started = time.perf_counter()
+        applied = 0
+        while batch := process_pending(batch_size=batch_size):
+            applied += batch
+        apply_seconds = time.perf_counter() - started
+        confirmed = Order.objects.filter(external_id__startswith='BENCH-', status='confirmed').count()
+
+        timings.sort()
+        self.stdout.write(
+            f"Acknowledged {len(bodies)} deliveries at {len(bodies) / ingest_seconds:.0f}/s "
+            f"(p50 {statistics.median(timings) * 1000:.2f} ms, p99 {timings[int(len(timings) * 0.99) - 1] * 1000:.2f} ms); "
+            f"stored {stored} events, dropped {len(bodies) - stored} redeliveries"
+        )
+        self.stdout.write(
+            f"Applied {applied} events at {applied / apply_seconds:.0f}/s; {confirmed}/{orders} orders confirmed"
+        )
@@ -0,0 +1,72 @@
+import time
+
+import numpy as np
+from scipy import sparse
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from shop.caching import bump_version
+from shop.models import OrderItem, ProductRecommendation
+
+
+class Command(BaseCommand):
+    help = "Rebuild the \"customers also bought\" table from OrderItem history"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-k', type=int, default=8, help="Neighbours kept per product")
+        parser.add_argument('--min-support', type=int, default=2,
+                            help="Minimum number of customers who bought both products")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        top_k, min_support = options['top_k'], options['min_support']
+
+        # One (customer, product) pair per purchased line; cancelled/refunded orders don't count
+        pairs = np.array(
+            OrderItem.objects.exclude(order__status__in=['cancelled', 'refunded'])
+            .values_list('order__user_id', 'product_id'),
+            dtype=np.int64,
+        ).reshape(-1, 2)
+        rows = self.compute(pairs, top_k, min_support)
+
+        with transaction.atomic():
+            ProductRecommendation.objects.all().delete()
+            ProductRecommendation.objects.bulk_create(rows, batch_size=1000)
+        bump_version('recommendations', 'all')
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Stored {len(rows)} recommendations from {len(pairs)} purchases "
+            f"in {time.perf_counter() - started:.2f}s."
+        ))
+
+    def compute(self, pairs, top_k, min_support):
+        if not len(pairs):
+            return []
+        user_ids, user_index = np.unique(pairs[:, 0], return_inverse=True)
+        product_ids, product_index = np.unique(pairs[:, 1], return_inverse=True)
+
+        # customers x products purchase matrix, 1 if the customer ever bought the product
+        purchases = sparse.csr_matrix(
+            (np.ones(len(pairs), dtype=np.float32), (user_index, product_index)),
+            shape=(len(user_ids), len(product_ids)),
+        )
+        purchases.data[:] = 1
+        buyers = np.asarray(purchases.sum(axis=0)).ravel()
+
+        # products x products co-purchase counts
+        co = (purchases.T @ purchases).tocoo()
+        keep = (co.row != co.col) & (co.data >= min_support)
+        row, col, support = co.row[keep], co.col[keep], co.data[keep]
+        # Cosine similarity, so best-sellers don't dominate every list
+        score = support / np.sqrt(buyers[row] * buyers[col])
+
+        # Sort by product then best score, and keep the first top_k of each product
+        order = np.lexsort((-score, row))
+        row, col, score = row[order], col[order], score[order]
+        rank = np.arange(len(row)) - np.searchsorted(row, row, side='left')
+        keep = rank < top_k
+
+        return [
+            ProductRecommendation(product_id=int(p), recommended_id=int(r), rank=int(k), score=float(s))
+            for p, r, k, s in zip(product_ids[row[keep]], product_ids[col[keep]], rank[keep], score[keep])
+        ]
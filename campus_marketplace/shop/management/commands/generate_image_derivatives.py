@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from shop.images import generate_derivatives
+from shop.models import Product, Profile
+
+
+class Command(BaseCommand):
+    help = "Generate thumbnail/medium/large WebP and JPEG derivatives for existing product images and avatars"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help="Regenerate derivatives that already exist")
+
+    def handle(self, *args, **options):
+        names = set(Product.objects.exclude(image='').exclude(image__isnull=True).values_list('image', flat=True))
+        names |= set(Profile.objects.exclude(avatar='').exclude(avatar__isnull=True).values_list('avatar', flat=True))
+
+        written = failed = 0
+        for name in sorted(names):
+            try:
+                written += generate_derivatives(name, force=options['force'])
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f"{name}: {e}")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Processed {len(names) - failed} images, wrote {written} derivatives, {failed} failed."
+        ))
@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop.webhooks import process_pending
+
+
+class Command(BaseCommand):
+    help = "Apply stored payment webhooks to their orders (once, or continuously with --follow)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--follow', action='store_true', help="Keep polling for new events")
+        parser.add_argument('--interval', type=float, default=1.0, help="Seconds between polls when idle")
+
+    def handle(self, *args, **options):
+        while True:
+            applied = process_pending(batch_size=options['batch_size'])
+            if applied:
+                self.stdout.write(f"Applied {applied} webhook events.")
+            if not options['follow']:
+                return
+            if applied < options['batch_size']:
+                time.sleep(options['interval'])
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from shop.models import Category
+
+
+class Command(BaseCommand):
+    help = "Recount Category.length from the Product table"
+
+    def add_arguments(self, parser):
+        parser.add_argument('slugs', nargs='*', help="Only rebuild these categories (default: all)")
+
+    def handle(self, *args, **options):
+        category_ids = None
+        if options['slugs']:
+            category_ids = Category.objects.filter(slug__in=options['slugs']).values_list('pk', flat=True)
+        updated = Category.refresh_lengths(category_ids)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt product counts for {updated} categories."))
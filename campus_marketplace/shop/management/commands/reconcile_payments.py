@@ -0,0 +1,39 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from shop.reconcile import BATCH_SIZE, CONCURRENCY, STALE_AFTER, reconcile_pending_orders
+
+
+class Command(BaseCommand):
+    help = "Check stale pending Xendit orders against Xendit and settle the ones whose webhook was lost (run from cron)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=float, default=STALE_AFTER.total_seconds() / 60, metavar='MINUTES',
+                            help="Only orders pending at least this long")
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help="Xendit requests in flight at once")
+        parser.add_argument('--dry-run', action='store_true', help="Only report what is out of step")
+
+    def handle(self, *args, **options):
+        counts = reconcile_pending_orders(
+            older_than=timedelta(minutes=options['older_than']), batch_size=options['batch_size'],
+            concurrency=options['concurrency'], dry_run=options['dry_run'],
+        )
+        self.report(counts)
+        if options['dry_run']:
+            self.stdout.write("Dry run: nothing was changed.")
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f"{counts['paid']} paid orders queued to be confirmed, {counts['cancelled']} cancelled."
+            ))
+
+    def report(self, counts):
+        rate = counts['checked'] / counts['seconds'] if counts['seconds'] else 0
+        self.stdout.write(
+            f"Checked {counts['checked']} pending orders in {counts['seconds']:.1f}s ({rate:.0f}/s): "
+            f"{counts['paid']} paid, {counts['expired']} expired, {counts['missing']} without an invoice, "
+            f"{counts['open']} still open, {counts['errors']} errors"
+        )
+        drift = counts['paid'] + counts['expired'] + counts['missing']
+        self.stdout.write(f"{drift} out of step with Xendit.")
@@ -0,0 +1,47 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from shop.models import WebhookEvent
+from shop.webhooks import apply_webhook_events, process_pending
+
+
+class Command(BaseCommand):
+    help = (
+        "Queue stored payment webhooks to be applied again. Applying is idempotent, "
+        "so replaying an event that already took effect changes nothing."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('ids', nargs='*', type=int, help="WebhookEvent ids")
+        parser.add_argument('--order', help="Every event for this order's external_id")
+        parser.add_argument('--failed', action='store_true', help="Events that gave up after repeated errors")
+        parser.add_argument('--since', type=int, metavar='HOURS', help="Events received in the last HOURS hours")
+        parser.add_argument('--now', action='store_true', help="Apply them here instead of leaving them to the worker")
+
+    def handle(self, *args, **options):
+        if not any(options[name] for name in ('ids', 'order', 'failed', 'since')):
+            raise CommandError("Say which events to replay: ids, --order, --failed or --since.")
+        events = WebhookEvent.objects.all()
+        if options['ids']:
+            events = events.filter(pk__in=options['ids'])
+        if options['order']:
+            events = events.filter(external_id=options['order'])
+        if options['failed']:
+            events = events.filter(processed_at__isnull=True).exclude(last_error='')
+        if options['since']:
+            events = events.filter(received_at__gte=timezone.now() - timedelta(hours=options['since']))
+
+        queued = events.update(processed_at=None, attempts=0, next_attempt_at=timezone.now(), last_error='')
+        self.stdout.write(f"Queued {queued} webhook events.")
+        if options['now']:
+            applied = 0
+            while True:
+                batch = process_pending()
+                applied += batch
+                if not batch:
+                    break
+            self.stdout.write(self.style.SUCCESS(f"Applied {applied} webhook events."))
+        elif queued:
+            apply_webhook_events.enqueue()
@@ -0,0 +1,50 @@
+import os
+import signal
+import socket
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop.taskqueue import purge_finished, work
+
+PURGE_INTERVAL = 60 * 60
+
+
+class Command(BaseCommand):
+    help = "Run queued background tasks (see shop/taskqueue.py) until stopped with Ctrl-C or SIGTERM"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=1, help="Tasks run in parallel, one thread each")
+        parser.add_argument('--idle', type=float, default=1.0, help="Seconds between polls when nothing is due")
+        parser.add_argument('--burst', action='store_true', help="Exit once nothing is due, e.g. from cron")
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        if not options['burst']:
+            # Finish the tasks in hand, then exit
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(sig, lambda *_: stop.set())
+
+        prefix = f'{socket.gethostname()}:{os.getpid()}'
+        threads = [
+            threading.Thread(
+                target=work, name=f'worker-{i}',
+                args=(f'{prefix}:{i}', stop), kwargs={'idle': options['idle'], 'burst': options['burst']},
+            )
+            for i in range(options['concurrency'])
+        ]
+        for thread in threads:
+            thread.start()
+        self.stdout.write(f"Worker {prefix} running {len(threads)} task thread(s).")
+
+        next_purge = time.monotonic()
+        while any(thread.is_alive() for thread in threads):
+            if not options['burst'] and time.monotonic() >= next_purge:
+                purged = purge_finished()
+                if purged:
+                    self.stdout.write(f"Purged {purged} finished tasks.")
+                next_purge = time.monotonic() + PURGE_INTERVAL
+            for thread in threads:
+                thread.join(timeout=1)
+        self.stdout.write("Worker stopped.")
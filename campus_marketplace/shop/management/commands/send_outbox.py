@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from shop.mail import BATCH_SIZE, RATE, drain_outbox
+
+
+class Command(BaseCommand):
+    help = "Send the queued mail in the outbox now (normally the task worker does this)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backend', help="Deliver with this email backend instead, e.g. "
+                                              "django.core.mail.backends.console.EmailBackend")
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument('--rate', type=float, default=RATE, help="Messages per second at most (0: no limit)")
+
+    def handle(self, *args, **options):
+        sent, failed = drain_outbox(batch_size=options['batch_size'], rate=options['rate'], backend=options['backend'])
+        self.stdout.write(self.style.SUCCESS(f"Sent {sent} emails, {failed} failed."))
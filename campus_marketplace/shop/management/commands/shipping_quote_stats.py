@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from shop.shipping import quote_cache_stats, reset_quote_cache_stats
+
+
+class Command(BaseCommand):
+    help = "Show how often shipping quotes were served from cache and the Lalamove time that saved"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help="Zero the counters after printing them")
+
+    def handle(self, *args, **options):
+        stats = quote_cache_stats()
+        self.stdout.write(
+            f"hits {stats['hits']}  misses {stats['misses']}  hit rate {stats['hit_rate']:.1%}\n"
+            f"avg Lalamove call {stats['avg_upstream_ms']:.0f} ms  saved {stats['saved_ms'] / 1000:.1f} s"
+        )
+        if options['reset']:
+            reset_quote_cache_stats()
@@ -0,0 +1,27 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from shop.taskqueue import task_metrics
+
+
+class Command(BaseCommand):
+    help = "Per-task counts, retries and wait/run latency for recently finished background tasks"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=float, default=24)
+
+    def handle(self, *args, **options):
+        metrics, backlog = task_metrics(timezone.now() - timedelta(hours=options['hours']))
+        self.stdout.write(
+            f"{'task':<50} {'done':>6} {'failed':>6} {'retried':>7} "
+            f"{'wait p50':>9} {'wait p95':>9} {'run p50':>8} {'run p95':>8}"
+        )
+        for name, row in metrics.items():
+            self.stdout.write(
+                f"{name:<50} {row['done']:>6} {row['failed']:>6} {row['retried']:>7} "
+                f"{row['wait_p50_ms']:>7.0f}ms {row['wait_p95_ms']:>7.0f}ms "
+                f"{row['run_p50_ms']:>6.0f}ms {row['run_p95_ms']:>6.0f}ms"
+            )
+        self.stdout.write(f"Due now: {backlog['due']} (oldest waiting {backlog['oldest_due_s']:.0f}s)")
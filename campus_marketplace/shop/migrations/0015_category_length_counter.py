@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:55
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def rebuild_lengths(apps, schema_editor):
+    Category = apps.get_model('shop', 'Category')
+    Product = apps.get_model('shop', 'Product')
+    counts = Product.objects.filter(category=OuterRef('pk')).order_by().values('category').annotate(n=Count('pk')).values('n')
+    Category.objects.update(length=Coalesce(Subquery(counts), Value(0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0014_order_external_id'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='category',
+            name='plural',
+        ),
+        migrations.AlterField(
+            model_name='category',
+            name='length',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(rebuild_lengths, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0021_order_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShippingEstimate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('zone', models.CharField(blank=True, max_length=100)),
+                ('service_type', models.CharField(max_length=30)),
+                ('fee', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('currency', models.CharField(default='PHP', max_length=3)),
+                ('distance_m', models.PositiveIntegerField(blank=True, help_text='Average route length in metres', null=True)),
+                ('samples', models.PositiveIntegerField(default=1)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('zone', 'service_type'), name='unique_shipping_estimate')],
+            },
+        ),
+    ]
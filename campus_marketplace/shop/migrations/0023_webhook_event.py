@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0022_shipping_estimate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('provider', models.CharField(default='xendit', max_length=20)),
+                ('event_id', models.CharField(help_text="The provider's id for the object the event is about, e.g. the invoice id", max_length=100)),
+                ('status', models.CharField(max_length=30)),
+                ('external_id', models.CharField(blank=True, db_index=True, max_length=150)),
+                ('payload', models.JSONField()),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('processed_at__isnull', True)), fields=['received_at'], name='webhook_event_pending_idx')],
+                'constraints': [models.UniqueConstraint(fields=('provider', 'event_id', 'status'), name='unique_webhook_event')],
+            },
+        ),
+    ]
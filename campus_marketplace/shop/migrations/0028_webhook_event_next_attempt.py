@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:48
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0027_cache_table'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhookevent',
+            name='next_attempt_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, help_text='A failed event is not retried before this time'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0029_outgoing_email_next_attempt'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageDerivative',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('original', models.CharField(max_length=255, unique=True)),
+                ('names', models.JSONField(help_text="{'thumb.webp': stored name, ...}")),
+                ('generated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
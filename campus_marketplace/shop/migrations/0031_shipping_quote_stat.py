@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0030_image_derivative'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShippingQuoteStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=30, unique=True)),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -1,16 +1,20 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models import Count, ExpressionWrapper, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Now
+from django.db.models.signals import post_save, post_delete, post_init
 from django.dispatch import receiver
 from django.core.validators import MinValueValidator, MaxValueValidator
+from django.utils import timezone
 
 
 class Category(models.Model):
     name = models.CharField(max_length=100)
     slug = models.SlugField(unique=True)
     icon = models.CharField(max_length=50, default='📦')
-    length = models.PositiveIntegerField(default=0)
-    plural = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+    # Denormalized product count, kept in sync by the Product hooks below
+    length = models.PositiveIntegerField(default=0, editable=False)
 
     class Meta:
         verbose_name_plural = 'Categories'
@@ -18,6 +22,83 @@ class Category(models.Model):
     def __str__(self):
         return self.name
 
+    @property
+    def plural(self):
+        return self.length > 1
+
+    @classmethod
+    def refresh_lengths(cls, category_ids=None):
+        """Recount products for the given categories (all if None) in one UPDATE."""
+        counts = Product.objects.filter(category=OuterRef('pk')).order_by().values('category').annotate(n=Count('pk')).values('n')
+        categories = cls.objects.all()
+        if category_ids is not None:
+            categories = categories.filter(pk__in=set(category_ids))
+        return categories.update(length=Coalesce(Subquery(counts), Value(0)))
+
+
+def held_stock(product=None):
+    """
+    Units held by reservations that haven't expired yet, of the outer
+    product, or of the product the outer row's `product` foreign key
+    points at when given (e.g. 'product' for CartItem).
+    """
+    held = (
+        StockReservation.objects.filter(product=OuterRef(product or 'pk'), expires_at__gt=Now())
+        .order_by().values('product').annotate(n=Sum('quantity')).values('n')
+    )
+    return Coalesce(Subquery(held, output_field=models.IntegerField()), Value(0))
+
+
+def available_stock(product=None):
+    """Stock less active holds; what a buyer can still order. See held_stock for `product`."""
+    stock = F(f'{product}__stock') if product else F('stock')
+    return ExpressionWrapper(stock - held_stock(product), output_field=models.IntegerField())
+
+
+class ProductQuerySet(models.QuerySet):
+    """Bulk operations skip model signals, so they recount the touched categories."""
+
+    def bulk_create(self, objs, *args, **kwargs):
+        with transaction.atomic(using=self.db):
+            objs = super().bulk_create(objs, *args, **kwargs)
+            Category.refresh_lengths(obj.category_id for obj in objs)
+        return objs
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs = list(objs)
+        now = timezone.now()
+        for obj in objs:
+            obj.updated_at = now
+        fields = [*fields, 'updated_at']
+        if 'category' not in fields and 'category_id' not in fields:
+            return super().bulk_update(objs, fields, *args, **kwargs)
+        with transaction.atomic(using=self.db):
+            touched = set(self.filter(pk__in=[obj.pk for obj in objs]).values_list('category_id', flat=True))
+            rows = super().bulk_update(objs, fields, *args, **kwargs)
+            touched.update(obj.category_id for obj in objs)
+            Category.refresh_lengths(touched)
+        for obj in objs:
+            obj._original_category_id = obj.category_id
+        return rows
+
+    def update(self, **kwargs):
+        # auto_now only applies to save(); keep updated_at honest for bulk updates too
+        kwargs.setdefault('updated_at', timezone.now())
+        if 'category' not in kwargs and 'category_id' not in kwargs:
+            return super().update(**kwargs)
+        with transaction.atomic(using=self.db):
+            rows = dict(self.values_list('pk', 'category_id'))
+            touched = set(rows.values())
+            super().update(**kwargs)
+            touched.update(self.model._base_manager.filter(pk__in=rows).values_list('category_id', flat=True).distinct())
+            Category.refresh_lengths(touched)
+        return len(rows)
+
+    def with_available_stock(self):
+        """Annotate available_stock: stock less the units held for open invoices."""
+        return self.annotate(available_stock=available_stock())
+
+
 class Product(models.Model):
     name = models.CharField(max_length=200)
     description = models.TextField(blank=True)
@@ -27,10 +108,78 @@ class Product(models.Model):
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='products')
     seller = models.ForeignKey(User, on_delete=models.CASCADE, related_name='products')
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = ProductQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Category pages and the seller's listings, newest first
+            models.Index(fields=['category', '-created_at'], name='product_category_recent_idx'),
+            models.Index(fields=['seller', '-created_at'], name='product_seller_recent_idx'),
+        ]
 
     def __str__(self):
         return self.name
 
+
+@receiver(post_init, sender=Product)
+def remember_product_category(sender, instance, **kwargs):
+    # Read from __dict__ so a deferred category doesn't cost a query
+    instance._original_category_id = instance.__dict__.get('category_id')
+
+
+@receiver(post_save, sender=Product)
+def update_category_length_on_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    previous = None if created else instance._original_category_id
+    if not created and previous is None:
+        # Loaded without its category, so we can't tell what it used to be
+        Category.refresh_lengths()
+    elif previous != instance.category_id:
+        if previous is not None:
+            Category.objects.filter(pk=previous, length__gt=0).update(length=F('length') - 1)
+        Category.objects.filter(pk=instance.category_id).update(length=F('length') + 1)
+    instance._original_category_id = instance.category_id
+
+
+@receiver(post_delete, sender=Product)
+def update_category_length_on_delete(sender, instance, **kwargs):
+    if instance._original_category_id is None:
+        Category.refresh_lengths()
+    else:
+        Category.objects.filter(pk=instance._original_category_id, length__gt=0).update(length=F('length') - 1)
+
+class ProductRecommendation(models.Model):
+    """Top-K "customers also bought" neighbours, rebuilt by the build_recommendations command."""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='recommendations')
+    recommended = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='recommended_in')
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+
+    class Meta:
+        ordering = ['product', 'rank']
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'rank'], name='unique_recommendation_rank'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} -> {self.recommended_id} (#{self.rank})"
+
+class AutocompleteChange(models.Model):
+    """
+    A product or category whose name was saved or that was deleted, for
+    other processes to patch their search-as-you-type index; see
+    shop/autocomplete.py.
+    """
+    kind = models.CharField(max_length=10)
+    object_id = models.PositiveBigIntegerField()
+    changed_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"{self.kind} {self.object_id} at {self.changed_at:%Y-%m-%d %H:%M:%S}"
+
 class CartItem(models.Model):
     SHIPPING_METHOD_CHOICES = [
         ('S', 'Standard Shipping'), 
@@ -49,6 +198,12 @@ class CartItem(models.Model):
     def __str__(self):
         return f"{self.quantity} × {self.product.name}"
 
+    class Meta:
+        constraints = [
+            # One row per product in a cart; also the index behind the cart lookups
+            models.UniqueConstraint(fields=['user', 'product'], name='unique_cart_item'),
+        ]
+
 class Order(models.Model):
     STATUS_CHOICES = [
         ('pending', 'Pending'),
@@ -65,13 +220,28 @@ class Order(models.Model):
     total = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
     invoice_id = models.CharField(max_length=100, blank=True, null=True)
+    invoice_url = models.URLField(max_length=500, blank=True, null=True)
     payment_method = models.CharField(max_length=20, blank=True, null=True)
+    # Repeated pay requests with the same key reuse this order and its invoice
+    idempotency_key = models.CharField(max_length=64, blank=True, null=True)
 
     def __str__(self):
         return f"Order #{self.id} by {self.user.username}"
 
     class Meta:
         ordering = ['-placed_at']
+        indexes = [
+            models.Index(fields=['user', '-placed_at'], name='order_user_recent_idx'),
+            # Pending orders oldest first, for reconcile_payments
+            models.Index(fields=['placed_at', 'id'], condition=models.Q(status='pending'), name='order_pending_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'idempotency_key'],
+                condition=models.Q(status='pending'),
+                name='unique_pending_order_idempotency_key',
+            ),
+        ]
 
 
 class OrderItem(models.Model):
@@ -86,7 +256,184 @@ class OrderItem(models.Model):
 
     def __str__(self):
         return f"{self.quantity} × {self.product.name}"
-    
+
+    class Meta:
+        indexes = [
+            # Covers the seller's "orders containing my products" subquery
+            models.Index(fields=['product', 'order'], name='orderitem_product_order_idx'),
+        ]
+
+
+class StockReservation(models.Model):
+    """Units held for an order while its invoice is open; they don't count as available stock."""
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='reservations')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='reservations')
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', 'expires_at'], name='reservation_product_active_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} × {self.product_id} for order {self.order_id} until {self.expires_at:%Y-%m-%d %H:%M}"
+
+class ShippingEstimate(models.Model):
+    """
+    Running average of past Lalamove quotes per delivery zone and vehicle,
+    used to price delivery when a live quote can't be had in time. The row
+    with an empty zone averages all zones.
+    """
+    zone = models.CharField(max_length=100, blank=True)
+    service_type = models.CharField(max_length=30)
+    fee = models.DecimalField(max_digits=10, decimal_places=2)
+    currency = models.CharField(max_length=3, default='PHP')
+    distance_m = models.PositiveIntegerField(null=True, blank=True, help_text="Average route length in metres")
+    samples = models.PositiveIntegerField(default=1)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['zone', 'service_type'], name='unique_shipping_estimate'),
+        ]
+
+    def __str__(self):
+        return f"{self.service_type} to {self.zone or 'any zone'}: {self.currency} {self.fee} ({self.samples} quotes)"
+
+class ShippingQuoteStat(models.Model):
+    """A counter behind shop.shipping.quote_cache_stats(): hits, misses or upstream_ms."""
+    name = models.CharField(max_length=30, unique=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name} = {self.value}"
+
+class ImageDerivative(models.Model):
+    """
+    The storage names of an uploaded image's resized copies, one row per
+    original; written by shop.images once they are generated.
+    """
+    original = models.CharField(max_length=255, unique=True)
+    names = models.JSONField(help_text="{'thumb.webp': stored name, ...}")
+    generated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Derivatives of {self.original}"
+
+class WebhookEvent(models.Model):
+    """
+    Inbox of payment webhooks as received. The webhook only stores the
+    event; the process_webhook_events worker applies it to its order. A
+    redelivery of the same event is dropped by the unique constraint.
+    """
+    provider = models.CharField(max_length=20, default='xendit')
+    event_id = models.CharField(max_length=100, help_text="The provider's id for the object the event is about, e.g. the invoice id")
+    status = models.CharField(max_length=30)
+    external_id = models.CharField(max_length=150, blank=True, db_index=True)
+    payload = models.JSONField()
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now, help_text="A failed event is not retried before this time")
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['provider', 'event_id', 'status'], name='unique_webhook_event'),
+        ]
+        indexes = [
+            # The worker's queue: unprocessed events, oldest first
+            models.Index(fields=['received_at'], condition=models.Q(processed_at__isnull=True),
+                         name='webhook_event_pending_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.provider} {self.status} for {self.external_id or self.event_id}"
+
+class Task(models.Model):
+    """A call to a registered background task, run by the run_worker command; see shop/taskqueue.py."""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    name = models.CharField(max_length=200)
+    args = models.JSONField(default=list, blank=True)
+    kwargs = models.JSONField(default=dict, blank=True)
+    priority = models.SmallIntegerField(default=0, help_text="Higher runs first")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    run_at = models.DateTimeField(default=timezone.now, help_text="Not run before this time")
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=3)
+    last_error = models.TextField(blank=True)
+    # Which worker holds it, and until when; a lapsed lease is picked up again
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', '-priority', 'run_at'], name='task_queue_idx'),
+            models.Index(fields=['finished_at'], name='task_finished_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} #{self.pk} ({self.status})"
+
+class OutgoingEmail(models.Model):
+    """
+    A message queued by shop.mail.OutboxEmailBackend, waiting for the
+    sender (shop.mail.drain_outbox) to deliver it.
+    """
+    QUEUED = 'queued'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (SENDING, 'Sending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    ]
+
+    subject = models.CharField(max_length=998)
+    body = models.TextField(blank=True)
+    from_email = models.CharField(max_length=254)
+    to = models.JSONField(default=list)
+    cc = models.JSONField(default=list, blank=True)
+    bcc = models.JSONField(default=list, blank=True)
+    reply_to = models.JSONField(default=list, blank=True)
+    headers = models.JSONField(default=dict, blank=True)
+    # [[content, mimetype]], e.g. the HTML version
+    alternatives = models.JSONField(default=list, blank=True)
+    # [[filename, base64 content, mimetype]]
+    attachments = models.JSONField(default=list, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now, help_text="Queued mail is not sent before this time")
+    last_error = models.TextField(blank=True)
+    claimed_by = models.CharField(max_length=64, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at'], condition=models.Q(status='queued'), name='outgoing_email_queued_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} to {', '.join(self.to)} ({self.status})"
+
 class Profile(models.Model):
     GENDER_CHOICES = [
         ('M', 'Male'),
@@ -168,6 +515,10 @@ class Message(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Inbox listing and unread counts
+            models.Index(fields=['recipient', 'is_read', '-created_at'], name='message_inbox_idx'),
+        ]
 
 class ShippingAddress(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='shipping_addresses')
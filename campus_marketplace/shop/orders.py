@@ -0,0 +1,210 @@
+"""
+Turning a cart into an order.
+
+Direct checkout (place_order) happens in one transaction with a fixed
+number of statements regardless of cart size: one conditional UPDATE that
+decrements stock only where enough is available, the order, one bulk
+insert of its items, one UPDATE of the sellers' sales totals and one
+DELETE of the cart lines. If any product is short, the whole checkout is
+rolled back.
+
+Paying through Xendit splits this in two. reserve_order creates the
+pending order and holds its units for as long as the invoice is open
+(StockReservation rows, which count against available stock); the
+webhook then either confirms the order, turning the holds into sales, or
+releases them. Holds that outlive their invoice are released by
+release_expired_reservations. Each pending order carries an idempotency
+key, so a repeated pay request for the same cart finds the order (and
+invoice) the first one created instead of opening another.
+"""
+import hashlib
+import logging
+from collections import Counter
+from datetime import timedelta
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, Q, Value, When
+from django.utils import timezone
+
+from . import badges
+from .caching import invalidate_product
+from .models import CartItem, Order, OrderItem, Product, Profile, StockReservation, available_stock, held_stock
+
+logger = logging.getLogger(__name__)
+
+# How long a Xendit invoice stays payable; holds last a little longer so a
+# payment made at the last moment still finds its units when the webhook arrives
+INVOICE_DURATION = timedelta(seconds=getattr(settings, 'SHOP_INVOICE_DURATION', 30 * 60))
+RESERVATION_GRACE = timedelta(minutes=5)
+
+
+class InsufficientStock(Exception):
+    """Raised when some cart lines ask for more than is available; `products` lists them."""
+
+    def __init__(self, products):
+        self.products = products
+        super().__init__(', '.join(product.name for product in products))
+
+
+def _add_per_key(field, key, amounts):
+    # F(field) + <amount for this row's key>, as one CASE
+    return F(field) + Case(*(When(**{key: k}, then=Value(v)) for k, v in amounts.items()), default=Value(0))
+
+
+def _quantities(lines):
+    quantities = Counter()
+    for line in lines:
+        quantities[line.product_id] += line.quantity
+    return quantities
+
+
+def _enough_available(quantities):
+    # Stock not held by someone else's open invoice
+    return reduce(or_, (Q(pk=pk, stock__gte=held_stock() + qty) for pk, qty in quantities.items()))
+
+
+def _decrement_stock(quantities, condition):
+    """Decrement every product in one UPDATE where condition holds; returns the rows changed."""
+    return Product.objects.filter(condition).update(
+        stock=Case(*(When(pk=pk, then=F('stock') - qty) for pk, qty in quantities.items()))
+    )
+
+
+def _record_sales(lines):
+    sold_by_seller = Counter()
+    for line in lines:
+        sold_by_seller[line.product.seller_id] += line.quantity
+    Profile.objects.filter(user_id__in=sold_by_seller).update(
+        total_sales=_add_per_key('total_sales', 'user_id', sold_by_seller)
+    )
+    # The UPDATEs bypass the model signals that keep the detail cache fresh
+    for line in lines:
+        invalidate_product(line.product)
+
+
+def _create_order(cart, shipping, **fields):
+    order = Order.objects.create(user=cart.user, total=cart.total_with(shipping), **fields)
+    OrderItem.objects.bulk_create([
+        OrderItem(order=order, product_id=line.product_id, quantity=line.quantity, price_each=line.product.price)
+        for line in cart
+    ])
+    return order
+
+
+def _short_products(quantities):
+    return list(Product.objects.filter(pk__in=quantities).exclude(_enough_available(quantities)))
+
+
+def place_order(cart, shipping):
+    """Create an order from the cart, decrement stock and empty the cart; returns the Order."""
+    lines = list(cart)
+    quantities = _quantities(lines)
+
+    with transaction.atomic():
+        if _decrement_stock(quantities, _enough_available(quantities)) == len(quantities):
+            order = _create_order(cart, shipping, status='pending')
+            _record_sales(lines)
+            CartItem.objects.filter(pk__in=[line.pk for line in lines]).delete()
+            badges.forget(badges.CART, cart.user.pk)
+        else:
+            # Undo the decrements that did apply; the short products are reported below
+            transaction.set_rollback(True)
+            order = None
+
+    if order is None:
+        raise InsufficientStock(_short_products(quantities))
+    cart.refresh()
+    return order
+
+
+def cart_fingerprint(cart, shipping):
+    """Idempotency key for paying for exactly this cart: same lines, prices and total give the same key."""
+    lines = sorted((line.product_id, line.quantity, str(line.product.price)) for line in cart)
+    raw = repr((cart.user.pk, lines, str(cart.total_with(shipping))))
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def pending_order_for(user, idempotency_key):
+    """
+    The still-payable order an earlier request with this key created, or None.
+    One whose invoice window has passed is cancelled and its holds released.
+    """
+    order = Order.objects.filter(user=user, idempotency_key=idempotency_key, status='pending').first()
+    if order is not None and order.placed_at <= timezone.now() - INVOICE_DURATION:
+        release_order(order)
+        order.status = 'cancelled'
+        order.save(update_fields=['status'])
+        return None
+    return order
+
+
+def reserve_order(cart, shipping, external_id, idempotency_key=None):
+    """
+    Create a pending order for the cart and hold its units until the invoice
+    expires. The cart itself is kept until the payment is confirmed. Raises
+    IntegrityError if a pending order with the same idempotency key exists.
+    """
+    lines = list(cart)
+    quantities = _quantities(lines)
+
+    with transaction.atomic():
+        # Lock the rows so concurrent reservations of the same products queue up
+        # (a no-op on SQLite, where writers are serialized anyway)
+        available = dict(
+            Product.objects.select_for_update().filter(pk__in=quantities).order_by('pk')
+            .annotate(available=available_stock()).values_list('pk', 'available')
+        )
+        if any(available.get(pk, 0) < qty for pk, qty in quantities.items()):
+            short = [line.product for line in lines if available.get(line.product_id, 0) < quantities[line.product_id]]
+            raise InsufficientStock(short)
+
+        order = _create_order(
+            cart, shipping, status='pending', external_id=external_id, idempotency_key=idempotency_key,
+        )
+        expires_at = timezone.now() + INVOICE_DURATION + RESERVATION_GRACE
+        StockReservation.objects.bulk_create([
+            StockReservation(order=order, product_id=pk, quantity=qty, expires_at=expires_at)
+            for pk, qty in quantities.items()
+        ])
+    return order
+
+
+def confirm_order(order):
+    """Turn a paid order's holds into sales: decrement stock, count the sales and drop the holds."""
+    with transaction.atomic():
+        items = list(order.items.select_related('product'))
+        quantities = _quantities(items)
+        held = {r.product_id: r.quantity for r in order.reservations.filter(expires_at__gt=timezone.now())}
+        order.reservations.all().delete()
+
+        # Units still held were kept out of everyone else's reach; for the rest
+        # the hold lapsed, so only take what nobody else is holding
+        condition = reduce(or_, (
+            Q(pk=pk, stock__gte=qty) if held.get(pk, 0) >= qty else Q(pk=pk, stock__gte=held_stock() + qty)
+            for pk, qty in quantities.items()
+        ))
+        if _decrement_stock(quantities, condition) != len(quantities):
+            logger.error("Order %s was paid after its hold lapsed and some items are oversold", order.pk)
+        _record_sales(items)
+
+
+def release_order(order):
+    """Give a cancelled or expired order's held units back."""
+    order.reservations.all().delete()
+
+
+def release_expired_reservations(batch_size=500):
+    """Delete lapsed holds in batches of batch_size; returns how many were released."""
+    released = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                StockReservation.objects.filter(expires_at__lte=timezone.now())
+                .order_by('expires_at').values_list('pk', flat=True)[:batch_size]
+            )
+            if not batch:
+                return released
+            released += StockReservation.objects.filter(pk__in=batch).delete()[0]
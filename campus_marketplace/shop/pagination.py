@@ -0,0 +1,131 @@
+"""
+Keyset (cursor) pagination.
+
+Pages are fetched with a WHERE clause on the last row seen instead of an
+OFFSET, so page N costs the same as page 1. Cursors are signed, opaque
+tokens carrying the sort key values of the boundary row.
+"""
+import datetime
+
+from django.core import signing
+from django.core.exceptions import FieldDoesNotExist
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    @property
+    def has_other_pages(self):
+        return self.has_next or self.has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __bool__(self):
+        return bool(self.object_list)
+
+
+class KeysetPaginator:
+    """
+    Paginate queryset on ordering, which must end in a unique field
+    (e.g. ('-created_at', '-id')) so every row has a distinct position.
+    """
+    salt = 'shop.pagination'
+
+    def __init__(self, queryset, ordering, per_page=24):
+        self.queryset = queryset
+        self.ordering = tuple(ordering)
+        self.per_page = per_page
+
+    def page(self, cursor=None):
+        direction, values = self._decode(cursor)
+        backwards = direction == 'prev'
+
+        queryset = self.queryset.order_by(*(self._flip(o) for o in self.ordering) if backwards else self.ordering)
+        if values is not None:
+            queryset = queryset.filter(self._after(values, backwards))
+
+        rows = list(queryset[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if backwards:
+            rows.reverse()
+        if not rows:
+            return KeysetPage(rows)
+
+        # Going backwards we came from a later page, so there is always a next one
+        has_next = True if backwards else has_more
+        has_previous = has_more if backwards else values is not None
+        return KeysetPage(
+            rows,
+            next_cursor=self._encode('next', rows[-1]) if has_next else None,
+            previous_cursor=self._encode('prev', rows[0]) if has_previous else None,
+        )
+
+    @staticmethod
+    def _flip(order):
+        return order[1:] if order.startswith('-') else f'-{order}'
+
+    def _after(self, values, backwards):
+        """Build (a < x) OR (a = x AND b < y) OR ... for the boundary row."""
+        condition = Q()
+        equal = Q()
+        for order, value in zip(self.ordering, values):
+            name = order.lstrip('-')
+            descending = order.startswith('-') != backwards
+            condition |= equal & Q(**{f"{name}__{'lt' if descending else 'gt'}": value})
+            equal &= Q(**{name: value})
+        return condition
+
+    def _encode(self, direction, obj):
+        values = [getattr(obj, order.lstrip('-')) for order in self.ordering]
+        return signing.dumps({'d': direction, 'o': self.ordering, 'v': values},
+                             salt=self.salt, compress=True, serializer=_CursorSerializer)
+
+    def _decode(self, cursor):
+        if not cursor:
+            return None, None
+        try:
+            data = signing.loads(cursor, salt=self.salt, serializer=_CursorSerializer)
+        except signing.BadSignature:
+            return None, None
+        # A cursor minted for a different sort order doesn't apply here
+        if tuple(data.get('o', ())) != self.ordering or data.get('d') not in ('next', 'prev'):
+            return None, None
+        return data['d'], [self._to_python(order, value) for order, value in zip(self.ordering, data['v'])]
+
+    def _to_python(self, order, value):
+        try:
+            field = self.queryset.model._meta.get_field(order.lstrip('-'))
+        except FieldDoesNotExist:
+            return value
+        return field.to_python(value)
+
+
+class _CursorEncoder(DjangoJSONEncoder):
+    def default(self, o):
+        # DjangoJSONEncoder drops microseconds, which would make the boundary inexact
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+class _CursorSerializer(signing.JSONSerializer):
+    def dumps(self, obj):
+        return _CursorEncoder(separators=(',', ':')).encode(obj).encode('latin-1')
@@ -0,0 +1,167 @@
+"""
+Catching up on payment webhooks that never arrived.
+
+An order paid through Xendit stays pending until its webhook comes in; if
+the webhook is lost, it stays pending for good. reconcile_pending_orders
+pages through Xendit orders that have been pending longer than
+STALE_AFTER, oldest placed_at first, and asks Xendit for each invoice's
+status (a batch at a time, `concurrency` requests in flight over the
+pooled client). Then, per batch:
+
+- paid invoices are stored in the webhook inbox with one bulk insert, as
+  if the webhook had arrived, and applied by apply_webhook_events, so a
+  payment is confirmed the same way whichever route it took. A PAID
+  event already in the inbox for an order that is still pending (it gave
+  up after MAX_ATTEMPTS, or came in before its order existed) is queued
+  to be applied again;
+- expired invoices, and orders Xendit has no invoice for once the invoice
+  window is over, are cancelled with one UPDATE and their holds released
+  with one DELETE;
+- invoices still open are left alone.
+
+Run it from cron with `manage.py reconcile_payments`.
+"""
+import logging
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from campus_marketplace.services.http_client import get_client
+
+from .models import Order, StockReservation, WebhookEvent
+from .orders import INVOICE_DURATION, RESERVATION_GRACE
+from .webhooks import XENDIT, apply_webhook_events
+
+logger = logging.getLogger(__name__)
+
+BASE_URL = (getattr(settings, 'XENDIT_BASE_URL', None) or 'https://api.xendit.co').rstrip('/')
+# Give the webhook this long to arrive before asking Xendit
+STALE_AFTER = timedelta(minutes=getattr(settings, 'SHOP_RECONCILE_AFTER_MINUTES', 15))
+BATCH_SIZE = 100
+CONCURRENCY = 8
+
+PAID_STATUSES = ('PAID', 'SETTLED')
+EXPIRED_STATUSES = ('EXPIRED',)
+
+
+def stale_pending_orders(older_than=STALE_AFTER, batch_size=BATCH_SIZE):
+    """Yield lists of pending Xendit orders placed before now - older_than, oldest first."""
+    cutoff = timezone.now() - older_than
+    orders = (
+        Order.objects.filter(status='pending', external_id__isnull=False, placed_at__lte=cutoff)
+        .only('pk', 'external_id', 'invoice_id', 'placed_at').order_by('placed_at', 'pk')
+    )
+    batch = list(orders[:batch_size])
+    while batch:
+        yield batch
+        # Keyset paging: orders cancelled meanwhile drop out without shifting the next page
+        last = batch[-1]
+        batch = list(orders.filter(placed_at__gte=last.placed_at).exclude(placed_at=last.placed_at, pk__lte=last.pk)[:batch_size])
+
+
+def fetch_invoice(order):
+    """Xendit's invoice for the order as a dict, or None if Xendit has none."""
+    from .views import get_xendit_auth_header
+
+    client = get_client('xendit')
+    headers = {'Authorization': get_xendit_auth_header()}
+    if order.invoice_id:
+        response = client.get(f'{BASE_URL}/v2/invoices/{order.invoice_id}', headers=headers)
+    else:
+        # The invoice was created but we never stored its id
+        response = client.get(f'{BASE_URL}/v2/invoices', params={'external_id': order.external_id}, headers=headers)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    invoice = response.json()
+    if isinstance(invoice, list):
+        return invoice[0] if invoice else None
+    return invoice
+
+
+def _fetch(order):
+    try:
+        return order, fetch_invoice(order), None
+    except Exception as e:
+        return order, None, e
+
+
+def _record_paid(paid):
+    # As if the webhook had arrived
+    events = [
+        WebhookEvent(
+            provider=XENDIT, event_id=str(invoice['id'])[:100], status='PAID',
+            external_id=order.external_id, payload=invoice,
+        )
+        for order, invoice in paid
+    ]
+    WebhookEvent.objects.bulk_create(events, ignore_conflicts=True)
+    # One already in the inbox didn't get its order paid, whatever became of it: apply it again
+    still_pending = Order.objects.filter(pk__in=[order.pk for order, _ in paid], status='pending')
+    WebhookEvent.objects.filter(
+        provider=XENDIT, status='PAID', event_id__in=[event.event_id for event in events],
+        external_id__in=still_pending.values('external_id'),
+    ).update(processed_at=None, attempts=0, next_attempt_at=timezone.now(), last_error='')
+
+
+def _cancel(orders):
+    with transaction.atomic():
+        # A webhook may have settled some of them since we looked
+        pks = list(
+            Order.objects.select_for_update().filter(pk__in=[order.pk for order in orders], status='pending')
+            .values_list('pk', flat=True)
+        )
+        StockReservation.objects.filter(order_id__in=pks).delete()
+        return Order.objects.filter(pk__in=pks).update(status='cancelled')
+
+
+def reconcile_pending_orders(older_than=STALE_AFTER, batch_size=BATCH_SIZE, concurrency=CONCURRENCY, dry_run=False):
+    """
+    Bring stale pending orders in line with Xendit. Returns a Counter of
+    checked, paid, expired, missing (no invoice at Xendit), open, errors,
+    cancelled (orders actually cancelled) and seconds.
+    """
+    started = time.perf_counter()
+    counts = Counter()
+    # Orders younger than this may still get their invoice
+    invoice_cutoff = timezone.now() - INVOICE_DURATION - RESERVATION_GRACE
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for batch in stale_pending_orders(older_than, batch_size):
+            paid, cancel = [], []
+            for order, invoice, error in pool.map(_fetch, batch):
+                counts['checked'] += 1
+                if error is not None:
+                    logger.warning("Could not check order %s with Xendit: %r", order.pk, error)
+                    counts['errors'] += 1
+                elif invoice is None:
+                    if order.placed_at <= invoice_cutoff:
+                        counts['missing'] += 1
+                        cancel.append(order)
+                    else:
+                        counts['open'] += 1
+                elif invoice.get('status') in PAID_STATUSES:
+                    counts['paid'] += 1
+                    paid.append((order, invoice))
+                elif invoice.get('status') in EXPIRED_STATUSES:
+                    counts['expired'] += 1
+                    cancel.append(order)
+                else:
+                    counts['open'] += 1
+            if dry_run:
+                continue
+            if paid:
+                _record_paid(paid)
+            if cancel:
+                counts['cancelled'] += _cancel(cancel)
+    if counts['paid'] and not dry_run:
+        apply_webhook_events.enqueue()
+    counts['seconds'] = time.perf_counter() - started
+    logger.info("Reconciled %d pending orders in %.1fs: %d paid, %d expired, %d missing, %d open, %d errors",
+                counts['checked'], counts['seconds'], counts['paid'], counts['expired'], counts['missing'],
+                counts['open'], counts['errors'])
+    return counts
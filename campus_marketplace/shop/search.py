@@ -0,0 +1,164 @@
+"""
+Full-text search index for Product.
+
+The backend is picked from the database vendor (SQLite FTS5 in dev,
+Postgres tsvector + GIN in prod) unless SHOP_SEARCH_BACKEND points at a
+custom class. Each backend keeps a side table keyed by product id that is
+updated from the Product save/delete signals below.
+"""
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import FloatField, Q
+from django.db.models.expressions import RawSQL
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+
+class IcontainsSearchBackend:
+    """Fallback for databases without a native full-text index (no ranking)."""
+    # Prepended to a listing's ordering to put the best matches first
+    rank_ordering = ()
+
+    def index_product(self, product):
+        pass
+
+    def remove_product(self, product_id):
+        pass
+
+    def rebuild(self):
+        return 0
+
+    def search(self, queryset, query):
+        return queryset.filter(Q(name__icontains=query) | Q(description__icontains=query))
+
+
+class SQLiteFTS5SearchBackend:
+    table = 'shop_product_fts'
+    # bm25() column weights: a hit in the name counts more than in the description
+    rank_sql = f"SELECT bm25({table}, 10.0, 1.0) FROM {table} WHERE {table} MATCH %s AND rowid = shop_product.id"
+    # bm25 is lower for better matches
+    rank_ordering = ('search_rank',)
+
+    def index_product(self, product):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table} WHERE rowid = %s", [product.pk])
+            cursor.execute(
+                f"INSERT INTO {self.table} (rowid, name, description) VALUES (%s, %s, %s)",
+                [product.pk, product.name, product.description],
+            )
+
+    def remove_product(self, product_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table} WHERE rowid = %s", [product_id])
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table}")
+            cursor.execute(f"INSERT INTO {self.table} (rowid, name, description) SELECT id, name, description FROM shop_product")
+            return cursor.rowcount
+
+    def to_match(self, query):
+        # Quote every word so user input can't hit FTS5 query syntax; '*' makes it a prefix match
+        return ' '.join(f'"{word}"*' for word in re.findall(r'\w+', query))
+
+    def search(self, queryset, query):
+        match = self.to_match(query)
+        if not match:
+            return queryset.none()
+        return queryset.filter(
+            pk__in=RawSQL(f"SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s", [match])
+        ).annotate(
+            search_rank=RawSQL(self.rank_sql, [match], output_field=FloatField())
+        ).order_by(*self.rank_ordering, '-created_at')
+
+
+class PostgresSearchBackend:
+    table = 'shop_product_search'
+    config = 'english'
+    # ts_rank is higher for better matches
+    rank_ordering = ('-search_rank',)
+    document_sql = (
+        "setweight(to_tsvector(%s, coalesce(%s, '')), 'A') || "
+        "setweight(to_tsvector(%s, coalesce(%s, '')), 'B')"
+    )
+
+    def index_product(self, product):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {self.table} (product_id, document) VALUES (%s, {self.document_sql}) "
+                f"ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document",
+                [product.pk, self.config, product.name, self.config, product.description],
+            )
+
+    def remove_product(self, product_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table} WHERE product_id = %s", [product_id])
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table}")
+            cursor.execute(
+                f"INSERT INTO {self.table} (product_id, document) "
+                f"SELECT id, setweight(to_tsvector(%s, coalesce(name, '')), 'A') || "
+                f"setweight(to_tsvector(%s, coalesce(description, '')), 'B') FROM shop_product",
+                [self.config, self.config],
+            )
+            return cursor.rowcount
+
+    def search(self, queryset, query):
+        if not query.strip():
+            return queryset.none()
+        tsquery = f"websearch_to_tsquery('{self.config}', %s)"
+        return queryset.filter(
+            pk__in=RawSQL(f"SELECT product_id FROM {self.table} WHERE document @@ {tsquery}", [query])
+        ).annotate(
+            search_rank=RawSQL(
+                f"SELECT ts_rank(document, {tsquery}) FROM {self.table} WHERE product_id = shop_product.id",
+                [query],
+                output_field=FloatField(),
+            )
+        ).order_by(*self.rank_ordering, '-created_at')
+
+
+BACKENDS = {
+    'sqlite': SQLiteFTS5SearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+_backend = None
+
+
+def get_search_backend():
+    global _backend
+    if _backend is None:
+        backend_path = getattr(settings, 'SHOP_SEARCH_BACKEND', None)
+        if backend_path:
+            backend_class = import_string(backend_path)
+        else:
+            backend_class = BACKENDS.get(connection.vendor, IcontainsSearchBackend)
+        _backend = backend_class()
+    return _backend
+
+
+def search_products(queryset, query):
+    """Filter queryset down to products matching query, best matches first."""
+    return get_search_backend().search(queryset, query)
+
+
+def search_rank_ordering():
+    """Ordering on the search_rank annotation that puts the best matches first."""
+    return tuple(get_search_backend().rank_ordering)
+
+
+@receiver(post_save, sender='shop.Product')
+def index_product_on_save(sender, instance, raw=False, **kwargs):
+    if not raw:
+        get_search_backend().index_product(instance)
+
+
+@receiver(post_delete, sender='shop.Product')
+def remove_product_from_index(sender, instance, **kwargs):
+    get_search_backend().remove_product(instance.pk)
@@ -0,0 +1,538 @@
+"""
+Cached Lalamove delivery quotes.
+
+The pickup (the TUP campus) and the parcel never change, so a quote only
+depends on where it goes, the vehicle and when it is scheduled. Quotes
+are cached under a key built from the normalized delivery address, the
+service type and the schedule time rounded up to SCHEDULE_BUCKET, for
+less than the time Lalamove keeps a quotation valid.
+
+Identical requests that miss at the same time share one upstream call:
+within a process they queue on a per-key lock, and across processes the
+first one takes a short-lived lock entry in the cache while the others
+wait for its result. Hits, misses and the time spent upstream are
+counted in ShippingQuoteStat rows, see quote_cache_stats().
+
+aget_quote is the same for async views. It talks to Lalamove without
+blocking the event loop, and concurrent misses in the loop await one
+shared task.
+
+aget_quotes asks for every vehicle in SERVICE_TYPES at once and returns
+within QUOTE_DEADLINE with whatever arrived. Vehicles that timed out, or
+whose provider is down, are priced from ShippingEstimate: running
+averages of past quotes per delivery zone, updated whenever a live quote
+comes back. An estimate has no Lalamove quotation behind it, so it is
+flagged 'bookable': False and can only be shown, never ordered.
+
+Every live quote is also kept under its quoteId until it expires;
+bookable_quote(quote_id) is how checkout gets the fee it charges, rather
+than trusting the one the browser sends back.
+"""
+import asyncio
+import hashlib
+import logging
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal, InvalidOperation
+
+import httpx
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.db.models import DecimalField, ExpressionWrapper, F, IntegerField
+from django.db.models.functions import Least
+
+from campus_marketplace.services.lalamove_service import aget_lalamove_quotation, get_lalamove_quotation
+
+from .models import ShippingEstimate, ShippingQuoteStat
+
+logger = logging.getLogger(__name__)
+
+PICKUP_ADDRESS = "Natividad Almeda-Lopez corner A. Villegas and San Marcelino Streets, Ermita, Manila, Metro Manila, Philippines"
+DEFAULT_SERVICE_TYPE = "MOTORCYCLE"
+# Quoted side by side; the first one that has a price is the default choice
+SERVICE_TYPES = tuple(getattr(settings, 'SHOP_QUOTE_SERVICE_TYPES', (DEFAULT_SERVICE_TYPE, 'SEDAN', 'MPV')))
+# The most the cart page waits for live quotes, in seconds
+QUOTE_DEADLINE = getattr(settings, 'SHOP_QUOTE_DEADLINE', 2.5)
+# Estimates average the last ~ESTIMATE_WINDOW quotes, so they follow price changes
+ESTIMATE_WINDOW = 50
+SCHEDULE_LEAD = timedelta(hours=1)
+SCHEDULE_BUCKET = timedelta(minutes=15)
+# Lalamove keeps a quotation for 5 minutes; stay under it so a cached quoteId can still be ordered
+QUOTE_TIMEOUT = getattr(settings, 'SHOP_QUOTE_CACHE_TIMEOUT', 4 * 60)
+QUOTE_EXPIRY_MARGIN = 30
+# Upper bound on how long others wait for the request fetching a quote
+FETCH_LOCK_TIMEOUT = 20
+FETCH_POLL_INTERVAL = 0.1
+
+HITS = 'hits'
+MISSES = 'misses'
+UPSTREAM_MS = 'upstream_ms'
+# The longest a process keeps counts to itself before adding them to the shared ones
+STATS_FLUSH_INTERVAL = 10
+
+_key_locks = {}
+_key_locks_guard = threading.Lock()
+# Cache key -> the task fetching it, for aget_quote
+_fetch_tasks = {}
+_pending = {}
+_pending_lock = threading.Lock()
+_flushed_at = 0
+
+
+def normalize_address(address):
+    """Case, spacing and punctuation folded, so trivially different spellings share a quote."""
+    address = re.sub(r'[.#]', ' ', address.casefold())
+    address = re.sub(r'\s*,\s*', ', ', address)
+    return re.sub(r'\s+', ' ', address).strip(' ,')
+
+
+def delivery_zone(address):
+    """
+    The city part of an address like "12 Rizal St, Ermita, Manila, Metro
+    Manila, Philippines", which is what the cart page sends.
+    """
+    parts = [part for part in normalize_address(address).split(', ') if part]
+    if parts and parts[-1] == 'philippines':
+        parts.pop()
+    if not parts:
+        return ''
+    city = parts[-2] if len(parts) > 1 else parts[-1]
+    return re.sub(r'^city of |\s+city$', '', city)
+
+
+def schedule_bucket(now=None):
+    """The pickup time quoted for a request made now: an hour ahead, rounded up to the bucket."""
+    at = (now or datetime.now(dt_timezone.utc)) + SCHEDULE_LEAD
+    step = SCHEDULE_BUCKET.total_seconds()
+    return datetime.fromtimestamp(-(-at.timestamp() // step) * step, dt_timezone.utc)
+
+
+def _quotation_key(quote_id):
+    return f'lalamove_quotation:{quote_id}'
+
+
+def _quote_key(address, service_type, scheduled):
+    digest = hashlib.sha256(normalize_address(address).encode()).hexdigest()[:32]
+    return f'shipping_quote:{service_type}:{int(scheduled.timestamp())}:{digest}'
+
+
+def _add_pending(name, amount):
+    global _flushed_at
+    # Counted in memory and written at most every STATS_FLUSH_INTERVAL, so a hit stays cheap
+    with _pending_lock:
+        _pending[name] = _pending.get(name, 0) + amount
+        now = time.monotonic()
+        if now - _flushed_at < STATS_FLUSH_INTERVAL:
+            return {}
+        _flushed_at = now
+        pending = dict(_pending)
+        _pending.clear()
+        return pending
+
+
+def _take_pending():
+    global _flushed_at
+    with _pending_lock:
+        _flushed_at = time.monotonic()
+        pending = dict(_pending)
+        _pending.clear()
+        return pending
+
+
+def _flush(pending):
+    try:
+        for name, amount in pending.items():
+            # One UPDATE with F(), so concurrent processes never lose each other's counts
+            if not ShippingQuoteStat.objects.filter(name=name).update(value=F('value') + amount):
+                ShippingQuoteStat.objects.get_or_create(name=name)
+                ShippingQuoteStat.objects.filter(name=name).update(value=F('value') + amount)
+    except DatabaseError:
+        # Statistics only; never fail a quote over them
+        logger.exception("Could not record shipping quote stats %s", pending)
+
+
+async def _aflush(pending):
+    try:
+        for name, amount in pending.items():
+            if not await ShippingQuoteStat.objects.filter(name=name).aupdate(value=F('value') + amount):
+                await ShippingQuoteStat.objects.aget_or_create(name=name)
+                await ShippingQuoteStat.objects.filter(name=name).aupdate(value=F('value') + amount)
+    except DatabaseError:
+        logger.exception("Could not record shipping quote stats %s", pending)
+
+
+def _count(name, amount=1):
+    _flush(_add_pending(name, amount))
+
+
+async def _acount(name, amount=1):
+    await _aflush(_add_pending(name, amount))
+
+
+def quote_cache_stats():
+    """
+    {'hits', 'misses', 'hit_rate', 'avg_upstream_ms', 'saved_ms'} since the
+    counters were last reset. Other processes' last STATS_FLUSH_INTERVAL
+    of counts may not be in yet.
+    """
+    _flush(_take_pending())
+    stats = dict(ShippingQuoteStat.objects.filter(name__in=(HITS, MISSES, UPSTREAM_MS)).values_list('name', 'value'))
+    hits = stats.get(HITS, 0)
+    misses = stats.get(MISSES, 0)
+    upstream_ms = stats.get(UPSTREAM_MS, 0)
+    avg_ms = upstream_ms / misses if misses else 0
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / (hits + misses) if hits + misses else 0,
+        'avg_upstream_ms': avg_ms,
+        # Each hit is an upstream call we didn't wait for
+        'saved_ms': hits * avg_ms,
+    }
+
+
+def reset_quote_cache_stats():
+    _take_pending()
+    ShippingQuoteStat.objects.filter(name__in=(HITS, MISSES, UPSTREAM_MS)).update(value=0)
+
+
+def _timeout_for(quote):
+    # Never keep a quote past its own expiry, if Lalamove told us one
+    expires_at = quote.get('expiresAt')
+    if not expires_at:
+        return QUOTE_TIMEOUT
+    try:
+        expires = datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
+    except ValueError:
+        return QUOTE_TIMEOUT
+    remaining = (expires - datetime.now(dt_timezone.utc)).total_seconds() - QUOTE_EXPIRY_MARGIN
+    return max(0, min(QUOTE_TIMEOUT, int(remaining)))
+
+
+def bookable_quote(quote_id):
+    """The live quote Lalamove issued as quote_id, while it can still be ordered, else None."""
+    if not quote_id:
+        return None
+    return cache.get(_quotation_key(quote_id))
+
+
+def _entries(key, quote, service_type):
+    entries = {key: quote}
+    if quote.get('quoteId'):
+        entries[_quotation_key(quote['quoteId'])] = {**quote, 'serviceType': service_type}
+    return entries
+
+
+def _store(key, quote, service_type):
+    timeout = _timeout_for(quote)
+    if timeout:
+        cache.set_many(_entries(key, quote, service_type), timeout)
+
+
+async def _astore(key, quote, service_type):
+    timeout = _timeout_for(quote)
+    if timeout:
+        await cache.aset_many(_entries(key, quote, service_type), timeout)
+
+
+def _quotation_payload(address, service_type, scheduled):
+    return {
+        "data": {
+            "scheduleAt": scheduled.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            "serviceType": service_type,
+            "language": "en_PH",
+            "stops": [
+                {"address": PICKUP_ADDRESS},
+                {"address": address},
+            ],
+            "item": {
+                "quantity": "1",
+                "weight": "SMALL",
+            },
+        }
+    }
+
+
+def _quote_from(response, payload):
+    data = response.get('data', {})
+    price_breakdown = data.get('priceBreakdown', {})
+    return {
+        'fee': price_breakdown.get('total'),
+        'currency': price_breakdown.get('currency'),
+        'quoteId': data.get('quotationId'),
+        'expiresAt': data.get('expiresAt'),
+        'scheduleAt': payload['data']['scheduleAt'],
+        'distance': (data.get('distance') or {}).get('value'),
+    }
+
+
+def _sample(quote):
+    try:
+        fee = Decimal(quote['fee'])
+    except (TypeError, InvalidOperation):
+        return None, None
+    try:
+        distance = int(quote['distance']) if quote.get('distance') else None
+    except (TypeError, ValueError):
+        distance = None
+    return fee, distance
+
+
+def _running_average(field, value, output_field):
+    # Mean of the stored average (as ESTIMATE_WINDOW - 1 samples at most) and the new value
+    weight = Least(F('samples'), ESTIMATE_WINDOW - 1)
+    return ExpressionWrapper((F(field) * weight + value) / (weight + 1), output_field=output_field)
+
+
+def _estimate_updates(fee, distance):
+    updates = {
+        'fee': _running_average('fee', fee, DecimalField(max_digits=10, decimal_places=2)),
+        'samples': F('samples') + 1,
+    }
+    if distance is not None:
+        updates['distance_m'] = _running_average('distance_m', distance, IntegerField())
+    return updates
+
+
+def _new_estimates(zones, service_type, quote, fee, distance):
+    return [
+        ShippingEstimate(zone=zone, service_type=service_type, fee=fee, currency=quote['currency'] or 'PHP',
+                         distance_m=distance)
+        for zone in zones
+    ]
+
+
+def record_quote(address, service_type, quote):
+    """Fold a live quote into the estimates for its zone and for all zones."""
+    fee, distance = _sample(quote)
+    if fee is None:
+        return
+    zones = {delivery_zone(address), ''}
+    try:
+        rows = ShippingEstimate.objects.filter(zone__in=zones, service_type=service_type)
+        if rows.update(**_estimate_updates(fee, distance)) < len(zones):
+            missing = zones - set(rows.values_list('zone', flat=True))
+            ShippingEstimate.objects.bulk_create(
+                _new_estimates(missing, service_type, quote, fee, distance), ignore_conflicts=True,
+            )
+    except DatabaseError:
+        # Estimates are a fallback; never fail a quote over them
+        logger.exception("Could not record the %s quote for %s", service_type, address)
+
+
+async def arecord_quote(address, service_type, quote):
+    fee, distance = _sample(quote)
+    if fee is None:
+        return
+    zones = {delivery_zone(address), ''}
+    try:
+        rows = ShippingEstimate.objects.filter(zone__in=zones, service_type=service_type)
+        if await rows.aupdate(**_estimate_updates(fee, distance)) < len(zones):
+            missing = zones - {zone async for zone in rows.values_list('zone', flat=True)}
+            await ShippingEstimate.objects.abulk_create(
+                _new_estimates(missing, service_type, quote, fee, distance), ignore_conflicts=True,
+            )
+    except DatabaseError:
+        logger.exception("Could not record the %s quote for %s", service_type, address)
+
+
+def _fetch(address, service_type, scheduled):
+    payload = _quotation_payload(address, service_type, scheduled)
+    started = time.perf_counter()
+    response = get_lalamove_quotation(payload)
+    _count(UPSTREAM_MS, int((time.perf_counter() - started) * 1000))
+    quote = _quote_from(response, payload)
+    record_quote(address, service_type, quote)
+    return quote
+
+
+async def _afetch(address, service_type, scheduled, timeout=None):
+    payload = _quotation_payload(address, service_type, scheduled)
+    started = time.perf_counter()
+    response = await aget_lalamove_quotation(payload, timeout=timeout)
+    await _acount(UPSTREAM_MS, int((time.perf_counter() - started) * 1000))
+    quote = _quote_from(response, payload)
+    await arecord_quote(address, service_type, quote)
+    return quote
+
+
+def _wait_for(key):
+    # Another process is fetching this quote; use its result once it lands
+    deadline = time.monotonic() + FETCH_LOCK_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(FETCH_POLL_INTERVAL)
+        quote = cache.get(key)
+        if quote is not None:
+            return quote
+        if cache.get(f'{key}:lock') is None:
+            return None
+    return None
+
+
+async def _await_for(key):
+    deadline = time.monotonic() + FETCH_LOCK_TIMEOUT
+    while time.monotonic() < deadline:
+        await asyncio.sleep(FETCH_POLL_INTERVAL)
+        quote = await cache.aget(key)
+        if quote is not None:
+            return quote
+        if await cache.aget(f'{key}:lock') is None:
+            return None
+    return None
+
+
+def get_quote(address, service_type=DEFAULT_SERVICE_TYPE):
+    """
+    {'fee', 'currency', 'quoteId', 'expiresAt', 'scheduleAt'} for delivering
+    to address, from cache when possible. Lalamove errors propagate as
+    requests exceptions and are never cached.
+    """
+    scheduled = schedule_bucket()
+    key = _quote_key(address, service_type, scheduled)
+    quote = cache.get(key)
+    if quote is not None:
+        _count(HITS)
+        return quote
+
+    with _key_locks_guard:
+        key_lock = _key_locks.setdefault(key, threading.Lock())
+    try:
+        with key_lock:
+            # Whoever held the lock may have just cached it
+            quote = cache.get(key)
+            owns_lock = quote is None and cache.add(f'{key}:lock', 1, FETCH_LOCK_TIMEOUT)
+            if quote is None and not owns_lock:
+                quote = _wait_for(key)
+            if quote is not None:
+                _count(HITS)
+                return quote
+
+            # Nothing cached, or the other fetch failed or took too long: ask ourselves
+            _count(MISSES)
+            try:
+                quote = _fetch(address, service_type, scheduled)
+                _store(key, quote, service_type)
+            finally:
+                if owns_lock:
+                    cache.delete(f'{key}:lock')
+            return quote
+    finally:
+        with _key_locks_guard:
+            if not key_lock.locked():
+                _key_locks.pop(key, None)
+
+
+async def _afetch_and_store(key, address, service_type, scheduled, timeout):
+    # Run once per key and loop, however many requests are awaiting it
+    owns_lock = await cache.aadd(f'{key}:lock', 1, FETCH_LOCK_TIMEOUT)
+    if not owns_lock:
+        quote = await _await_for(key)
+        if quote is not None:
+            await _acount(HITS)
+            return quote
+
+    await _acount(MISSES)
+    try:
+        quote = await _afetch(address, service_type, scheduled, timeout)
+        await _astore(key, quote, service_type)
+    finally:
+        if owns_lock:
+            await cache.adelete(f'{key}:lock')
+    return quote
+
+
+async def aget_quote(address, service_type=DEFAULT_SERVICE_TYPE, timeout=None):
+    """
+    Async version of get_quote; Lalamove errors propagate as httpx or
+    requests exceptions. With a timeout, Lalamove gets one try of at most
+    that many seconds.
+    """
+    scheduled = schedule_bucket()
+    key = _quote_key(address, service_type, scheduled)
+    quote = await cache.aget(key)
+    if quote is not None:
+        await _acount(HITS)
+        return quote
+
+    task = _fetch_tasks.get(key)
+    if task is not None and task.get_loop() is asyncio.get_running_loop():
+        await _acount(HITS)
+    else:
+        task = _fetch_tasks[key] = asyncio.ensure_future(_afetch_and_store(key, address, service_type, scheduled, timeout))
+        task.add_done_callback(lambda done: _fetch_tasks.pop(key, None) if _fetch_tasks.get(key) is done else None)
+    # Shielded so one caller disconnecting doesn't cancel the fetch for the others
+    return await asyncio.shield(task)
+
+
+def _rejected(error):
+    # Lalamove turned the request itself down (bad address, unsupported vehicle):
+    # an estimate would price a delivery that can't happen
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None)
+    return status is not None and 400 <= status < 500 and status != 429
+
+
+async def aestimates(address, service_types):
+    """{service_type: estimate} from past quotes to the address's zone, else to any zone."""
+    zone = delivery_zone(address)
+    found = {}
+    rows = ShippingEstimate.objects.filter(service_type__in=service_types, zone__in={zone, ''})
+    async for row in rows:
+        # The zone's own average beats the all-zones one
+        if row.service_type not in found or row.zone:
+            found[row.service_type] = {
+                'fee': str(row.fee),
+                'currency': row.currency,
+                'quoteId': None,
+                'serviceType': row.service_type,
+                'estimated': True,
+                'bookable': False,
+            }
+    return found
+
+
+async def aget_quotes(address, service_types=SERVICE_TYPES, deadline=None):
+    """
+    One price per service type, in service_types order, within deadline
+    (QUOTE_DEADLINE) seconds: live quotes where they arrived in time,
+    estimates (not bookable) otherwise.
+    A type Lalamove rejected outright is left out; if it rejected all of
+    them, its error is raised.
+    """
+    deadline = QUOTE_DEADLINE if deadline is None else deadline
+    # One try each, given up at the deadline, so a slow Lalamove can't hold the request past it
+    tasks = {asyncio.ensure_future(aget_quote(address, service_type, timeout=deadline)): service_type
+             for service_type in service_types}
+    done, pending = await asyncio.wait(tasks, timeout=deadline)
+    for task in pending:
+        # Cancels only our wait; the shared fetch is shielded for other requests in
+        # this loop. Under WSGI the request's loop cancels it as it closes, without
+        # waiting on the HTTP call, which gives up on its own timeout
+        task.cancel()
+
+    quotes, rejected = {}, {}
+    for task in done:
+        service_type = tasks[task]
+        error = task.exception()
+        if error is None:
+            quotes[service_type] = {**task.result(), 'serviceType': service_type, 'estimated': False, 'bookable': True}
+        elif _rejected(error):
+            rejected[service_type] = error
+        elif isinstance(error, (requests.exceptions.RequestException, httpx.HTTPError)):
+            logger.warning("No live %s quote for %s: %r", service_type, address, error)
+        else:
+            raise error
+    if pending:
+        logger.warning("Lalamove quotes for %s missed the %.1fs deadline: %s", address, deadline,
+                       ', '.join(tasks[task] for task in pending))
+
+    missing = [t for t in service_types if t not in quotes and t not in rejected]
+    if missing:
+        quotes.update(await aestimates(address, missing))
+    if not quotes and rejected:
+        raise next(iter(rejected.values()))
+    return [quotes[t] for t in service_types if t in quotes]
@@ -0,0 +1,281 @@
+"""
+A small background task queue kept in the database, so nothing else has
+to run next to the app.
+
+Functions are registered with @task and queued as Task rows:
+
+    @task(priority=10)
+    def send_receipt(order_id):
+        ...
+
+    send_receipt.enqueue(order.pk)                       # as soon as a worker is free
+    send_receipt.schedule(args=[order.pk], delay=60)     # not before a minute from now
+
+Queuing is an INSERT in the caller's transaction, so a task queued by a
+request that then fails is rolled back with it. Arguments must be JSON.
+
+`manage.py run_worker --concurrency N` runs them. Workers claim tasks
+highest priority first, then oldest run_at, with SELECT ... FOR UPDATE
+SKIP LOCKED where the database has it, so workers never wait on each
+other; on SQLite a task is claimed by a conditional UPDATE only one
+worker can win. A claim is a lease of LEASE: while the task runs, a
+heartbeat thread renews it every HEARTBEAT, so a task may run far longer
+than LEASE without another worker taking it over; if the worker dies,
+the heartbeat stops with it and the task is picked up again once the
+lease lapses. A task that raises is retried with exponential backoff
+until max_attempts, then marked failed.
+
+Every Task row keeps when it was due, started and finished, which is what
+task_metrics() (and `manage.py task_stats`) report latency and failures from.
+"""
+import logging
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Task
+
+logger = logging.getLogger(__name__)
+
+# How long a worker may go without renewing its claim before others assume it died
+LEASE = timedelta(seconds=getattr(settings, 'SHOP_TASK_LEASE', 5 * 60))
+# A running task's lease is renewed this often, well before it lapses
+HEARTBEAT = LEASE / 3
+RETRY_BACKOFF = 10          # seconds before the first retry, doubled per attempt
+RETRY_BACKOFF_MAX = 60 * 60
+# Finished tasks are kept this long for task_stats, then purged
+RETENTION = timedelta(days=getattr(settings, 'SHOP_TASK_RETENTION_DAYS', 7))
+QUEUE_ORDER = ('-priority', 'run_at', 'pk')
+
+_registry = {}
+
+
+class TaskFunction:
+    """A registered task. Calling it runs the function here and now."""
+
+    def __init__(self, func, name, priority, max_attempts):
+        self.func = func
+        self.name = name
+        self.priority = priority
+        self.max_attempts = max_attempts
+        self.__doc__ = func.__doc__
+
+    def __call__(self, *args, **kwargs):
+        return self.func(*args, **kwargs)
+
+    def enqueue(self, *args, **kwargs):
+        """Queue a call to run as soon as a worker is free; returns the Task."""
+        return self.schedule(args=args, kwargs=kwargs)
+
+    def schedule(self, args=(), kwargs=None, *, run_at=None, delay=None, priority=None):
+        """Queue a call to run at run_at, or delay seconds from now; returns the Task."""
+        if run_at is None:
+            run_at = timezone.now() + timedelta(seconds=delay or 0)
+        return Task.objects.create(
+            name=self.name, args=list(args), kwargs=kwargs or {}, run_at=run_at,
+            priority=self.priority if priority is None else priority, max_attempts=self.max_attempts,
+        )
+
+    def schedule_unless_queued(self, run_at):
+        """schedule() a call without arguments at run_at, unless one is already queued to run by then."""
+        if Task.objects.filter(name=self.name, status=Task.QUEUED, run_at__lte=run_at).exists():
+            return None
+        return self.schedule(run_at=run_at)
+
+
+def task(func=None, *, name=None, priority=0, max_attempts=3):
+    """Register a function as a background task, under its dotted path unless name is given."""
+    def register(func):
+        task_name = name or f'{func.__module__}.{func.__qualname__}'
+        registered = _registry[task_name] = TaskFunction(func, task_name, priority, max_attempts)
+        return registered
+    return register(func) if func is not None else register
+
+
+def _claimable(now):
+    # Due tasks, and running ones whose worker stopped renewing the lease
+    return Task.objects.filter(Q(status=Task.QUEUED, run_at__lte=now) | Q(status=Task.RUNNING, locked_until__lt=now))
+
+
+def claim(worker_id, limit=1):
+    """Take up to `limit` due tasks for this worker; returns them, highest priority first."""
+    now = timezone.now()
+    lease = {'status': Task.RUNNING, 'locked_by': worker_id, 'locked_until': now + LEASE, 'started_at': now}
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            pks = list(
+                _claimable(now).select_for_update(skip_locked=True)
+                .order_by(*QUEUE_ORDER).values_list('pk', flat=True)[:limit]
+            )
+            Task.objects.filter(pk__in=pks).update(**lease)
+    else:
+        # No row locks: only the worker whose UPDATE still finds the row as it read it gets it
+        pks = []
+        candidates = _claimable(now).order_by(*QUEUE_ORDER).values_list('pk', 'status', 'locked_until')[:limit * 4]
+        for pk, status, locked_until in candidates:
+            if Task.objects.filter(pk=pk, status=status, locked_until=locked_until).update(**lease):
+                pks.append(pk)
+                if len(pks) == limit:
+                    break
+    return list(Task.objects.filter(pk__in=pks).order_by(*QUEUE_ORDER))
+
+
+def _retry_delay(attempts):
+    # Exponential, capped, with jitter so a burst of failures doesn't retry in lockstep
+    delay = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** (attempts - 1))
+    return timedelta(seconds=delay * random.uniform(0.5, 1))
+
+
+def renew_lease(task_id, worker_id):
+    """Extend this worker's lease on a running task; returns False if it no longer holds it."""
+    return bool(
+        Task.objects.filter(pk=task_id, status=Task.RUNNING, locked_by=worker_id)
+        .update(locked_until=timezone.now() + LEASE)
+    )
+
+
+def _heartbeat(task_id, worker_id, stop):
+    try:
+        while not stop.wait(HEARTBEAT.total_seconds()):
+            try:
+                if not renew_lease(task_id, worker_id):
+                    logger.warning("Task #%s is no longer held by worker %s", task_id, worker_id)
+                    return
+            except DatabaseError:
+                # Try again next beat; the lease has time to spare
+                logger.exception("Could not renew the lease on task #%s", task_id)
+    finally:
+        connection.close()
+
+
+@contextmanager
+def _holding_lease(task_id, worker_id):
+    # Keep the claim for as long as the task runs, however long that is
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(task_id, worker_id, stop),
+                                 name=f'{worker_id}-heartbeat', daemon=True)
+    heartbeat.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        heartbeat.join()
+
+
+def run_task(claimed, worker_id):
+    """Run a claimed task and record the outcome; returns True if it succeeded."""
+    registered = _registry.get(claimed.name)
+    started = time.perf_counter()
+    try:
+        if registered is None:
+            raise LookupError(f"No task registered as {claimed.name!r}")
+        with _holding_lease(claimed.pk, worker_id):
+            registered.func(*claimed.args, **claimed.kwargs)
+    except Exception as e:
+        elapsed = (time.perf_counter() - started) * 1000
+        attempts = claimed.attempts + 1
+        now = timezone.now()
+        if attempts < claimed.max_attempts:
+            outcome = {'status': Task.QUEUED, 'run_at': now + _retry_delay(attempts)}
+        else:
+            outcome = {'status': Task.FAILED, 'finished_at': now}
+        logger.exception("Task %s #%s failed after %.0f ms (attempt %d/%d)", claimed.name, claimed.pk, elapsed,
+                         attempts, claimed.max_attempts)
+        # Only if it is still ours; after a lapsed lease another worker owns the row
+        Task.objects.filter(pk=claimed.pk, locked_by=worker_id).update(
+            attempts=attempts, last_error=repr(e)[:2000], locked_by='', locked_until=None, **outcome,
+        )
+        return False
+
+    elapsed = (time.perf_counter() - started) * 1000
+    logger.info("Task %s #%s done in %.0f ms", claimed.name, claimed.pk, elapsed)
+    Task.objects.filter(pk=claimed.pk, locked_by=worker_id).update(
+        status=Task.DONE, attempts=claimed.attempts + 1, finished_at=timezone.now(), locked_by='', locked_until=None,
+    )
+    return True
+
+
+def work(worker_id, stop, idle=1.0, burst=False):
+    """
+    Claim and run tasks until `stop` (a threading.Event) is set, waiting
+    `idle` seconds whenever nothing is due. With burst=True, return as
+    soon as nothing is due.
+    """
+    try:
+        while not stop.is_set():
+            close_old_connections()
+            try:
+                claimed = claim(worker_id)
+                for claimed_task in claimed:
+                    run_task(claimed_task, worker_id)
+            except DatabaseError:
+                # e.g. a lock timeout; a task we couldn't mark finished is retried when its lease lapses
+                logger.exception("Task worker %s hit a database error", worker_id)
+                stop.wait(idle)
+                continue
+            if not claimed:
+                if burst:
+                    return
+                stop.wait(idle)
+    finally:
+        # Each worker thread has its own connection
+        connection.close()
+
+
+def purge_finished(older_than=RETENTION):
+    """Delete tasks that succeeded more than older_than ago; failed ones are kept."""
+    return Task.objects.filter(status=Task.DONE, finished_at__lt=timezone.now() - older_than).delete()[0]
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, math.ceil(len(values) * fraction) - 1)]
+
+
+def task_metrics(since):
+    """
+    Per task name, for tasks finished since `since`: how many succeeded and
+    failed for good, how many needed retries, and the wait (due -> started)
+    and run (started -> finished) times in ms. Also the current backlog.
+    """
+    rows = defaultdict(lambda: {'done': 0, 'failed': 0, 'retried': 0, 'wait_ms': [], 'run_ms': []})
+    finished = Task.objects.filter(finished_at__gte=since).values_list(
+        'name', 'status', 'attempts', 'run_at', 'started_at', 'finished_at',
+    )
+    for name, status, attempts, run_at, started_at, finished_at in finished.iterator():
+        row = rows[name]
+        row['done' if status == Task.DONE else 'failed'] += 1
+        row['retried'] += attempts > 1
+        if started_at:
+            row['wait_ms'].append(max(0, (started_at - run_at).total_seconds() * 1000))
+            row['run_ms'].append((finished_at - started_at).total_seconds() * 1000)
+
+    metrics = {}
+    for name, row in sorted(rows.items()):
+        metrics[name] = {
+            'done': row['done'],
+            'failed': row['failed'],
+            'retried': row['retried'],
+            'wait_p50_ms': _percentile(row['wait_ms'], 0.5),
+            'wait_p95_ms': _percentile(row['wait_ms'], 0.95),
+            'run_p50_ms': _percentile(row['run_ms'], 0.5),
+            'run_p95_ms': _percentile(row['run_ms'], 0.95),
+        }
+    due = Task.objects.filter(status=Task.QUEUED, run_at__lte=timezone.now())
+    oldest = due.order_by('run_at').values_list('run_at', flat=True).first()
+    backlog = {
+        'due': due.count(),
+        'oldest_due_s': (timezone.now() - oldest).total_seconds() if oldest else 0,
+    }
+    return metrics, backlog
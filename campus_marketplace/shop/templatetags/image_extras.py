@@ -0,0 +1,24 @@
+from django import template
+from django.utils.html import format_html
+
+from shop.images import derivative_srcsets
+
+register = template.Library()
+
+
+@register.simple_tag
+def responsive_image(image, alt='', sizes='100vw', css_class='', loading='lazy'):
+    """<picture> with WebP and JPEG srcsets for an ImageField value, or a plain <img> as fallback."""
+    if not image:
+        return ''
+    derivatives = derivative_srcsets(image.name)
+    if derivatives is None:
+        return format_html('<img src="{}" alt="{}" class="{}" loading="{}">', image.url, alt, css_class, loading)
+    srcsets, fallback = derivatives
+    return format_html(
+        '<picture style="display: contents">'
+        '<source type="image/webp" srcset="{}" sizes="{}">'
+        '<img src="{}" srcset="{}" sizes="{}" alt="{}" class="{}" loading="{}" decoding="async">'
+        '</picture>',
+        srcsets['webp'], sizes, fallback, srcsets['jpg'], sizes, alt, css_class, loading,
+    )
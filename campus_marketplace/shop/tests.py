@@ -1,3 +1,1233 @@
+import asyncio
+import io
+import json
+import re
+import smtplib
+import threading
+import time
+from email.mime.image import MIMEImage
+from unittest import mock
+from datetime import timedelta
+from decimal import Decimal
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.files.base import ContentFile
+from django.core.files.storage import InMemoryStorage
+from django.core.mail import EmailMessage
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db import connection, transaction
+from PIL import Image
+import requests
 from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from campus_marketplace.services import lalamove_service
+from campus_marketplace.services.http_client import (
+    DEFAULTS, AsyncServiceClient, CircuitBreaker, ServiceClient, ServiceUnavailable,
+)
+from campus_marketplace.services.lalamove_service import create_lalamove_order
+
+from . import autocomplete, images, mail, reconcile, shipping, taskqueue, webhooks
+from .caching import get_product_detail
+from .cart import GUEST_CART_COOKIE, Cart, GuestCart
+from .management.commands.benchmark_shipping_quotes import StubLalamove, StubServer
+from .facets import facet_counts, filter_conditions, parse_filters
+from .models import (
+    AutocompleteChange, CartItem, Category, ImageDerivative, Message, Order, OrderItem, OutgoingEmail, Product, Profile,
+    ShippingEstimate, ShippingQuoteStat, StockReservation, Task, WebhookEvent, available_stock,
+)
+from .orders import (
+    INVOICE_DURATION, RESERVATION_GRACE, InsufficientStock, confirm_order, place_order, release_expired_reservations,
+    release_order, reserve_order,
+)
+from .views import out_of_stock_message
+from .webhooks import XENDIT
+from .pagination import KeysetPaginator
+
+
+class HotQueryPlanTests(TestCase):
+    """
+    EXPLAIN the hot lookups from shop/views.py and fail if any of them
+    reads a whole table instead of going through an index.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user(username='seller')
+        cls.buyer = User.objects.create_user(username='buyer')
+        cls.category = Category.objects.create(name='Books', slug='books')
+        cls.product = Product.objects.create(name='Notebook', price=50, category=cls.category, seller=cls.seller)
+        order = Order.objects.create(user=cls.buyer, total=50)
+        OrderItem.objects.create(order=order, product=cls.product, quantity=1, price_each=50)
+        CartItem.objects.create(user=cls.buyer, product=cls.product)
+        Message.objects.create(sender=cls.buyer, recipient=cls.seller, subject='Hi', message='Still available?')
+
+    def explain(self, queryset):
+        if connection.vendor == 'postgresql':
+            # Tiny test tables make a seq scan the cheapest plan; ask whether an index path exists at all
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute('SET LOCAL enable_seqscan = off')
+                return queryset.explain()
+        return queryset.explain()
+
+    def assertUsesIndexes(self, queryset):
+        plan = self.explain(queryset)
+        if connection.vendor == 'postgresql':
+            full_scans = re.findall(r'Seq Scan on \w+', plan)
+        else:
+            # SQLite: "SEARCH t USING INDEX ..." is a lookup, "SCAN t [USING INDEX ...]" reads everything
+            full_scans = [line for line in plan.splitlines() if re.search(r'\bSCAN (?!CONSTANT ROW)', line)]
+        self.assertFalse(full_scans, f"Full scan in query plan:\n{plan}\n\n{queryset.query}")
+
+    def test_cart_items(self):
+        self.assertUsesIndexes(CartItem.objects.filter(user=self.buyer))
+
+    def test_in_cart(self):
+        self.assertUsesIndexes(CartItem.objects.filter(user=self.buyer, product=self.product))
+
+    def test_category_products(self):
+        self.assertUsesIndexes(Product.objects.filter(category=self.category).order_by('-created_at', '-id'))
+
+    def test_seller_products(self):
+        self.assertUsesIndexes(Product.objects.filter(seller=self.seller).order_by('-created_at', '-id'))
+
+    def test_seller_orders(self):
+        self.assertUsesIndexes(
+            Order.objects.filter(
+                id__in=OrderItem.objects.filter(product__seller=self.seller).values('order_id')
+            ).select_related('user')
+        )
+
+    def test_seller_dashboard_orders(self):
+        self.assertUsesIndexes(
+            Order.objects.filter(items__product__seller=self.seller).distinct().order_by('-placed_at')
+        )
+
+    def test_seller_order_items(self):
+        self.assertUsesIndexes(OrderItem.objects.filter(product__seller=self.seller))
+
+    def test_customer_orders(self):
+        self.assertUsesIndexes(Order.objects.filter(user=self.buyer).order_by('-placed_at'))
+
+    def test_inbox(self):
+        self.assertUsesIndexes(Message.objects.filter(recipient=self.seller).order_by('-created_at'))
+
+    def test_unread_messages(self):
+        self.assertUsesIndexes(Message.objects.filter(recipient=self.seller, is_read=False))
+
+
+class KeysetPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        seller = User.objects.create_user(username='seller')
+        category = Category.objects.create(name='Books', slug='books')
+        cls.products = [
+            Product.objects.create(name=f'Book {i}', price=10, category=category, seller=seller) for i in range(5)
+        ]
+
+    def paginator(self):
+        return KeysetPaginator(Product.objects.all(), ('-created_at', '-id'), per_page=2)
+
+    def test_next_and_previous_cursors_walk_every_row_once(self):
+        newest_first = [p.pk for p in sorted(self.products, key=lambda p: (p.created_at, p.pk), reverse=True)]
+        pages = [self.paginator().page()]
+        while pages[-1].has_next:
+            pages.append(self.paginator().page(pages[-1].next_cursor))
+        self.assertEqual([p.pk for page in pages for p in page], newest_first)
+        self.assertFalse(pages[0].has_previous)
+
+        back = self.paginator().page(pages[-1].previous_cursor)
+        self.assertEqual([p.pk for p in back], [p.pk for p in pages[-2]])
+        self.assertTrue(back.has_next)
+
+    def test_bad_cursor_starts_over(self):
+        self.assertEqual(
+            [p.pk for p in self.paginator().page('not-a-cursor')], [p.pk for p in self.paginator().page()]
+        )
+
+
+class ProductSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        seller = User.objects.create_user(username='seller')
+        category = Category.objects.create(name='Books', slug='books')
+        cls.in_name = Product.objects.create(name='Calculus textbook', description='Hardcover', price=10,
+                                             category=category, seller=seller)
+        cls.in_description = Product.objects.create(name='Notebook', description='Pairs well with a textbook',
+                                                    price=10, category=category, seller=seller)
+        Product.objects.create(name='Lamp', price=10, category=category, seller=seller)
+
+    def test_best_match_comes_first(self):
+        response = self.client.get(reverse('product_list'), {'q': 'textbook'})
+        self.assertEqual([p.pk for p in response.context['products']], [self.in_name.pk, self.in_description.pk])
+
+
+class FacetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        seller = User.objects.create_user(username='seller')
+        cls.books = Category.objects.create(name='Books', slug='books')
+        cls.gadgets = Category.objects.create(name='Gadgets', slug='gadgets')
+        Product.objects.create(name='Novel', price=50, stock=1, category=cls.books, seller=seller)
+        Product.objects.create(name='Atlas', price=200, stock=0, category=cls.books, seller=seller)
+        Product.objects.create(name='Phone', price=200, stock=1, category=cls.gadgets, seller=seller)
+
+    def facets(self, params):
+        categories = list(Category.objects.order_by('pk'))
+        filters = parse_filters(params, categories)
+        buckets = facet_counts(Product.objects.with_available_stock(), categories, filters)
+        return filters, {c.slug: c.facet_count for c in categories}, [b['count'] for b in buckets]
+
+    def test_each_facet_ignores_its_own_filter(self):
+        filters, categories, buckets = self.facets({'category': 'books', 'min_price': '100', 'max_price': '499.99'})
+        # Category counts honour the price filter, price counts honour the category filter
+        self.assertEqual(categories, {'books': 1, 'gadgets': 1})
+        self.assertEqual(buckets, [1, 1, 0, 0, 0])
+        self.assertEqual(list(Product.objects.filter(*filter_conditions(filters)).values_list('name', flat=True)),
+                         ['Atlas'])
+
+    def test_other_filters_narrow_every_facet(self):
+        _, categories, buckets = self.facets({'in_stock': '1'})
+        self.assertEqual(categories, {'books': 1, 'gadgets': 1})
+        self.assertEqual(buckets, [1, 1, 0, 0, 0])
+
+    def test_invalid_values_are_ignored(self):
+        filters, _, _ = self.facets({'category': 'nope', 'min_price': '-5', 'max_price': 'NaN'})
+        self.assertEqual((filters['category'], filters['min_price'], filters['max_price']), (None, None, None))
+
+
+class AutocompleteTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user(username='seller')
+        cls.category = Category.objects.create(name='Books', slug='books')
+
+    def setUp(self):
+        # The index is per process and outlives each test's rollback
+        autocomplete._loaded = False
+        self.addCleanup(setattr, autocomplete, '_loaded', False)
+
+    def test_saving_a_product_updates_the_loaded_index(self):
+        autocomplete.get_index()
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.create(name='Graphing calculator', price=10, category=self.category, seller=self.seller)
+        self.assertEqual([label for _, _, label, _ in autocomplete.suggest('calc')], ['Graphing calculator'])
+
+    def test_a_change_from_another_process_is_patched_in_without_a_rebuild(self):
+        autocomplete.get_index()
+        # As if the product were saved by another process: recorded, but not applied here
+        loaded, autocomplete._loaded = autocomplete._loaded, False
+        try:
+            with self.captureOnCommitCallbacks(execute=True):
+                Product.objects.create(name='Desk lamp', price=10, category=self.category, seller=self.seller)
+        finally:
+            autocomplete._loaded = loaded
+        self.assertEqual(autocomplete.suggest('desk'), [])
+        autocomplete._checked_at = float('-inf')
+        with mock.patch.object(autocomplete, '_load_index') as load_index:
+            self.assertEqual([label for _, _, label, _ in autocomplete.suggest('desk')], ['Desk lamp'])
+        load_index.assert_not_called()
+
+    def test_a_deleted_product_is_removed(self):
+        product = Product.objects.create(name='Desk lamp', price=10, category=self.category, seller=self.seller)
+        product_id = product.pk
+        autocomplete.get_index()
+        with self.captureOnCommitCallbacks(execute=True):
+            product.delete()
+        self.assertEqual(autocomplete.suggest('desk'), [])
+        self.assertTrue(AutocompleteChange.objects.filter(kind='product', object_id=product_id).exists())
+
+    def test_saving_without_renaming_records_nothing(self):
+        product = Product.objects.create(name='Desk lamp', price=10, category=self.category, seller=self.seller)
+        product = Product.objects.get(pk=product.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            product.price = 12
+            product.save()
+            self.category.icon = '📚'
+            self.category.save()
+        self.assertFalse(AutocompleteChange.objects.exists())
+
+    def test_lookups_between_syncs_stay_in_memory(self):
+        autocomplete.get_index()
+        with self.assertNumQueries(0):
+            autocomplete.suggest('boo')
+            autocomplete.suggest('book')
+
+    def test_a_process_that_has_not_looked_for_too_long_rebuilds(self):
+        autocomplete.get_index()
+        autocomplete._synced_to -= autocomplete.CHANGES_KEPT
+        autocomplete._checked_at = float('-inf')
+        with mock.patch.object(autocomplete, '_load_index') as load_index:
+            autocomplete.get_index()
+        load_index.assert_called_once_with()
+
+
+class ImageDerivativeTests(TestCase):
+    def setUp(self):
+        self.storage = InMemoryStorage()
+        buffer = io.BytesIO()
+        Image.new('RGB', (40, 30), 'red').save(buffer, 'PNG')
+        self.name = self.storage.save('products/shoe.png', ContentFile(buffer.getvalue()))
+        self.addCleanup(cache.delete, images._ready_key(self.name))
+
+    def test_generating_records_the_names_in_the_database(self):
+        self.assertEqual(images.generate_derivatives(self.name, storage=self.storage), 6)
+        names = ImageDerivative.objects.get(original=self.name).names
+        self.assertEqual(names['medium.jpg'], 'products/shoe_medium.jpg')
+        self.assertTrue(all(self.storage.exists(stored) for stored in names.values()))
+
+    def test_a_culled_cache_entry_is_read_back_from_the_database(self):
+        images.generate_derivatives(self.name, storage=self.storage)
+        cache.delete(images._ready_key(self.name))
+        with mock.patch.object(images.build_derivatives, 'enqueue') as enqueue, \
+                mock.patch.object(images.default_storage, 'exists') as exists:
+            srcsets, fallback = images.derivative_srcsets(self.name)
+        enqueue.assert_not_called()
+        exists.assert_not_called()
+        self.assertIn('shoe_thumb.webp 320w', srcsets['webp'])
+        self.assertTrue(fallback.endswith('shoe_medium.jpg'))
+        self.assertEqual(cache.get(images._ready_key(self.name))['medium.jpg'], 'products/shoe_medium.jpg')
+
+    def test_an_unknown_image_is_queued_once(self):
+        cache.delete(f'{images._ready_key(self.name)}:queued')
+        self.addCleanup(cache.delete, f'{images._ready_key(self.name)}:queued')
+        with mock.patch.object(images.build_derivatives, 'enqueue') as enqueue:
+            self.assertIsNone(images.derivative_srcsets(self.name))
+            self.assertIsNone(images.derivative_srcsets(self.name))
+        enqueue.assert_called_once_with(self.name)
+
+
+class PlaceOrderTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user(username='seller')
+        cls.buyer = User.objects.create_user(username='buyer')
+        category = Category.objects.create(name='Books', slug='books')
+        cls.pen = Product.objects.create(name='Pen', price=Decimal('10.00'), stock=5, category=category,
+                                         seller=cls.seller)
+        cls.ink = Product.objects.create(name='Ink', price=Decimal('20.00'), stock=1, category=category,
+                                         seller=cls.seller)
+
+    def test_order_takes_stock_and_empties_the_cart(self):
+        CartItem.objects.create(user=self.buyer, product=self.pen, quantity=2)
+        CartItem.objects.create(user=self.buyer, product=self.ink, quantity=1)
+        order = place_order(Cart(self.buyer), Decimal('50.00'))
+
+        # 40.00 subtotal, 5% tax, 50.00 shipping
+        self.assertEqual(order.total, Decimal('92.00'))
+        self.assertEqual(sorted(order.items.values_list('product__name', 'quantity')), [('Ink', 1), ('Pen', 2)])
+        self.assertEqual(Product.objects.get(pk=self.pen.pk).stock, 3)
+        self.assertEqual(Product.objects.get(pk=self.ink.pk).stock, 0)
+        self.assertEqual(Profile.objects.get(user=self.seller).total_sales, 3)
+        self.assertFalse(CartItem.objects.filter(user=self.buyer).exists())
+
+    def test_one_short_product_rolls_back_everything(self):
+        CartItem.objects.create(user=self.buyer, product=self.pen, quantity=2)
+        CartItem.objects.create(user=self.buyer, product=self.ink, quantity=2)
+        with self.assertRaises(InsufficientStock) as raised:
+            place_order(Cart(self.buyer), Decimal('50.00'))
+
+        self.assertEqual(raised.exception.products, [self.ink])
+        self.assertEqual(Product.objects.get(pk=self.pen.pk).stock, 5)
+        self.assertFalse(Order.objects.filter(user=self.buyer).exists())
+        self.assertEqual(CartItem.objects.filter(user=self.buyer).count(), 2)
+
+    def test_shortage_message_without_names(self):
+        self.assertEqual(out_of_stock_message(InsufficientStock([self.ink])), 'Not enough stock left for: Ink.')
+        # After a race the recheck can find nothing short
+        self.assertEqual(out_of_stock_message(InsufficientStock([])), 'Some items in your cart just ran out of stock.')
+
+
+class StockHoldTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user(username='seller')
+        cls.buyer = User.objects.create_user(username='buyer')
+        cls.other = User.objects.create_user(username='other')
+        category = Category.objects.create(name='Books', slug='books')
+        cls.pen = Product.objects.create(name='Pen', price=Decimal('10.00'), stock=3, category=category,
+                                         seller=cls.seller)
+
+    def available(self):
+        return Product.objects.annotate(available=available_stock()).get(pk=self.pen.pk).available
+
+    def reserve(self, user, quantity, external_id):
+        CartItem.objects.update_or_create(user=user, product=self.pen, defaults={'quantity': quantity})
+        return reserve_order(Cart(user), '0', external_id=external_id)
+
+    def test_hold_keeps_units_from_other_buyers(self):
+        order = self.reserve(self.buyer, 2, 'ORDER-1')
+        self.assertEqual(order.status, 'pending')
+        self.assertEqual(self.available(), 1)
+        # Stock itself only moves on payment, and the buyer's cart stays until then
+        self.assertEqual(Product.objects.get(pk=self.pen.pk).stock, 3)
+        self.assertTrue(CartItem.objects.filter(user=self.buyer).exists())
+        with self.assertRaises(InsufficientStock):
+            self.reserve(self.other, 2, 'ORDER-2')
+
+    def test_confirm_turns_the_hold_into_a_sale(self):
+        order = self.reserve(self.buyer, 2, 'ORDER-1')
+        confirm_order(order)
+        self.assertEqual(Product.objects.get(pk=self.pen.pk).stock, 1)
+        self.assertFalse(StockReservation.objects.filter(order=order).exists())
+        self.assertEqual(self.available(), 1)
+
+    def test_release_gives_the_units_back(self):
+        order = self.reserve(self.buyer, 2, 'ORDER-1')
+        release_order(order)
+        self.assertEqual(self.available(), 3)
+
+    def test_expired_holds_stop_counting_and_are_swept(self):
+        order = self.reserve(self.buyer, 2, 'ORDER-1')
+        StockReservation.objects.filter(order=order).update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.available(), 3)
+        self.assertEqual(release_expired_reservations(), 1)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_pages_show_stock_less_holds(self):
+        self.reserve(self.buyer, 2, 'ORDER-1')
+        CartItem.objects.create(user=self.other, product=self.pen, quantity=1)
+        self.client.force_login(self.other)
+        detail = self.client.get(reverse('product_detail', args=[self.pen.pk]))
+        self.assertEqual(detail.context['available_stock'], 1)
+        listing = self.client.get(reverse('product_list'))
+        self.assertEqual([p.available_stock for p in listing.context['products']], [1])
+        cart = self.client.get(reverse('cart'))
+        self.assertEqual([line.available_stock for line in cart.context['cart_items']], [1])
+
+    def test_the_in_stock_filter_leaves_out_fully_held_products(self):
+        self.reserve(self.buyer, 3, 'ORDER-1')
+        response = self.client.get(reverse('product_list'), {'in_stock': '1'})
+        self.assertEqual(list(response.context['products']), [])
+
+    def test_a_new_hold_changes_the_product_page_etag(self):
+        url = reverse('product_detail', args=[self.pen.pk])
+        etag = self.client.get(url)['ETag']
+        self.reserve(self.buyer, 2, 'ORDER-1')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class GuestCartTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        seller = User.objects.create_user(username='seller')
+        cls.buyer = User.objects.create_user(username='buyer', password='pw-12345')
+        category = Category.objects.create(name='Books', slug='books')
+        cls.pen = Product.objects.create(name='Pen', price=Decimal('10.00'), stock=5, category=category, seller=seller)
+        cls.ink = Product.objects.create(name='Ink', price=Decimal('20.00'), stock=5, category=category, seller=seller)
+
+    def test_guest_sees_the_cart_they_filled(self):
+        self.client.get(reverse('add_to_cart', args=[self.pen.pk]))
+        response = self.client.get(reverse('add_to_cart', args=[self.pen.pk]), follow=True)
+        self.assertEqual(response.redirect_chain[-1][0], reverse('cart'))
+        self.assertEqual([(line.product, line.quantity) for line in response.context['guest_lines']], [(self.pen, 2)])
+        self.assertEqual(response.context['guest_subtotal'], '20.00')
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_merge_adds_to_what_is_already_in_the_cart(self):
+        CartItem.objects.create(user=self.buyer, product=self.pen, quantity=3)
+        merged = GuestCart({self.pen.pk: 2, self.ink.pk: 1, 999999: 4}).merge_into(self.buyer)
+        self.assertEqual(merged, 3)
+        self.assertEqual(
+            dict(CartItem.objects.filter(user=self.buyer).values_list('product_id', 'quantity')),
+            {self.pen.pk: 5, self.ink.pk: 1},
+        )
+
+    def test_logging_in_merges_and_clears_the_cookie(self):
+        self.client.get(reverse('add_to_cart', args=[self.ink.pk]))
+        response = self.client.post(reverse('login'), {'username': 'buyer', 'password': 'pw-12345'})
+        self.assertEqual(CartItem.objects.get(user=self.buyer).product, self.ink)
+        self.assertEqual(response.cookies[GUEST_CART_COOKIE].value, '')
+
+
+class CartItemApiTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        seller = User.objects.create_user(username='seller')
+        cls.buyer = User.objects.create_user(username='buyer')
+        category = Category.objects.create(name='Books', slug='books')
+        cls.pen = Product.objects.create(name='Pen', price=Decimal('10.00'), stock=3, category=category, seller=seller)
+
+    def setUp(self):
+        self.line = CartItem.objects.create(user=self.buyer, product=self.pen, quantity=1)
+        self.client.force_login(self.buyer)
+
+    def post(self, line_id=None, **body):
+        return self.client.post(reverse('cart_item_api', args=[line_id or self.line.pk]), json.dumps(body),
+                                content_type='application/json')
+
+    def test_set_returns_the_new_totals(self):
+        data = self.post(action='set', quantity=2).json()
+        self.assertEqual(data['item']['quantity'], 2)
+        self.assertEqual((data['subtotal'], data['tax'], data['total']), ('20.00', '1.00', '21.00'))
+        self.assertEqual(data['cart_count'], 2)
+
+    def test_quantity_is_kept_between_one_and_the_available_stock(self):
+        self.assertEqual(self.post(action='set', quantity=10 ** 12).json()['item']['quantity'], 3)
+        self.assertEqual(self.post(action='increase').json()['item']['quantity'], 3)
+        self.assertEqual(self.post(action='set', quantity=-5).json()['item']['quantity'], 1)
+        self.assertEqual(self.post(action='decrease').json()['item']['quantity'], 1)
+
+    def test_remove(self):
+        data = self.post(action='remove').json()
+        self.assertIsNone(data['item'])
+        self.assertEqual(data['line_count'], 0)
+
+    def test_bad_requests(self):
+        self.assertEqual(self.post(action='explode').status_code, 400)
+        self.assertEqual(self.post(action='set', quantity='many').status_code, 400)
+        someone_else = CartItem.objects.create(user=User.objects.create_user(username='other'), product=self.pen)
+        self.assertEqual(self.post(someone_else.pk, action='increase').status_code, 404)
+        self.assertEqual(CartItem.objects.get(pk=someone_else.pk).quantity, 1)
+
+
+class FakeXenditResponse:
+    def __init__(self, payload, status_code=200):
+        self.payload = payload
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(response=self)
+
+    def json(self):
+        return self.payload
+
+
+class FakeXenditClient:
+    """
+    Stands in for get_client('xendit'): answers every invoice POST with
+    `response`, and invoice lookups with `invoices`.
+    """
+
+    def __init__(self, response, invoices=()):
+        self.response = response
+        self.invoices = list(invoices)
+        self.calls = []
+
+    def post(self, url, **kwargs):
+        self.calls.append(json.loads(kwargs['data']))
+        if isinstance(self.response, Exception):
+            raise self.response
+        return self.response
+
+    def get(self, url, **kwargs):
+        return FakeXenditResponse(self.invoices)
+
+
+class PayIdempotencyTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        seller = User.objects.create_user(username='seller')
+        cls.buyer = User.objects.create_user(username='buyer', email='buyer@example.com')
+        category = Category.objects.create(name='Books', slug='books')
+        cls.pen = Product.objects.create(name='Pen', price=Decimal('10.00'), stock=3, category=category, seller=seller)
+
+    def setUp(self):
+        CartItem.objects.create(user=self.buyer, product=self.pen, quantity=2)
+        self.client.force_login(self.buyer)
+
+    def pay(self, xendit, **headers):
+        with mock.patch('shop.views.get_client', return_value=xendit), \
+                mock.patch('shop.reconcile.get_client', return_value=xendit):
+            return self.client.post(reverse('create_payment_intent'),
+                                    json.dumps({'shipping_method': 'pickup', 'final_total': '21.00'}),
+                                    content_type='application/json', **headers)
+
+    def invoice(self):
+        return FakeXenditResponse({'id': 'inv-1', 'invoice_url': 'https://pay.example/inv-1'})
+
+    def test_same_key_reuses_the_order_and_invoice(self):
+        xendit = FakeXenditClient(self.invoice())
+        first = self.pay(xendit, HTTP_IDEMPOTENCY_KEY='abc').json()
+        second = self.pay(xendit, HTTP_IDEMPOTENCY_KEY='abc').json()
+        self.assertEqual(first, second)
+        self.assertEqual(first['redirect_url'], 'https://pay.example/inv-1')
+        self.assertEqual(len(xendit.calls), 1)
+        self.assertEqual(Order.objects.filter(user=self.buyer).count(), 1)
+
+    def test_same_cart_without_a_key_reuses_the_order(self):
+        xendit = FakeXenditClient(self.invoice())
+        self.pay(xendit)
+        self.pay(xendit)
+        self.assertEqual(len(xendit.calls), 1)
+
+    def test_gateway_error_cancels_the_order_and_frees_the_stock(self):
+        with self.assertLogs('shop.views', 'WARNING'):
+            response = self.pay(FakeXenditClient(requests.exceptions.ConnectionError()))
+        self.assertEqual(response.status_code, 500)
+        order = Order.objects.get(user=self.buyer)
+        self.assertEqual(order.status, 'cancelled')
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_no_answer_keeps_the_order_for_a_retry_to_pick_up(self):
+        with self.assertLogs('shop.views', 'WARNING'):
+            response = self.pay(FakeXenditClient(requests.exceptions.ReadTimeout()))
+        self.assertEqual(response.status_code, 503)
+        order = Order.objects.get(user=self.buyer)
+        self.assertEqual(order.status, 'pending')
+        self.assertTrue(StockReservation.objects.filter(order=order).exists())
+
+        # Xendit made the invoice after all: the retry sends the buyer to it, not to a second one
+        xendit = FakeXenditClient(self.invoice(), invoices=[
+            {'id': 'inv-1', 'status': 'PENDING', 'invoice_url': 'https://pay.example/inv-1'},
+        ])
+        retry = self.pay(xendit)
+        self.assertEqual(retry.json()['redirect_url'], 'https://pay.example/inv-1')
+        self.assertEqual(xendit.calls, [])
+        self.assertEqual(Order.objects.filter(user=self.buyer).count(), 1)
+
+    def test_a_server_error_keeps_the_order_too(self):
+        with self.assertLogs('shop.views', 'WARNING'):
+            response = self.pay(FakeXenditClient(FakeXenditResponse({}, status_code=502)))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(Order.objects.get(user=self.buyer).status, 'pending')
+        # Until Xendit shows an invoice, a retry waits rather than opening another
+        retry = self.pay(FakeXenditClient(self.invoice()))
+        self.assertEqual(retry.status_code, 409)
+
+    def test_unexpected_reply_cancels_the_order_so_a_retry_can_pay(self):
+        with self.assertLogs('shop.views', 'ERROR'):
+            response = self.pay(FakeXenditClient(FakeXenditResponse({'id': 'inv-1'})))
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(Order.objects.get(user=self.buyer).status, 'cancelled')
+        self.assertFalse(StockReservation.objects.exists())
+
+        retry = self.pay(FakeXenditClient(self.invoice()))
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(Order.objects.filter(user=self.buyer, status='pending').count(), 1)
+
+
+class LalamoveCheckoutTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        seller = User.objects.create_user(username='seller')
+        cls.buyer = User.objects.create_user(username='buyer', email='buyer@example.com')
+        category = Category.objects.create(name='Books', slug='books')
+        cls.pen = Product.objects.create(name='Pen', price=Decimal('10.00'), stock=3, category=category, seller=seller)
+        ShippingEstimate.objects.create(service_type='MOTORCYCLE', fee=Decimal('80.00'))
+
+    def setUp(self):
+        cache.clear()
+        CartItem.objects.create(user=self.buyer, product=self.pen, quantity=2)
+        self.client.force_login(self.buyer)
+
+    def live_quote(self):
+        quote = {'fee': '120.00', 'currency': 'PHP', 'quoteId': 'q-1', 'expiresAt': None,
+                 'scheduleAt': '2026-01-01T00:00:00.000Z', 'distance': None}
+        with mock.patch('shop.shipping._fetch', return_value=quote):
+            return shipping.get_quote('1 Ayala Ave, Makati', 'MOTORCYCLE')
+
+    def pay(self, **body):
+        xendit = FakeXenditClient(FakeXenditResponse({'id': 'inv-1', 'invoice_url': 'https://pay.example/inv-1'}))
+        with mock.patch('shop.views.get_client', return_value=xendit):
+            return self.client.post(reverse('create_payment_intent'),
+                                    json.dumps({'shipping_method': 'lalamove', 'final_total': '21.00', **body}),
+                                    content_type='application/json')
+
+    def test_estimates_are_not_bookable(self):
+        estimates = async_to_sync(shipping.aestimates)('1 Ayala Ave, Makati', ['MOTORCYCLE'])
+        self.assertIsNone(estimates['MOTORCYCLE']['quoteId'])
+        self.assertFalse(estimates['MOTORCYCLE']['bookable'])
+
+    def test_live_quotes_are_kept_by_their_id(self):
+        self.live_quote()
+        self.assertEqual(shipping.bookable_quote('q-1')['fee'], '120.00')
+        self.assertIsNone(shipping.bookable_quote(None))
+        self.assertIsNone(shipping.bookable_quote('unknown'))
+
+    def test_checkout_without_a_live_quote_is_refused(self):
+        response = self.pay(shipping_cost=80)
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(Order.objects.exists())
+
+    def test_checkout_charges_the_quoted_fee(self):
+        self.live_quote()
+        response = self.pay(shipping_cost=1, lalamove_quote_id='q-1')
+        self.assertEqual(response.status_code, 200)
+        # 20.00 + 5% tax + the quoted 120.00, whatever the browser claimed
+        self.assertEqual(Order.objects.get(user=self.buyer).total, Decimal('141.00'))
+
+    def test_lalamove_order_needs_a_quotation(self):
+        with self.assertRaises(ValueError):
+            create_lalamove_order({'data': {'quotationId': None}})
+
+
+class WebhookRetryTests(TestCase):
+    def setUp(self):
+        self.event = WebhookEvent.objects.create(provider=XENDIT, event_id='inv-1', status='PAID',
+                                                 external_id='ORDER-1', payload={})
+
+    def test_a_failing_event_backs_off_instead_of_retrying_at_once(self):
+        with mock.patch('shop.webhooks.apply_event', side_effect=RuntimeError('db down')), \
+                self.assertLogs('shop.webhooks', 'ERROR'):
+            webhooks.apply_webhook_events()
+        self.event.refresh_from_db()
+        self.assertEqual(self.event.attempts, 1)
+        self.assertGreater(self.event.next_attempt_at, timezone.now())
+        self.assertFalse(webhooks.pending_events().exists())
+
+    def test_the_next_run_is_scheduled_for_when_a_retry_is_due(self):
+        with mock.patch('shop.webhooks.apply_event', side_effect=RuntimeError('db down')), \
+                self.assertLogs('shop.webhooks', 'ERROR'):
+            webhooks.apply_webhook_events()
+            webhooks.apply_webhook_events()
+        self.event.refresh_from_db()
+        scheduled = Task.objects.get(name=webhooks.apply_webhook_events.name, status=Task.QUEUED)
+        self.assertEqual(scheduled.run_at, self.event.next_attempt_at)
+
+    def test_nothing_is_scheduled_once_the_inbox_is_applied(self):
+        webhooks.apply_webhook_events()
+        self.event.refresh_from_db()
+        self.assertIsNotNone(self.event.processed_at)
+        self.assertFalse(Task.objects.exists())
+
+
+@taskqueue.task(name='shop.tests.flaky', max_attempts=2)
+def flaky(fail=False, sleep=0):
+    time.sleep(sleep)
+    if fail:
+        raise RuntimeError('flaky')
+
+
+class TaskQueueTests(TestCase):
+    def test_a_claimed_task_is_not_claimed_again(self):
+        queued = flaky.enqueue()
+        self.assertEqual(taskqueue.claim('w1'), [queued])
+        self.assertEqual(taskqueue.claim('w2'), [])
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.locked_by), (Task.RUNNING, 'w1'))
+
+    def test_a_future_task_waits_for_its_time(self):
+        flaky.schedule(delay=60)
+        self.assertEqual(taskqueue.claim('w1'), [])
+
+    def test_a_failed_task_is_retried_later_then_given_up(self):
+        queued = flaky.enqueue(fail=True)
+        with self.assertLogs('shop.taskqueue', 'ERROR'):
+            self.assertFalse(taskqueue.run_task(taskqueue.claim('w1')[0], 'w1'))
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts, queued.locked_by), (Task.QUEUED, 1, ''))
+        self.assertGreater(queued.run_at, timezone.now())
+
+        Task.objects.filter(pk=queued.pk).update(run_at=timezone.now())
+        with self.assertLogs('shop.taskqueue', 'ERROR'):
+            taskqueue.run_task(taskqueue.claim('w1')[0], 'w1')
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), (Task.FAILED, 2))
+
+    def test_a_lapsed_lease_is_taken_over(self):
+        queued = flaky.enqueue()
+        taskqueue.claim('w1')
+        Task.objects.filter(pk=queued.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(taskqueue.claim('w2'), [queued])
+        # The first worker can neither renew it nor record its outcome any more
+        self.assertFalse(taskqueue.renew_lease(queued.pk, 'w1'))
+        self.assertTrue(taskqueue.run_task(queued, 'w1'))
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.locked_by), (Task.RUNNING, 'w2'))
+
+    def test_the_lease_is_renewed_while_the_task_runs(self):
+        queued = flaky.enqueue(sleep=0.2)
+        claimed = taskqueue.claim('w1')[0]
+        with mock.patch('shop.taskqueue.HEARTBEAT', timedelta(seconds=0.02)), \
+                mock.patch('shop.taskqueue.renew_lease', return_value=True) as renew:
+            self.assertTrue(taskqueue.run_task(claimed, 'w1'))
+        renew.assert_called_with(queued.pk, 'w1')
+        self.assertGreater(renew.call_count, 2)
+
+    def test_renewing_pushes_the_lease_back(self):
+        queued = flaky.enqueue()
+        taskqueue.claim('w1')
+        Task.objects.filter(pk=queued.pk).update(locked_until=timezone.now())
+        self.assertTrue(taskqueue.renew_lease(queued.pk, 'w1'))
+        queued.refresh_from_db()
+        self.assertGreater(queued.locked_until, timezone.now() + taskqueue.LEASE - timedelta(seconds=5))
+
+
+class RefusingEmailBackend(BaseEmailBackend):
+    """Delivery backend whose server turns every message down."""
+
+    def send_messages(self, email_messages):
+        raise smtplib.SMTPDataError(451, 'try again later')
+
+
+class UnreachableEmailBackend(BaseEmailBackend):
+    """Delivery backend whose server can't be reached."""
+
+    def open(self):
+        raise ConnectionRefusedError('smtp down')
+
+
+class OutboxRetryTests(TestCase):
+    def setUp(self):
+        self.email = OutgoingEmail.objects.create(subject='Hi', body='Hello', from_email='shop@example.com',
+                                                  to=['buyer@example.com'])
+
+    def drain(self, backend):
+        return mail.drain_outbox(rate=0, backend=f'shop.tests.{backend.__name__}')
+
+    def test_a_failed_message_backs_off_instead_of_retrying_at_once(self):
+        with self.assertLogs('shop.mail', 'ERROR'):
+            self.assertEqual(self.drain(RefusingEmailBackend), (0, 1))
+        self.email.refresh_from_db()
+        self.assertEqual((self.email.status, self.email.attempts), (OutgoingEmail.QUEUED, 1))
+        self.assertGreater(self.email.next_attempt_at, timezone.now())
+        # Not due yet, so the next drain leaves it alone
+        self.assertEqual(self.drain(RefusingEmailBackend), (0, 0))
+
+    def test_a_message_is_given_up_after_max_attempts(self):
+        OutgoingEmail.objects.filter(pk=self.email.pk).update(attempts=mail.MAX_ATTEMPTS - 1)
+        with self.assertLogs('shop.mail', 'ERROR'):
+            self.drain(RefusingEmailBackend)
+        self.email.refresh_from_db()
+        self.assertEqual(self.email.status, OutgoingEmail.FAILED)
+
+    def test_an_unreachable_server_hands_the_batch_back(self):
+        with self.assertRaises(ConnectionRefusedError):
+            self.drain(UnreachableEmailBackend)
+        self.email.refresh_from_db()
+        self.assertEqual((self.email.status, self.email.claimed_by, self.email.attempts), (OutgoingEmail.QUEUED, '', 0))
+        self.assertGreater(self.email.next_attempt_at, timezone.now())
+
+    def test_send_outbox_is_scheduled_while_mail_waits_for_a_retry(self):
+        with mock.patch('shop.mail.DELIVERY_BACKEND', 'shop.tests.UnreachableEmailBackend'), \
+                self.assertRaises(ConnectionRefusedError):
+            mail.send_outbox()
+        self.email.refresh_from_db()
+        scheduled = Task.objects.get(name=mail.send_outbox.name, status=Task.QUEUED)
+        self.assertEqual(scheduled.run_at, self.email.next_attempt_at)
+
+    def test_nothing_is_scheduled_once_the_outbox_is_sent(self):
+        with mock.patch('shop.mail.DELIVERY_BACKEND', 'django.core.mail.backends.locmem.EmailBackend'):
+            mail.send_outbox()
+        self.email.refresh_from_db()
+        self.assertEqual(self.email.status, OutgoingEmail.SENT)
+        self.assertFalse(Task.objects.exists())
+
+
+class OutboxTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(mail.send_outbox, 'enqueue')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_notifications_leave_out_users_who_opted_out(self):
+        keen = User.objects.create_user(username='keen', email='keen@example.com')
+        quiet = User.objects.create_user(username='quiet', email='quiet@example.com')
+        Profile.objects.filter(user=quiet).update(email_notifications=False)
+        with self.settings(EMAIL_BACKEND='shop.mail.OutboxEmailBackend'):
+            self.assertEqual(mail.send_notification([keen, quiet], 'Order shipped', 'On its way'), 1)
+        self.assertEqual([row.to for row in OutgoingEmail.objects.all()], [['keen@example.com']])
+
+    def test_attachments_come_out_of_the_outbox_as_they_went_in(self):
+        message = EmailMessage('Receipt', 'Attached', 'shop@example.com', ['buyer@example.com'])
+        message.attach('receipt.txt', 'Total: 120', 'text/plain')
+        logo = MIMEImage(b'GIF89a\x01\x00\x01\x00', 'gif')
+        logo.add_header('Content-ID', '<logo>')
+        message.attach(logo)
+        message.attach('original.eml', EmailMessage('Order', 'Details', to=['seller@example.com']), 'message/rfc822')
+        mail.OutboxEmailBackend().send_messages([message])
+
+        sent = mail._to_message(OutgoingEmail.objects.get(), connection=None).message()
+        receipt, image, forwarded = list(sent.walk())[2:5]
+        self.assertEqual((receipt.get_filename(), receipt.get_payload(decode=True)), ('receipt.txt', b'Total: 120'))
+        self.assertEqual((image['Content-ID'], image.get_payload(decode=True)), ('<logo>', b'GIF89a\x01\x00\x01\x00'))
+        self.assertEqual(forwarded.get_content_type(), 'message/rfc822')
+        self.assertEqual(forwarded.get_payload(0)['Subject'], 'Order')
+
+
+class ReconcileTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        seller = User.objects.create_user(username='seller')
+        cls.buyer = User.objects.create_user(username='buyer')
+        category = Category.objects.create(name='Books', slug='books')
+        cls.pen = Product.objects.create(name='Pen', price=Decimal('10.00'), stock=10, category=category,
+                                         seller=seller)
+
+    def order(self, external_id, age=reconcile.STALE_AFTER + timedelta(minutes=1)):
+        CartItem.objects.update_or_create(user=self.buyer, product=self.pen, defaults={'quantity': 1})
+        order = reserve_order(Cart(self.buyer), '0', external_id=external_id)
+        Order.objects.filter(pk=order.pk).update(placed_at=timezone.now() - age)
+        return order
+
+    def reconcile(self, invoices):
+        with mock.patch('shop.reconcile.fetch_invoice', side_effect=lambda order: invoices.get(order.external_id)), \
+                self.captureOnCommitCallbacks(execute=True):
+            return reconcile.reconcile_pending_orders()
+
+    def test_paid_expired_missing_and_open_invoices(self):
+        long_ago = INVOICE_DURATION + RESERVATION_GRACE + timedelta(minutes=1)
+        paid, expired, missing, young, still_open = (
+            self.order('ORDER-PAID'), self.order('ORDER-EXPIRED'), self.order('ORDER-MISSING', long_ago),
+            self.order('ORDER-YOUNG'), self.order('ORDER-OPEN'),
+        )
+        counts = self.reconcile({
+            'ORDER-PAID': {'id': 'inv-paid', 'status': 'PAID', 'external_id': 'ORDER-PAID'},
+            'ORDER-EXPIRED': {'id': 'inv-expired', 'status': 'EXPIRED'},
+            'ORDER-OPEN': {'id': 'inv-open', 'status': 'PENDING'},
+        })
+        self.assertEqual({key: counts[key] for key in ('checked', 'paid', 'expired', 'missing', 'open', 'cancelled')},
+                         {'checked': 5, 'paid': 1, 'expired': 1, 'missing': 1, 'open': 2, 'cancelled': 2})
+        self.assertTrue(WebhookEvent.objects.filter(event_id='inv-paid', status='PAID').exists())
+        statuses = dict(Order.objects.values_list('external_id', 'status'))
+        self.assertEqual(statuses, {'ORDER-PAID': 'pending', 'ORDER-EXPIRED': 'cancelled', 'ORDER-MISSING': 'cancelled',
+                                    'ORDER-YOUNG': 'pending', 'ORDER-OPEN': 'pending'})
+        self.assertFalse(StockReservation.objects.filter(order__in=[expired, missing]).exists())
+        # The inbox applies the payment
+        webhooks.apply_webhook_events()
+        self.assertEqual(Order.objects.get(pk=paid.pk).status, 'confirmed')
+
+    def test_dry_run_changes_nothing(self):
+        self.order('ORDER-EXPIRED')
+        with mock.patch('shop.reconcile.fetch_invoice', return_value={'id': 'inv-1', 'status': 'EXPIRED'}):
+            counts = reconcile.reconcile_pending_orders(dry_run=True)
+        self.assertEqual((counts['expired'], counts['cancelled']), (1, 0))
+        self.assertEqual(Order.objects.get().status, 'pending')
+
+    def test_a_paid_event_that_gave_up_is_applied_again(self):
+        order = self.order('ORDER-PAID')
+        WebhookEvent.objects.create(provider=XENDIT, event_id='inv-paid', status='PAID', external_id='ORDER-PAID',
+                                    payload={}, attempts=webhooks.MAX_ATTEMPTS, last_error='RuntimeError()')
+        self.reconcile({'ORDER-PAID': {'id': 'inv-paid', 'status': 'PAID'}})
+        event = WebhookEvent.objects.get()
+        self.assertEqual((event.attempts, event.last_error), (0, ''))
+        webhooks.apply_webhook_events()
+        self.assertEqual(Order.objects.get(pk=order.pk).status, 'confirmed')
+
+
+@mock.patch('shop.views.XENDIT_WEBHOOK_VERIFICATION_TOKEN', 'secret')
+class WebhookTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        seller = User.objects.create_user(username='seller')
+        cls.buyer = User.objects.create_user(username='buyer')
+        category = Category.objects.create(name='Books', slug='books')
+        cls.pen = Product.objects.create(name='Pen', price=Decimal('10.00'), stock=3, category=category,
+                                         seller=seller)
+
+    def setUp(self):
+        CartItem.objects.create(user=self.buyer, product=self.pen, quantity=2)
+        self.order = reserve_order(Cart(self.buyer), '0', external_id='ORDER-1')
+
+    def deliver(self, status, token='secret'):
+        return self.client.post(reverse('webhook_listener'),
+                                json.dumps({'id': 'inv-1', 'external_id': 'ORDER-1', 'status': status}),
+                                content_type='application/json', HTTP_X_CALLBACK_TOKEN=token)
+
+    def apply(self, *statuses):
+        for status in statuses:
+            self.assertEqual(self.deliver(status).status_code, 200)
+        webhooks.apply_webhook_events()
+        self.order.refresh_from_db()
+
+    def test_a_wrong_token_is_refused(self):
+        self.assertEqual(self.deliver('PAID', token='guess').status_code, 403)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+    def test_a_redelivery_is_stored_once(self):
+        self.deliver('PAID')
+        self.deliver('PAID')
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+
+    def test_paid_confirms_the_order_once(self):
+        self.apply('PAID')
+        self.assertEqual((self.order.status, self.order.invoice_id), ('confirmed', 'inv-1'))
+        self.assertEqual(Product.objects.get(pk=self.pen.pk).stock, 1)
+        self.assertFalse(CartItem.objects.filter(user=self.buyer).exists())
+        # Replaying it changes nothing
+        WebhookEvent.objects.update(processed_at=None)
+        webhooks.apply_webhook_events()
+        self.assertEqual(Product.objects.get(pk=self.pen.pk).stock, 1)
+
+    def test_expired_cancels_a_pending_order(self):
+        self.apply('EXPIRED')
+        self.assertEqual(self.order.status, 'cancelled')
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_a_late_expired_leaves_a_paid_order_alone(self):
+        self.apply('PAID', 'EXPIRED')
+        self.assertEqual(self.order.status, 'confirmed')
+
+    def test_paid_after_expired_still_confirms(self):
+        self.apply('EXPIRED')
+        with self.assertLogs('shop.webhooks', 'WARNING'):
+            self.apply('PAID')
+        self.assertEqual(self.order.status, 'confirmed')
+        self.assertEqual(Product.objects.get(pk=self.pen.pk).stock, 1)
+
+    def test_refunded_only_applies_to_a_paid_order(self):
+        self.apply('REFUNDED')
+        self.assertEqual(self.order.status, 'pending')
+        self.apply('PAID')
+        WebhookEvent.objects.filter(status='REFUNDED').update(processed_at=None)
+        webhooks.apply_webhook_events()
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'refunded')
+
+    def test_an_event_for_an_unknown_order_is_recorded_as_such(self):
+        self.client.post(reverse('webhook_listener'), json.dumps({'id': 'inv-9', 'external_id': 'ORDER-9', 'status': 'PAID'}),
+                         content_type='application/json', HTTP_X_CALLBACK_TOKEN='secret')
+        webhooks.apply_webhook_events()
+        event = WebhookEvent.objects.get(event_id='inv-9')
+        self.assertIsNotNone(event.processed_at)
+        self.assertIn('No order', event.last_error)
+
+
+class ShippingQuoteCacheTests(TestCase):
+    ADDRESS = '12 Rizal St., Ermita, Manila'
+    QUOTE = {'fee': '89', 'currency': 'PHP', 'quoteId': 'q-1', 'expiresAt': None, 'scheduleAt': '', 'distance': None}
+
+    def setUp(self):
+        # Threads get their own database connections, which can't see this test's transaction
+        local_cache = LocMemCache('shipping-tests', {})
+        local_cache.clear()
+        for name, value in [('cache', local_cache), ('_count', mock.Mock()),
+                            ('_acount', mock.AsyncMock())]:
+            patcher = mock.patch.object(shipping, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.fetched = []
+
+    def fetch(self, address, service_type, scheduled):
+        self.fetched.append(address)
+        time.sleep(0.1)
+        return dict(self.QUOTE)
+
+    def counted(self, name):
+        return sum(call.args[0] == name for call in shipping._count.call_args_list)
+
+    def test_trivially_different_addresses_share_a_key(self):
+        scheduled = shipping.schedule_bucket()
+        self.assertEqual(shipping.normalize_address('  12 RIZAL St. ,Ermita,  Manila '), '12 rizal st, ermita, manila')
+        self.assertEqual(shipping._quote_key('12 Rizal St., Ermita, Manila', 'MPV', scheduled),
+                         shipping._quote_key('12 rizal st ,ermita , manila', 'MPV', scheduled))
+        self.assertNotEqual(shipping._quote_key(self.ADDRESS, 'MPV', scheduled),
+                            shipping._quote_key(self.ADDRESS, 'SEDAN', scheduled))
+
+    def test_concurrent_misses_in_a_process_share_one_call(self):
+        results = []
+        with mock.patch.object(shipping, '_fetch', side_effect=self.fetch):
+            threads = [threading.Thread(target=lambda: results.append(shipping.get_quote(self.ADDRESS))) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            results.append(shipping.get_quote(self.ADDRESS.upper()))
+        self.assertEqual(len(self.fetched), 1)
+        self.assertEqual([quote['fee'] for quote in results], ['89'] * 5)
+        self.assertEqual((self.counted(shipping.HITS), self.counted(shipping.MISSES)), (4, 1))
+        self.assertEqual(shipping._key_locks, {})
+
+    def test_waits_for_another_process_fetching_the_same_quote(self):
+        key = shipping._quote_key(self.ADDRESS, shipping.DEFAULT_SERVICE_TYPE, shipping.schedule_bucket())
+        shipping.cache.add(f'{key}:lock', 1, shipping.FETCH_LOCK_TIMEOUT)
+        threading.Timer(0.2, shipping.cache.set, (key, dict(self.QUOTE, quoteId='q-other'))).start()
+        with mock.patch.object(shipping, '_fetch', side_effect=self.fetch):
+            quote = shipping.get_quote(self.ADDRESS)
+        self.assertEqual(quote['quoteId'], 'q-other')
+        self.assertEqual(self.fetched, [])
+
+    def test_fetches_itself_when_the_other_process_gives_up(self):
+        key = shipping._quote_key(self.ADDRESS, shipping.DEFAULT_SERVICE_TYPE, shipping.schedule_bucket())
+        shipping.cache.add(f'{key}:lock', 1, shipping.FETCH_LOCK_TIMEOUT)
+        threading.Timer(0.2, shipping.cache.delete, (f'{key}:lock',)).start()
+        with mock.patch.object(shipping, '_fetch', side_effect=self.fetch):
+            shipping.get_quote(self.ADDRESS)
+        self.assertEqual(self.fetched, [self.ADDRESS])
+        self.assertIsNotNone(shipping.bookable_quote('q-1'))
+
+    def test_concurrent_async_misses_await_one_task(self):
+        async def afetch(address, service_type, scheduled, timeout=None):
+            self.fetched.append(address)
+            await asyncio.sleep(0.1)
+            return dict(self.QUOTE)
+
+        async def quotes():
+            return await asyncio.gather(*(shipping.aget_quote(self.ADDRESS) for _ in range(3)))
+
+        with mock.patch.object(shipping, '_afetch', side_effect=afetch):
+            results = async_to_sync(quotes)()
+        self.assertEqual(len(self.fetched), 1)
+        self.assertEqual([quote['fee'] for quote in results], ['89'] * 3)
+        self.assertEqual(shipping._fetch_tasks, {})
+
+
+class ShippingQuoteStatsTests(TestCase):
+    def setUp(self):
+        shipping.reset_quote_cache_stats()
+        patcher = mock.patch.object(shipping, 'STATS_FLUSH_INTERVAL', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_counts_are_added_up_in_the_database(self):
+        for _ in range(3):
+            shipping._count(shipping.HITS)
+        shipping._count(shipping.MISSES)
+        async_to_sync(shipping._acount)(shipping.UPSTREAM_MS, 200)
+        self.assertEqual(ShippingQuoteStat.objects.get(name=shipping.HITS).value, 3)
+        self.assertEqual(shipping.quote_cache_stats(), {
+            'hits': 3, 'misses': 1, 'hit_rate': 0.75, 'avg_upstream_ms': 200, 'saved_ms': 600,
+        })
+
+    def test_counts_held_back_by_the_interval_are_in_the_stats(self):
+        with mock.patch.object(shipping, 'STATS_FLUSH_INTERVAL', 60):
+            shipping._count(shipping.HITS)
+            shipping._count(shipping.HITS)
+        self.assertEqual(shipping.quote_cache_stats()['hits'], 2)
+        shipping.reset_quote_cache_stats()
+        self.assertEqual(shipping.quote_cache_stats()['hits'], 0)
+
+
+class ShippingQuoteDeadlineTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        StubLalamove.latency = 3
+        self.server = StubServer(('127.0.0.1', 0), StubLalamove)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        for name, value in [('BASE_URL', f'http://127.0.0.1:{self.server.server_port}'),
+                            ('API_KEY', 'key'), ('API_SECRET', 'secret'), ('MARKET', 'PH')]:
+            patcher = mock.patch.object(lalamove_service, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @mock.patch('shop.shipping.QUOTE_DEADLINE', 0.5)
+    def test_a_slow_lalamove_does_not_hold_the_request_past_the_deadline(self):
+        started = time.perf_counter()
+        with self.assertLogs('shop.shipping', 'WARNING'):
+            response = self.client.post(reverse('get_shipping_quote'), json.dumps({'delivery_address': '12 Rizal Street, Manila'}),
+                                        content_type='application/json')
+        elapsed = time.perf_counter() - started
+        # No live quote in time and no past quotes to estimate from
+        self.assertEqual(response.status_code, 503)
+        self.assertLess(elapsed, 0.5 + 0.3)
+
+
+def http_response(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    response.raw = io.BytesIO(b'')
+    return response
+
+
+class CircuitBreakerTests(TestCase):
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open)
+        self.assertFalse(breaker.allow())
+
+    def test_a_success_resets_the_count(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertFalse(breaker.is_open)
+
+    def test_half_open_lets_one_trial_through_after_the_cool_down(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        later = time.monotonic() + 31
+        with mock.patch('campus_marketplace.services.http_client.time.monotonic', return_value=later):
+            self.assertTrue(breaker.allow())
+            self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertFalse(breaker.is_open)
+        self.assertTrue(breaker.allow())
+
+    def test_a_failed_trial_opens_it_again(self):
+        breaker = CircuitBreaker(failure_threshold=5, reset_timeout=30)
+        for _ in range(5):
+            breaker.record_failure()
+        later = time.monotonic() + 31
+        with mock.patch('campus_marketplace.services.http_client.time.monotonic', return_value=later):
+            self.assertTrue(breaker.allow())
+            breaker.record_failure()
+            # A new cool-down from now
+            self.assertFalse(breaker.allow())
+
+
+class ServiceClientTests(TestCase):
+    def client_for(self, **options):
+        options = {**DEFAULTS, 'backoff': 0, 'failure_threshold': 2, 'reset_timeout': 0, **options}
+        return ServiceClient('test', **options)
+
+    def test_idempotent_calls_are_retried(self):
+        client = self.client_for(failure_threshold=5)
+        with mock.patch.object(client.session, 'request', side_effect=[
+            requests.exceptions.ConnectionError(), http_response(503), http_response(200),
+        ]) as request, self.assertLogs('campus_marketplace.services.http_client', 'WARNING'):
+            self.assertEqual(client.get('https://example.com').status_code, 200)
+        self.assertEqual(request.call_count, 3)
+
+    def test_other_posts_are_not_retried(self):
+        client = self.client_for()
+        with mock.patch.object(client.session, 'request', side_effect=requests.exceptions.ConnectionError()) as request, \
+                self.assertLogs('campus_marketplace.services.http_client', 'WARNING'), \
+                self.assertRaises(requests.exceptions.ConnectionError):
+            client.post('https://example.com')
+        self.assertEqual(request.call_count, 1)
+
+    def test_an_open_circuit_fails_fast_then_closes_after_a_good_trial(self):
+        client = self.client_for(retries=0, reset_timeout=30)
+        with mock.patch.object(client.session, 'request', return_value=http_response(500)) as request, \
+                self.assertLogs('campus_marketplace.services.http_client', 'WARNING'):
+            client.get('https://example.com')
+            client.get('https://example.com')
+            with self.assertRaises(ServiceUnavailable):
+                client.get('https://example.com')
+        self.assertEqual(request.call_count, 2)
+
+        client.breaker.reset_timeout = 0
+        with mock.patch.object(client.session, 'request', return_value=http_response(200)):
+            self.assertEqual(client.get('https://example.com').status_code, 200)
+        self.assertFalse(client.breaker.is_open)
+
+    def test_any_error_on_the_trial_call_settles_the_breaker(self):
+        client = self.client_for(retries=0)
+        client.breaker.record_failure()
+        client.breaker.record_failure()
+        with mock.patch.object(client.session, 'request', side_effect=requests.exceptions.ChunkedEncodingError()), \
+                self.assertRaises(requests.exceptions.ChunkedEncodingError):
+            client.get('https://example.com')
+        with mock.patch.object(client.session, 'request', return_value=http_response(200)):
+            self.assertEqual(client.get('https://example.com').status_code, 200)
+
+    def test_a_cancelled_async_trial_frees_the_breaker(self):
+        client = self.client_for(retries=0)
+        client.breaker.record_failure()
+        client.breaker.record_failure()
+        async_client = AsyncServiceClient(client)
+        with mock.patch.object(async_client.session, 'request', side_effect=asyncio.CancelledError()), \
+                self.assertRaises(asyncio.CancelledError):
+            async_to_sync(async_client.get)('https://example.com')
+        self.assertTrue(client.breaker.allow())
+
+
+class ProductDetailCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        seller = User.objects.create_user(username='seller')
+        cls.category = Category.objects.create(name='Books', slug='books')
+        cls.pen = Product.objects.create(name='Pen', price=10, category=cls.category, seller=seller)
+
+    def setUp(self):
+        cache.clear()
 
-# Create your tests here.
+    def test_an_evicted_version_does_not_revive_a_stale_entry(self):
+        self.assertEqual(get_product_detail(self.pen.pk)['product'].name, 'Pen')
+        # A change the entry wasn't invalidated for, then the cache evicts the version token
+        Product.objects.filter(pk=self.pen.pk).update(name='Fountain pen')
+        cache.delete(f'product_detail:category:{self.category.pk}')
+        self.assertEqual(get_product_detail(self.pen.pk)['product'].name, 'Fountain pen')
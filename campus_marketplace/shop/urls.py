@@ -63,7 +63,9 @@ urlpatterns = [
     path('message/<int:message_id>/reply/', views.reply_message, name='reply_message'),
     path('message/<int:message_id>/delete/', views.delete_message, name='delete_message'),
     path('api/get-shipping-quote/', views.get_shipping_quote, name='get_shipping_quote'),
+    path('api/autocomplete/', views.autocomplete, name='autocomplete'),
     path('api/save-shipping-address/', views.save_address, name='save_address'),
+    path('api/cart/items/<int:item_id>/', views.cart_item_api, name='cart_item_api'),
     path('delete-address/<int:address_id>/', views.delete_address, name='delete_address'),
     path('checkout/pay/', views.create_xendit_invoice, name='create_payment_intent'), # Renamed view function
     path('payment/status/', views.payment_status, name='payment_status'),
@@ -3,54 +3,88 @@ from decimal import Decimal
 from django.shortcuts import render, redirect, get_object_or_404
 
 from campus_marketplace.settings import XENDIT_WEBHOOK_VERIFICATION_TOKEN
-from .models import Product, Category, CartItem, Order, OrderItem, Profile, Message, ShippingAddress
+from .models import Product, Category, CartItem, Order, OrderItem, Profile, Message, ShippingAddress, available_stock
 from django.http import HttpResponse
 from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.forms import AuthenticationForm, PasswordResetForm
 from django.contrib.auth.decorators import login_required
 from .forms import UserRegisterForm, ProfileForm, ProductForm, UserUpdateForm
+from .search import search_products, search_rank_ordering
+from .pagination import KeysetPaginator
+from .facets import parse_filters, filter_conditions, facet_counts
+from .caching import get_product_detail
+from .autocomplete import suggest
+from .cart import Cart, GuestCart
+from .shipping import aget_quotes, bookable_quote
+from .webhooks import XENDIT, record_event
+from .reconcile import fetch_invoice
+from .orders import (
+    place_order, reserve_order, release_order, cart_fingerprint, pending_order_for,
+    InsufficientStock, INVOICE_DURATION,
+)
+from . import badges
+from .conditional import (
+    homepage_etag, homepage_last_modified,
+    product_list_etag, product_list_last_modified,
+    product_detail_etag, product_detail_last_modified,
+)
 from django.contrib import messages
-from django.urls import reverse_lazy
+from django.urls import reverse, reverse_lazy
 from django.contrib.auth.views import PasswordResetView, LoginView
-from django.views.decorators.http import require_http_methods
-from django.db.models import Q, Sum, F, ExpressionWrapper, DecimalField
+from django.views.decorators.http import require_http_methods, condition
+from django.views.decorators.cache import cache_control
+from django.db import IntegrityError
+from django.db.models import Q, Sum, F
 from django.shortcuts import render
 from django.http import JsonResponse
 from campus_marketplace.services.lalamove_service import get_lalamove_quotation, create_lalamove_order
-import json, requests, base64, time
+from campus_marketplace.services.http_client import get_client
+import json, requests, httpx, base64, time, hashlib, secrets, logging
 from django.core.serializers import serialize
 from django.views.decorators.csrf import csrf_exempt
 
+logger = logging.getLogger(__name__)
 
 
+# Catalog pages are revalidated on every visit and answered with 304 when unchanged;
+# private because the ETag covers the viewer's own cart/inbox state
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=homepage_etag, last_modified_func=homepage_last_modified)
 def homepage(request):
+    # Category.length is maintained by the Product hooks, no per-category COUNT needed
     categories = Category.objects.all()
-    latest = Product.objects.order_by('-created_at')[:6]
+    latest = Product.objects.with_available_stock().order_by('-created_at')[:6]
 
-    for category in categories:
-
-        category.length = len((Product.objects.all().filter(category=category)))
-        if category.length > 1:
-            category.plural = True
-
-           
     return render(request, "shop/index.html", {
         "categories": categories,
         "latest": latest,
     })
 
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=product_list_etag, last_modified_func=product_list_last_modified)
 def product_list(request):
     query = request.GET.get("q")
-    category_slug = request.GET.get("category")
-    products = Product.objects.all()
+    categories = list(Category.objects.all())
+    filters = parse_filters(request.GET, categories)
+    products = Product.objects.with_available_stock()
+    ordering = ('-created_at', '-id')
     if query:
-        products = products.filter(name__icontains=query)
-    if category_slug:
-        products = products.filter(category__slug=category_slug)
-    categories = Category.objects.all()
+        # Ranked by relevance through the full-text index
+        products = search_products(products, query)
+        ordering = search_rank_ordering() + ordering
+
+    # Facet counts for the sidebar in one aggregate query, before the facet filters apply
+    price_buckets = facet_counts(products, categories, filters)
+    products = products.filter(*filter_conditions(filters))
+
+    page = KeysetPaginator(products, ordering).page(request.GET.get('cursor'))
     return render(request, "shop/product_list.html", {
-        "products": products,
-        "categories": categories
+        "products": page,
+        "page": page,
+        "categories": categories,
+        "selected_category": filters['category'],
+        "filters": filters,
+        "price_buckets": price_buckets,
     })
 
 @login_required
@@ -74,19 +108,17 @@ def add_to_cart(request, product_id):
     return redirect("cart")
 
 
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=product_detail_etag, last_modified_func=product_detail_last_modified)
 def product_detail(request, product_id):
     """Display detailed information about a single product"""
-    # Get the product or show 404 if not found
-    product = get_object_or_404(Product, id=product_id)
-    
-    # Get related products (same category, exclude current product)
-    related_products = Product.objects.filter(
-        category=product.category
-    ).exclude(id=product_id)[:4]
-    
-    # Get seller info
-    seller = product.seller
-    seller_products_count = Product.objects.filter(seller=seller).count()
+    # Product, seller summary and related products are shared by every visitor and cached
+    context = dict(get_product_detail(product_id))
+    product = context['product']
+    # Not part of the shared cached detail: holds come and go without touching the product
+    context['available_stock'] = (
+        Product.objects.with_available_stock().values_list('available_stock', flat=True).get(pk=product.pk)
+    )
     
     # Check if user has this in cart
     in_cart = False
@@ -95,21 +127,21 @@ def product_detail(request, product_id):
             user=request.user, 
             product=product
         ).exists()
-    
-    context = {
-        'product': product,
-        'related_products': related_products,
-        'seller': seller,
-        'seller_products_count': seller_products_count,
-        'in_cart': in_cart,
-    }
+    context['in_cart'] = in_cart
     
     return render(request, 'shop/product_detail.html', context)
 
-@login_required(login_url='login')
 def cart_view(request):
     """Display user's shopping cart"""
-    cart_items = CartItem.objects.filter(user=request.user)
+    if not request.user.is_authenticated:
+        # Guests see their cookie cart, and log in to check out
+        guest_lines = GuestCart.from_request(request).lines()
+        return render(request, "shop/cart.html", {
+            "guest_lines": guest_lines,
+            "guest_subtotal": f"{sum((line.line_total() for line in guest_lines), Decimal('0')):.2f}",
+        })
+
+    cart = Cart.for_request(request)
     user_addresses = ShippingAddress.objects.filter(user=request.user)
 
     addresses_json = serialize('json', user_addresses)
@@ -123,29 +155,30 @@ def cart_view(request):
         item['fields'] for item in addresses_list
     ]
     
-    # Calculate totals
-    subtotal = sum(float(item.line_total()) for item in cart_items)
-    tax = subtotal * 0.05 
-    
-    total = subtotal + tax 
-    
     context = {
-        'cart_items': cart_items,
-        'cart_subtotal': f"{subtotal:.2f}",
-        'tax': f"{tax:.2f}",
-        'cart_total': f"{total:.2f}",
+        'cart_items': cart.lines,
+        'cart_subtotal': f"{cart.subtotal:.2f}",
+        'tax': f"{cart.tax:.2f}",
+        'cart_total': f"{cart.total:.2f}",
         'user_addresses': user_addresses,
         'clean_addresses': clean_addresses
     }
     return render(request, "shop/cart.html", context)
 
-@login_required(login_url='login')
 def add_to_cart(request, product_id):
     """Add product to cart"""
-    if not request.user.is_authenticated:
-        return redirect('login')
-    
     product = get_object_or_404(Product, id=product_id)
+
+    if not request.user.is_authenticated:
+        # Guests keep their cart in a signed cookie until they log in
+        guest_cart = GuestCart.from_request(request)
+        if guest_cart.add(product.pk):
+            messages.success(request, f"{product.name} added to cart! Log in to check out.")
+        else:
+            messages.error(request, "Your cart is full. Log in to add more items.")
+        response = redirect("cart")
+        guest_cart.save(response)
+        return response
     
     # Check if product already in cart
     cart_item, created = CartItem.objects.get_or_create(
@@ -158,6 +191,7 @@ def add_to_cart(request, product_id):
     if not created:
         cart_item.quantity += 1
         cart_item.save()
+    badges.adjust(badges.CART, request.user.pk, 1)
     
     messages.success(request, f"{product.name} added to cart!")
     return redirect("cart")
@@ -167,6 +201,7 @@ def add_to_cart(request, product_id):
 def update_cart(request, item_id):
     """Update cart item quantity"""
     item = get_object_or_404(CartItem, id=item_id, user=request.user)
+    previous_quantity = item.quantity
     
     if request.method == 'POST':
         action = request.POST.get('action')
@@ -180,6 +215,7 @@ def update_cart(request, item_id):
             item.quantity = max(1, quantity)  # Ensure minimum 1
         
         item.save()
+        badges.adjust(badges.CART, request.user.pk, item.quantity - previous_quantity)
         messages.success(request, 'Cart updated!')
     
     return redirect('cart')
@@ -209,6 +245,7 @@ def remove_item(request, item_id):
         
         # 2. Delete the item
         cart_item.delete()
+        badges.adjust(badges.CART, request.user.pk, -cart_item.quantity)
         
         # 3. Success response for AJAX
         return JsonResponse({
@@ -229,69 +266,97 @@ def remove_item(request, item_id):
         }, status=500)
 
 
+@login_required(login_url='login')
+@require_http_methods(["POST"])
+def cart_item_api(request, item_id):
+    """
+    Change one cart line and return the new totals as JSON.
+    Body: {"action": "increase" | "decrease" | "set" | "remove", "quantity": n}
+    """
+    try:
+        data = json.loads(request.body or '{}')
+        action = data.get('action')
+        quantity = int(data.get('quantity', 1)) if action == 'set' else None
+    except (json.JSONDecodeError, TypeError, ValueError, AttributeError):
+        return JsonResponse({'success': False, 'error': 'Invalid request data'}, status=400)
+
+    # One write with F() so rapid clicks don't overwrite each other
+    line = CartItem.objects.filter(id=item_id, user=request.user)
+    if action in ('increase', 'set'):
+        # No more than is available, as checkout would refuse it anyway
+        available = (
+            Product.objects.filter(cartitem__id=item_id, cartitem__user=request.user)
+            .annotate(available=available_stock()).values_list('available', flat=True).first()
+        )
+        available = max(1, available or 0)
+    if action == 'increase':
+        line.filter(quantity__lt=available).update(quantity=F('quantity') + 1)
+    elif action == 'decrease':
+        line.filter(quantity__gt=1).update(quantity=F('quantity') - 1)
+    elif action == 'set':
+        line.update(quantity=min(max(1, quantity), available))
+    elif action == 'remove':
+        line.delete()
+    else:
+        return JsonResponse({'success': False, 'error': 'Unknown action'}, status=400)
+
+    # Lines and subtotal come back in a single query
+    cart = Cart.for_request(request)
+    cart.refresh()
+    item = next((item for item in cart if item.pk == item_id), None)
+    if item is None and action != 'remove':
+        return JsonResponse({'success': False, 'error': 'Cart item not found.'}, status=404)
+    badges.reset(badges.CART, request.user.pk, cart.quantity)
+
+    return JsonResponse({
+        'success': True,
+        'item': item and {
+            'id': item.pk,
+            'quantity': item.quantity,
+            'line_total': f"{item.line_amount:.2f}",
+        },
+        'line_count': len(cart),
+        'cart_count': cart.quantity,
+        'subtotal': f"{cart.subtotal:.2f}",
+        'tax': f"{cart.tax:.2f}",
+        'total': f"{cart.total:.2f}",
+    })
+
+
+def out_of_stock_message(error):
+    names = ', '.join(product.name for product in error.products)
+    # Stock can run out between the check and the write, leaving no one product to name
+    return f'Not enough stock left for: {names}.' if names else 'Some items in your cart just ran out of stock.'
+
+
 @login_required(login_url='login')
 def checkout(request):
     """Checkout page - create order from cart"""
-    cart_items = CartItem.objects.filter(user=request.user)
+    cart = Cart.for_request(request)
+    shipping = Decimal('50.00')
     
     # Check if cart is empty
-    if not cart_items.exists():
+    if not cart:
         messages.warning(request, 'Your cart is empty!')
         return redirect('cart')
     
     if request.method == 'POST':
-        # Calculate totals
-        total_amount = sum(float(item.line_total()) for item in cart_items)
-        tax = total_amount * 0.05
-        shipping = 50.00
-        final_total = total_amount + tax + shipping
-        
-        # Create order
-        order = Order.objects.create(
-            user=request.user,
-            total=final_total,
-            status='pending'
-        )
-        
-        # Create order items and update product stock
-        for item in cart_items:
-            OrderItem.objects.create(
-                order=order,
-                product=item.product,
-                quantity=item.quantity,
-                price_each=item.product.price
-            )
-            
-            # Update product stock
-            product = item.product
-            product.stock -= item.quantity
-            product.save()
-            
-            # Update seller total sales
-            seller_profile = product.seller.profile
-            seller_profile.total_sales += item.quantity
-            seller_profile.save()
-        
-        # Clear cart
-        cart_items.delete()
+        try:
+            order = place_order(cart, shipping)
+        except InsufficientStock as e:
+            messages.error(request, f'{out_of_stock_message(e)} Please update your cart.')
+            return redirect('cart')
         
         messages.success(request, 'Order placed successfully!')
         return render(request, 'shop/checkout_success.html', {'order': order})
     
     # GET request - show checkout page
-    cart_items = CartItem.objects.filter(user=request.user)
-    
-    subtotal = sum(float(item.line_total()) for item in cart_items)
-    tax = subtotal * 0.05
-    shipping = 50.00
-    total = subtotal + tax + shipping
-    
     context = {
-        'cart_items': cart_items,
-        'subtotal': f"{subtotal:.2f}",
-        'tax': f"{tax:.2f}",
+        'cart_items': cart.lines,
+        'subtotal': f"{cart.subtotal:.2f}",
+        'tax': f"{cart.tax:.2f}",
         'shipping': f"{shipping:.2f}",
-        'total': f"{total:.2f}",
+        'total': f"{cart.total_with(shipping):.2f}",
     }
     
     return render(request, 'shop/checkout.html', context)
@@ -341,7 +406,16 @@ class CustomLoginView(LoginView):
         else:
             self.request.session.set_expiry(0)  # Browser session
         
-        return super().form_valid(form)
+        response = super().form_valid(form)
+
+        # Bring along whatever was added to the cart before logging in
+        guest_cart = GuestCart.from_request(self.request)
+        if guest_cart:
+            guest_cart.merge_into(user)
+            badges.forget(badges.CART, user.pk)
+            guest_cart.items.clear()
+            guest_cart.save(response)
+        return response
 
 class CustomPasswordResetView(PasswordResetView):
     """Handle password reset request"""
@@ -471,6 +545,9 @@ def seller_dashboard(request):
     return render(request, 'shop/seller_dashboard.html', context)
 
 
+SELLER_PRODUCT_SORTS = ('-created_at', 'name', '-price', 'price', 'stock')
+
+
 @login_required(login_url='login')
 def seller_products(request):
     """View all seller's products"""
@@ -483,22 +560,23 @@ def seller_products(request):
     # Get filter parameters
     search_query = request.GET.get('q', '')
     sort_by = request.GET.get('sort', '-created_at')
+    if sort_by not in SELLER_PRODUCT_SORTS:
+        sort_by = '-created_at'
     
     # Get seller's products
     products = Product.objects.filter(seller=request.user)
     
     # Search filter
     if search_query:
-        products = products.filter(
-            Q(name__icontains=search_query) | 
-            Q(description__icontains=search_query)
-        )
+        products = search_products(products, search_query)
     
-    # Sort
-    products = products.order_by(sort_by)
+    # Sort, with id as tie-breaker so the cursor position is unique
+    ordering = (sort_by, '-id' if sort_by.startswith('-') else 'id')
+    page = KeysetPaginator(products, ordering).page(request.GET.get('cursor'))
     
     context = {
-        'products': products,
+        'products': page,
+        'page': page,
         'search_query': search_query,
         'sort_by': sort_by,
         'profile': profile,
@@ -516,18 +594,21 @@ def seller_orders(request):
         messages.error(request, 'You must be a seller to access this page.')
         return redirect('profile')
     
-    # Get orders containing seller's products
+    # Get orders containing seller's products (subquery instead of a DISTINCT join)
     orders = Order.objects.filter(
-        items__product__seller=request.user
-    ).distinct().order_by('-placed_at')
+        id__in=OrderItem.objects.filter(product__seller=request.user).values('order_id')
+    ).select_related('user')
     
     # Filter by status
     status_filter = request.GET.get('status', '')
     if status_filter:
         orders = orders.filter(status=status_filter)
     
+    page = KeysetPaginator(orders, ('-placed_at', '-id'), per_page=25).page(request.GET.get('cursor'))
+    
     context = {
-        'orders': orders,
+        'orders': page,
+        'page': page,
         'profile': profile,
         'status_filter': status_filter,
     }
@@ -732,6 +813,7 @@ def contact_seller(request, product_id):
             subject=subject,
             message=message_text
         )
+        badges.adjust(badges.UNREAD, seller.pk, 1)
         
         messages.success(request, f'Message sent to {seller.username}!')
         return redirect('product_detail', product_id=product_id)
@@ -758,8 +840,8 @@ def messages_inbox(request):
     # Mark all as read when viewing
     unread_messages = Message.objects.filter(recipient=request.user, is_read=False)
     unread_messages.update(is_read=True)
-    
-    unread_count = Message.objects.filter(recipient=request.user, is_read=False).count()
+    badges.reset(badges.UNREAD, request.user.pk)
+    unread_count = 0
     
     context = {
         'messages': messages_list,
@@ -784,6 +866,7 @@ def message_detail(request, message_id):
     if not message.is_read:
         message.is_read = True
         message.save()
+        badges.adjust(badges.UNREAD, request.user.pk, -1)
     
     context = {
         'message': message,
@@ -817,6 +900,7 @@ def reply_message(request, message_id):
             subject=f"Re: {original_message.subject}",
             message=reply_text
         )
+        badges.adjust(badges.UNREAD, original_message.sender_id, 1)
         
         messages.success(request, 'Reply sent!')
         return redirect('messages_inbox')
@@ -840,6 +924,8 @@ def delete_message(request, message_id):
     
     if request.method == 'POST':
         message.delete()
+        if not message.is_read:
+            badges.adjust(badges.UNREAD, request.user.pk, -1)
         messages.success(request, 'Message deleted!')
         return redirect('messages_inbox')
     
@@ -851,7 +937,8 @@ def delete_message(request, message_id):
 
 
 
-def get_shipping_quote(request):
+async def get_shipping_quote(request):
+    # Async, so a worker isn't held for the whole Lalamove round trip when served over ASGI
     if request.method == 'POST':
         try:
             import json
@@ -860,46 +947,29 @@ def get_shipping_quote(request):
 
             # Assuming you get the order details from the frontend
             data = json.loads(request.body)
-            TUP_address = "Natividad Almeda-Lopez corner A. Villegas and San Marcelino Streets, Ermita, Manila, Metro Manila, Philippines"
             delivery_address = data.get('delivery_address')
-            schedule_at = (datetime.utcnow() + timedelta(hours=1)).isoformat() + 'Z'
-            service_type = "MOTORCYCLE"
-            
-            payload = {
-                "data": {
-                    "scheduleAt": schedule_at,
-                    "serviceType": service_type,
-                    "language": "en_PH",
-                    "stops": [
-                        {
-                            "address": TUP_address
-                        },
-                        {
-                            "address": delivery_address
-                        }
-                    ],
-                    "item": {
-                        "quantity": "1",
-                        "weight": "SMALL"
-                    },
-                    # Add any required special requests if necessary, e.g., 'POD' for proof of delivery
-                }
-        }
-            
-            quote_response = get_lalamove_quotation(payload) 
-            quote_data = quote_response.get('data', {}) 
-            price_breakdown = quote_data.get('priceBreakdown', {})
-            
+            if not delivery_address:
+                return JsonResponse({"success": False, "error": "Delivery address is required"}, status=400)
+
+            # Every vehicle at once, never waiting past the deadline; late ones are estimated and can't be booked
+            quotes = [
+                {key: quote[key] for key in ('serviceType', 'fee', 'currency', 'quoteId', 'estimated', 'bookable')}
+                for quote in await aget_quotes(delivery_address)
+            ]
+            if not quotes:
+                return JsonResponse({"success": False, "error": "Delivery quotes are unavailable right now. Please try again shortly."}, status=503)
+
             return JsonResponse({
                 "success": True,
-           
-                "fee": price_breakdown.get('total'), 
-                "currency": price_breakdown.get('currency'),
-                "quoteId": quote_data.get('quotationId')
+                **quotes[0],
+                "quotes": quotes,
             })
-        except requests.exceptions.HTTPError as e:
+        except (requests.exceptions.HTTPError, httpx.HTTPStatusError) as e:
             # Handle HTTP errors from the Lalamove API call
             return JsonResponse({"success": False, "error": str(e.response.text)}, status=e.response.status_code)
+        except (requests.exceptions.RequestException, httpx.TransportError):
+            # Timed out, unreachable, or its circuit is open after repeated failures
+            return JsonResponse({"success": False, "error": "Delivery quotes are unavailable right now. Please try again shortly."}, status=503)
         except KeyError as e:
             # Handle the specific KeyError if a field is missing (e.g., if Lalamove returns an error response)
             return JsonResponse({"success": False, "error": f"Missing key in Lalamove response: {e}"}, status=500)
@@ -910,6 +980,20 @@ def get_shipping_quote(request):
     return JsonResponse({"error": "Invalid request method"}, status=405)
 
 
+@require_http_methods(["GET"])
+def autocomplete(request):
+    """Product and category name suggestions for the search box"""
+    prefix = request.GET.get('q', '')[:100]
+    suggestions = []
+    for kind, obj_id, label, slug in suggest(prefix):
+        if kind == 'category':
+            url = reverse('product_list') + f'?category={slug}'
+        else:
+            url = reverse('product_detail', args=[obj_id])
+        suggestions.append({'type': kind, 'label': label, 'url': url})
+    return JsonResponse({'suggestions': suggestions})
+
+
 @login_required(login_url='login')
 def save_address(request):
     """Save user's shipping address"""
@@ -1019,36 +1103,112 @@ def create_xendit_invoice(request):
     try:
         data = json.loads(request.body)
         shipping_method = data.get('shipping_method')
-        shipping_cost = data.get('shipping_cost')
+        quote_id = data.get('lalamove_quote_id')
         final_total = float(data.get('final_total', 0)) # Client-side total
 
     except (json.JSONDecodeError, ValueError):
         return JsonResponse({'success': False, 'error': 'Invalid request data'}, status=400)
 
     # 1. Calculate Cart Summary
-    user_cart_items = CartItem.objects.filter(user=request.user)
-    if not user_cart_items.exists():
+    cart = Cart.for_request(request)
+    if not cart:
         return JsonResponse({'success': False, 'error': 'Cart is empty'}, status=400)
 
-    cart_summary = user_cart_items.annotate(
-        item_price=ExpressionWrapper(
-            F('quantity') * F('product__price'), 
-            output_field=DecimalField()
-        )
-    ).aggregate(cart_subtotal=Sum('item_price'))
-    
-    subtotal = cart_summary.get('cart_subtotal') or 0
-    tax = subtotal * Decimal(0.05)
-    final_shipping_cost = 0 # You must retrieve the actual Lalamove cost here!
+    final_shipping_cost = 0
     if shipping_method == 'lalamove':
-        # Retrieve the cost from session or calculate based on address/cart items
-        # For testing, you must replace 50.00 with your actual retrieved shipping cost
-        final_shipping_cost = shipping_cost
-    
-    server_calculated_total = subtotal + tax + final_shipping_cost
+        # Charge what Lalamove quoted, never the fee the browser sends back; an
+        # estimate has no quotation to book, and an expired quote can't be booked either
+        quote = bookable_quote(quote_id)
+        if quote is None:
+            return JsonResponse({'success': False, 'error': 'Your delivery quote has expired or is only an estimate. Please get a new quote.'}, status=409)
+        final_shipping_cost = quote['fee']
+
+    final_shipping_cost = str(final_shipping_cost or 0)
        
+    # A double-click or retry for the same cart reuses the first order and its invoice
+    idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+    if idempotency_key and len(idempotency_key) > 64:
+        idempotency_key = hashlib.sha256(idempotency_key.encode()).hexdigest()
+    idempotency_key = idempotency_key or cart_fingerprint(cart, final_shipping_cost)
+
     # 2. Prepare Xendit Invoice Data
-    order_id = f"ORDER-{request.user.id}-{int(time.time())}"
+    order_id = f"ORDER-{request.user.id}-{int(time.time())}-{secrets.token_hex(4)}"
+
+    # Hold the units for as long as the invoice can be paid
+    order, created = pending_order_for(request.user, idempotency_key), False
+    if order is None:
+        try:
+            order = reserve_order(cart, final_shipping_cost, external_id=order_id, idempotency_key=idempotency_key)
+            created = True
+        except InsufficientStock as e:
+            return JsonResponse({'success': False, 'error': out_of_stock_message(e)}, status=409)
+        except IntegrityError:
+            # A concurrent request with the same key got there first
+            order = pending_order_for(request.user, idempotency_key)
+    if order is None:
+        return JsonResponse({'success': False, 'error': 'Please try again.'}, status=409)
+    if not order.invoice_url and not created:
+        # An earlier request may have got no answer after Xendit made the invoice
+        recover_xendit_invoice(order)
+    if order.invoice_url:
+        return JsonResponse({'success': True, 'redirect_url': order.invoice_url})
+    if not created:
+        return JsonResponse({'success': False, 'error': 'Your payment is already being set up. Please wait a moment.'}, status=409)
+    try:
+        payment_info = open_xendit_invoice(request, order)
+    except Exception as e:
+        if invoice_outcome_unknown(e):
+            # Xendit may have made the invoice anyway, and the buyer could pay it: cancelling
+            # here would let a retry open a second one. Keep the order; a retry picks the
+            # invoice up, and reconcile_payments settles it either way
+            logger.warning("No answer from Xendit for order %s's invoice: %r", order.pk, e)
+            return JsonResponse({'success': False, 'error': 'The payment gateway is slow to respond. Please try again in a moment.'}, status=503)
+        # Otherwise don't leave the order pending with its stock held:
+        # a retry for the same cart would be refused until the invoice window passed
+        if isinstance(e, requests.exceptions.RequestException):
+            logger.warning("Xendit refused the invoice for order %s: %r", order.pk, e)
+        else:
+            logger.exception("Could not open a Xendit invoice for order %s", order.pk)
+        release_order(order)
+        order.status = 'cancelled'
+        order.save(update_fields=['status'])
+        return JsonResponse({'success': False, 'error': 'Payment gateway initialization failed.'}, status=500)
+
+    return JsonResponse({
+        'success': True,
+        'redirect_url': payment_info['invoice_url'] # Xendit's hosted payment page URL
+    })
+
+
+def invoice_outcome_unknown(error):
+    """Whether the invoice request failed in a way that leaves open whether Xendit created it."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return False
+    if isinstance(error, requests.exceptions.Timeout):
+        return True
+    response = getattr(error, 'response', None)
+    return isinstance(error, requests.exceptions.HTTPError) and response is not None and response.status_code >= 500
+
+
+def recover_xendit_invoice(order):
+    """Store the URL of the order's open invoice, if Xendit has one; returns the URL or None."""
+    try:
+        invoice = fetch_invoice(order)
+    except requests.exceptions.RequestException as e:
+        logger.warning("Could not look up order %s's invoice at Xendit: %r", order.pk, e)
+        return None
+    if not invoice or invoice.get('status') != 'PENDING' or not invoice.get('invoice_url'):
+        return None
+    order.invoice_url = invoice['invoice_url']
+    order.invoice_id = invoice.get('id')
+    order.save(update_fields=['invoice_url', 'invoice_id'])
+    return order.invoice_url
+
+
+def open_xendit_invoice(request, order):
+    """Create the Xendit invoice for a reserved order and store its URL; returns Xendit's response."""
+    order_id = order.external_id
+    server_calculated_total = order.total
   
     # Xendit Sandbox Invoice Creation URL
     XENDIT_INVOICE_URL = "https://api.xendit.co/v2/invoices" 
@@ -1067,91 +1227,53 @@ def create_xendit_invoice(request):
         "success_redirect_url": get_base_url(request) + reverse_lazy('payment_status') + f"?order_id={order_id}",
         "failure_redirect_url": get_base_url(request) + reverse_lazy('payment_status') + f"?order_id={order_id}&status=failed",
         "callback_url": get_base_url(request) + reverse_lazy('webhook_listener'), # Secure, server-to-server confirmation
+        "invoice_duration": int(INVOICE_DURATION.total_seconds()),
     }
     
     # 3. Call Xendit API
-    try:
-        response = requests.post(
-            XENDIT_INVOICE_URL,
-            headers={
-                "Authorization": get_xendit_auth_header(),
-                "Content-Type": "application/json"
-            },
-            data=json.dumps(invoice_data)
-        )
-        response.raise_for_status() # Raise exception for bad status codes
-        
-        payment_info = response.json()
-        
-        Order.objects.create(external_id=order_id, user=request.user, total=server_calculated_total, status='pending')
-
-        return JsonResponse({
-            'success': True,
-            'redirect_url': payment_info['invoice_url'] # Xendit's hosted payment page URL
-        })
-
-    except requests.exceptions.RequestException as e:
-        print(f"Xendit API Error: {e.response.text if e.response is not None else str(e)}")
-        return JsonResponse({'success': False, 'error': 'Payment gateway initialization failed.'}, status=500)
+    # Xendit deduplicates on the idempotency key, so the client may retry this POST
+    response = get_client('xendit').post(
+        XENDIT_INVOICE_URL,
+        headers={
+            "Authorization": get_xendit_auth_header(),
+            "Content-Type": "application/json",
+            "X-IDEMPOTENCY-KEY": order_id,
+        },
+        data=json.dumps(invoice_data),
+        idempotent=True,
+    )
+    response.raise_for_status() # Raise exception for bad status codes
+    
+    payment_info = response.json()
+    order.invoice_url = payment_info['invoice_url']
+    order.invoice_id = payment_info.get('id')
+    order.save(update_fields=['invoice_url', 'invoice_id'])
+    return payment_info
 
 @csrf_exempt
 def webhook_listener(request):
     """
     Receives secure payment confirmation from Xendit.
+    The event is only stored here; the process_webhook_events worker applies it.
     """
     if request.method != 'POST':
         return HttpResponse(status=405) # Only accept POST
 
+    # SECURITY: Verify Xendit Callback Token (CRITICAL)
+    xendit_token = request.headers.get('X-Callback-Token')
+    if xendit_token != XENDIT_WEBHOOK_VERIFICATION_TOKEN:
+        return HttpResponse('Forbidden: Invalid Callback Token', status=403)
+
     try:
-        # SECURITY: Verify Xendit Callback Token (CRITICAL)
-        # Check Xendit documentation for the exact header name; often 'X-Callback-Token'.
-        xendit_token = request.headers.get('X-Callback-Token')
-        if xendit_token != XENDIT_WEBHOOK_VERIFICATION_TOKEN: # Replace with your token from Xendit settings
-             return HttpResponse('Forbidden: Invalid Callback Token', status=403)
-             
-        # Parse Data
         data = json.loads(request.body)
-        
-        external_id = data.get('external_id') # Your unique order ID
-        status = data.get('status') # e.g., 'PAID', 'EXPIRED'
-
-        order = get_object_or_404(Order, external_id=external_id)
-
-        if status == 'PAID':
-            if order.status != 'confirmed':
-                order.status = 'confirmed'
-                order.invoice_id = data.get('id')
-                order.payment_method = 'xendit' # Save the Xendit Invoice ID
-                order.save()
-                
-                CartItem.objects.filter(user=order.user).delete()
-                
-                print(f"Order {external_id} paid successfully.")
-                pass
-
-        elif status in ['EXPIRED', 'FAILED', 'CLOSED']:
-             if order.status != 'cancelled':
-                order.status = 'cancelled'
-                order.invoice_id = data.get('id') # Save the Xendit Invoice ID
-                order.save()
-                
-                CartItem.objects.filter(user=order.user).delete()
-                
-                print(f"Order {external_id} paid successfully.")
-                pass
-             
-            
-
-        elif status == 'REFUNDED': 
-            order.status = 'refunded'
-
-            
-        return HttpResponse('Webhook received', status=200)
-
-    except Exception as e:
-        # Log unexpected errors
-        print(f"Error processing Xendit webhook: {e}")
-        return HttpResponse('Internal Server Error', status=500)
+    except ValueError:
+        return HttpResponse('Bad Request: invalid JSON', status=400)
+    if not isinstance(data, dict):
+        return HttpResponse('Bad Request: expected a JSON object', status=400)
+
+    # A redelivery of an event we already have is acknowledged all the same
+    record_event(XENDIT, data)
+    return HttpResponse('Webhook received', status=200)
 
 @login_required(login_url='login')
 def payment_status(request):
@@ -0,0 +1,171 @@
+"""
+Payment webhooks, stored first and applied later.
+
+The webhook view only verifies the token and records the event in the
+WebhookEvent inbox with one INSERT that ignores conflicts, so Xendit gets
+its 200 at once and a redelivered event costs nothing. It also queues
+apply_webhook_events for the task worker, which runs process_pending:
+events are applied to their orders oldest first, each in its own
+transaction with the order row locked. An event that fails is retried
+with exponential backoff (next_attempt_at), up to MAX_ATTEMPTS; while
+any are waiting, the task schedules itself for when the next one is due,
+so a retry never waits for an unrelated webhook to come in. The
+process_webhook_events command does the same by hand.
+
+Applying is idempotent: an event only moves an order along an allowed
+transition (a PAID order is never cancelled by a late EXPIRED, a second
+PAID finds it confirmed already), so replaying events is always safe.
+"""
+import logging
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import badges
+from .models import CartItem, Order, WebhookEvent
+from .orders import confirm_order, release_order
+from .taskqueue import task
+
+logger = logging.getLogger(__name__)
+
+XENDIT = 'xendit'
+# Failing events are retried this many times, then left for replay_webhook_events
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF = 30          # seconds before the first retry, doubled per attempt
+
+CANCELLING_STATUSES = ('EXPIRED', 'FAILED', 'CLOSED')
+
+
+def record_event(provider, payload):
+    """Store a webhook in the inbox. A redelivery, or an event without an id or status, is dropped."""
+    event_id = str(payload.get('id') or payload.get('external_id') or '')
+    status = str(payload.get('status') or '')
+    if not event_id or not status:
+        logger.warning("Dropped a %s webhook without an id or status: %s", provider, payload)
+        return
+    # ignore_conflicts: a duplicate is dropped by the database, no read first
+    WebhookEvent.objects.bulk_create([
+        WebhookEvent(
+            provider=provider, event_id=event_id[:100], status=status[:30],
+            external_id=str(payload.get('external_id') or '')[:150], payload=payload,
+        )
+    ], ignore_conflicts=True)
+    # Applied by a worker as soon as one is free; a redelivery just finds nothing left to do
+    apply_webhook_events.enqueue()
+
+
+def _pay(order, event):
+    if order.status not in ('pending', 'cancelled'):
+        return
+    if order.status == 'cancelled':
+        # Paid after we gave up on it: the money is in, so the order stands
+        logger.warning("Order %s was paid after it was cancelled", order.pk)
+    confirm_order(order)
+    order.status = 'confirmed'
+    order.invoice_id = event.event_id
+    order.payment_method = 'xendit'
+    order.save(update_fields=['status', 'invoice_id', 'payment_method'])
+    CartItem.objects.filter(user=order.user_id).delete()
+    badges.reset(badges.CART, order.user_id)
+
+
+def _cancel(order, event):
+    if order.status != 'pending':
+        return
+    release_order(order)
+    order.status = 'cancelled'
+    order.invoice_id = event.event_id
+    order.save(update_fields=['status', 'invoice_id'])
+
+
+def _refund(order, event):
+    if order.status in ('refunded', 'cancelled', 'pending'):
+        return
+    order.status = 'refunded'
+    order.save(update_fields=['status'])
+
+
+def _handler(status):
+    if status == 'PAID':
+        return _pay
+    if status in CANCELLING_STATUSES:
+        return _cancel
+    if status == 'REFUNDED':
+        return _refund
+    return None
+
+
+def apply_event(event):
+    """
+    Apply one inbox event to its order and mark it processed, atomically.
+    Returns False if it was already processed (e.g. by another worker).
+    """
+    with transaction.atomic():
+        # Claim it; a second worker skips it rather than waiting for the lock
+        event = (
+            WebhookEvent.objects.select_for_update(skip_locked=True)
+            .filter(pk=event.pk, processed_at__isnull=True).first()
+        )
+        if event is None:
+            return False
+        event.last_error = ''
+        handler = _handler(event.status)
+        if handler is None:
+            event.last_error = f"Ignored status {event.status}"
+        else:
+            order = Order.objects.select_for_update().filter(external_id=event.external_id).first()
+            if order is None:
+                event.last_error = f"No order with external_id {event.external_id!r}"
+            else:
+                handler(order, event)
+        event.processed_at = timezone.now()
+        event.attempts += 1
+        event.save(update_fields=['processed_at', 'attempts', 'last_error'])
+    return True
+
+
+def _fail(event, error):
+    logger.exception("Could not apply webhook event %s", event.pk)
+    # Back off, so a short outage doesn't use up every attempt at once
+    retry_at = timezone.now() + timedelta(seconds=RETRY_BACKOFF * 2 ** event.attempts)
+    WebhookEvent.objects.filter(pk=event.pk).update(
+        attempts=F('attempts') + 1, next_attempt_at=retry_at, last_error=repr(error)[:2000],
+    )
+
+
+def retryable_events():
+    """Unprocessed events with attempts left, whether or not they are due yet."""
+    return WebhookEvent.objects.filter(processed_at__isnull=True, attempts__lt=MAX_ATTEMPTS)
+
+
+def pending_events():
+    """Events due to be applied now, oldest first."""
+    return retryable_events().filter(next_attempt_at__lte=timezone.now()).order_by('received_at', 'pk')
+
+
+def process_pending(batch_size=100):
+    """Apply due events oldest first; returns how many were applied."""
+    applied = 0
+    for event in pending_events()[:batch_size]:
+        try:
+            applied += apply_event(event)
+        except Exception as e:
+            # One bad event mustn't stop the queue; it is retried later, up to MAX_ATTEMPTS
+            _fail(event, e)
+    return applied
+
+
+@task(priority=10, max_attempts=3)
+def apply_webhook_events():
+    """
+    Apply every due event, then schedule the next run for when the first
+    failed one is due again. If the run itself fails, the task queue
+    retries it.
+    """
+    while process_pending():
+        pass
+    next_due = retryable_events().order_by('next_attempt_at').values_list('next_attempt_at', flat=True).first()
+    if next_due is not None:
+        apply_webhook_events.schedule_unless_queued(max(next_due, timezone.now()))